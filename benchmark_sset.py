@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Compares the skip list behind miniredis.sset.SortedSet with the sorted list it
+replaced, timing random inserts, removals, ranks and range reads against sets
+of increasing size.
+
+Usage: benchmark_sset.py [size ...]   (defaults to 10000 1000000 10000000)
+
+Published under the MIT license.
+"""
+
+import sys, time, random
+from bisect import bisect_left, bisect_right, insort
+from miniredis.sset import SortedSet
+
+OPERATIONS = 10000
+# slow operations stop early, after this many seconds
+BUDGET = 5
+RANGE = 10
+
+
+class ListSortedSet(object):
+    """The original implementation, kept here for comparison"""
+
+    def __init__(self):
+        self._scores = []
+        self._members = {}
+
+    def insert(self, member, score):
+        old = self._members.get(member)
+        if old is not None:
+            if old == score:
+                return False
+            self._scores.remove((old, member))
+        insort(self._scores, (score, member))
+        self._members[member] = score
+        return old is None
+
+    def remove(self, member):
+        if member not in self._members:
+            return False
+        score = self._members.pop(member)
+        self._scores.remove((score, member))
+        return True
+
+    def rank(self, member):
+        score = self._members.get(member)
+        if score is None:
+            return None
+        return bisect_left(self._scores, (score, member))
+
+    def range(self, start, end, desc=False):
+        return self._scores[start:end + 1]
+
+    def scorerange(self, start, end):
+        left = bisect_left(self._scores, (start,))
+        right = bisect_right(self._scores, (end,))
+        while right < len(self._scores) and self._scores[right][0] == end:
+            right += 1
+        return self._scores[left:right]
+
+
+def build(cls, size):
+    zset = cls()
+    for i in xrange(size):
+        zset.insert('m%d' % i, float(i))
+    return zset
+
+
+def timed(label, size, func):
+    now = time.time()
+    for count in xrange(1, OPERATIONS + 1):
+        func(random.randrange(size))
+        elapsed = time.time() - now
+        if elapsed > BUDGET:
+            break
+    print "  %-12s %12.0f ops/s" % (label, count / elapsed)
+
+
+def run(cls, size):
+    print "%s, %d members" % (cls.__name__, size)
+    now = time.time()
+    zset = build(cls, size)
+    print "  %-12s %12.2f s" % ('build', time.time() - now)
+    timed('rank', size, lambda i: zset.rank('m%d' % i))
+    timed('range', size, lambda i: zset.range(i, i + RANGE - 1))
+    timed('scorerange', size, lambda i: zset.scorerange(i, i + RANGE - 1))
+    timed('remove', size, lambda i: zset.remove('m%d' % i))
+    timed('insert', size, lambda i: zset.insert('m%d' % i, i + 0.5))
+
+
+def main():
+    sizes = [int(arg) for arg in sys.argv[1:]] or [10000, 1000000, 10000000]
+    random.seed(0)
+    for size in sizes:
+        for cls in (ListSortedSet, SortedSet):
+            run(cls, size)
+
+
+if __name__ == '__main__':
+    main()
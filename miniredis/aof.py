@@ -0,0 +1,216 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Append-only file persistence: write commands are logged in request format,
+written once per event loop iteration and synced according to a policy.
+
+Published under the MIT license.
+"""
+
+import os, time, thread, logging
+from collections import deque
+
+from .protocol import RequestParser, encode_request
+from .sset import SortedSet
+from .intset import IntSet
+from .packed import PackedList, PackedHash
+
+log = logging.getLogger()
+
+FSYNC_POLICIES = ('always', 'everysec', 'no')
+
+# values per command when rewriting big collections
+REWRITE_BATCH = 64
+
+
+class AppendOnlyFile(object):
+
+    def __init__(self, path, fsync='everysec'):
+        self.path = path
+        self.fsync = fsync
+        self.file = open(self.path, 'ab')
+        self.buf = []
+        self.db = None              # database currently selected in the log
+        self.last_fsync = time.time()
+        self.syncing = False
+        self.rewrite_buf = None     # writes made while a rewrite is running
+        self.rewrite_pid = None
+        self.rewrite_started = None
+        self.last_rewrite_status = 'ok'
+        self.wait_rewrite = False   # whether the log is only valid once rewritten
+
+
+    def feed(self, db, args):
+        """Queue a command for the log"""
+        if db != self.db:
+            self.db = db
+            self._append(encode_request(['SELECT', str(db)]))
+        self._append(encode_request(args))
+
+
+    def _append(self, data):
+        self.buf.append(data)
+        if self.rewrite_buf is not None:
+            self.rewrite_buf.append(data)
+
+
+    def flush(self):
+        """Write out queued commands - called once per event loop iteration,
+        before replies are sent, so all the writes in a batch are committed
+        together"""
+        if not self.buf:
+            return
+        if self.wait_rewrite:
+            # the writes are kept for the rewrite, and the log left alone
+            self.buf = []
+            return
+        self.file.write(''.join(self.buf))
+        self.file.flush()
+        self.buf = []
+        if self.fsync == 'always':
+            os.fsync(self.file.fileno())
+            self.last_fsync = time.time()
+
+
+    def cron(self):
+        """Sync the log once a second under the everysec policy. The fsync
+        itself runs in a background thread, so the loop never waits on it"""
+        if self.fsync != 'everysec' or self.syncing or self.wait_rewrite:
+            return
+        now = time.time()
+        if now - self.last_fsync < 1:
+            return
+        self.last_fsync = now
+        self.syncing = True
+        thread.start_new_thread(self._fsync, (self.file.fileno(),))
+
+
+    def _fsync(self, fd):
+        try:
+            os.fsync(fd)
+        except OSError, e:
+            log.debug("AOF fsync failed: %s" % e) # file swapped by a rewrite
+        self.syncing = False
+
+
+    def close(self):
+        self.flush()
+        os.fsync(self.file.fileno())
+        self.file.close()
+
+
+    def size(self):
+        return self.file.tell()
+
+
+    def load(self, execute):
+        """Replay the log, passing each command to `execute`. A command cut
+        short by a crash is dropped, and the file truncated to match"""
+        parser = RequestParser()
+        fed = loaded = count = 0
+        with open(self.path, 'rb') as f:
+            while True:
+                data = f.read(1024 * 1024)
+                if not data:
+                    break
+                parser.feed(data)
+                fed += len(data)
+                while True:
+                    args = parser.get()
+                    if args is None:
+                        break
+                    execute(args)
+                    count += 1
+                    loaded = fed - (len(parser.buf) - parser.pos)
+        if loaded < fed:
+            log.warning("Truncating %s: %d bytes of incomplete commands at the end" % (self.path, fed - loaded))
+            self.file.truncate(loaded)
+            self.file.seek(0, os.SEEK_END)
+        return count
+
+
+    def start_rewrite(self, tables, timeouts):
+        """Fork a child that writes the current dataset as a compact log, while
+        the parent keeps a copy of the writes made in the meantime"""
+        self.flush()
+        temp = '%s.rewrite-%d' % (self.path, os.getpid())
+        pid = os.fork()
+        if not pid:
+            try:
+                rewrite(temp, tables, timeouts)
+            except Exception, e:
+                log.exception("AOF rewrite failed")
+                os._exit(1)
+            os._exit(0)
+        self.rewrite_pid = pid
+        self.rewrite_started = time.time()
+        self.rewrite_buf = []
+        self.db = None # make sure the next write selects its database
+        return pid
+
+
+    def finish_rewrite(self, status):
+        """Called with the child's exit status: append the writes made
+        during the rewrite and atomically replace the log"""
+        temp = '%s.rewrite-%d' % (self.path, os.getpid())
+        pending, self.rewrite_buf = self.rewrite_buf, None
+        self.rewrite_pid = None
+        if status != 0:
+            self.last_rewrite_status = 'err'
+            try:
+                os.unlink(temp)
+            except OSError:
+                pass
+            return False
+        self.flush()
+        with open(temp, 'ab') as f:
+            f.write(''.join(pending))
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(temp, self.path)
+        self.file.close()
+        self.file = open(self.path, 'ab')
+        self.wait_rewrite = False
+        self.last_rewrite_status = 'ok'
+        log.info("AOF rewrite of %s complete in %.2fs" % (self.path, time.time() - self.rewrite_started))
+        return True
+
+
+def rewrite_commands(key, value):
+    """Commands that recreate a value"""
+    if isinstance(value, (str, int, long)):
+        return [['SET', key, str(value)]]
+    if isinstance(value, (deque, PackedList)):
+        items, command = list(value), 'RPUSH'
+    elif isinstance(value, (dict, PackedHash)):
+        items, command = [], 'HMSET'
+        for field, v in value.iteritems():
+            items.extend((field, str(v)))
+    elif isinstance(value, SortedSet):
+        items, command = [], 'ZADD'
+        for score, member in value:
+            items.extend((repr(score), member))
+    elif isinstance(value, (set, IntSet)):
+        items, command = list(value), 'SADD'
+    else:
+        raise TypeError("Can't rewrite %s" % type(value))
+    # keep pairs together for hashes and sorted sets
+    batch = REWRITE_BATCH * (2 if command in ('HMSET', 'ZADD') else 1)
+    return [[command, key] + items[i:i+batch] for i in xrange(0, len(items), batch)]
+
+
+def rewrite(path, tables, timeouts):
+    """Write a compact log recreating the given tables"""
+    with open(path, 'wb') as f:
+        for db, table in tables.iteritems():
+            if not table:
+                continue
+            f.write(encode_request(['SELECT', str(db)]))
+            for key, value in table.iteritems():
+                for args in rewrite_commands(key, value):
+                    f.write(encode_request(args))
+                when = timeouts.get((db, key))
+                if when is not None:
+                    f.write(encode_request(['PEXPIREAT', key, str(int(when * 1000))]))
+        f.flush()
+        os.fsync(f.fileno())
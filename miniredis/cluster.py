@@ -0,0 +1,458 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Multi-process serving mode: the keyspace is hash-partitioned across shard
+processes, each a plain RedisServer on a private port, and fronted by router
+processes that share the public port through SO_REUSEPORT.
+
+Routers pipeline every command a client has sent to the shards owning its
+keys, and split multi-key commands (MGET, DEL) across shards, merging the
+replies. Shard connections are polled in the routers' event loops like
+client sockets, so a slow shard only holds up the replies that depend on it.
+As in Redis Cluster, a {hash tag} in a key name decides its shard, so
+related keys can be kept together for multi-key commands. SCAN walks the
+shards one after the other, the cursor telling which one it is on.
+
+Published under the MIT license.
+"""
+
+import os, time, signal, socket, logging, errno
+from collections import deque
+from random import choice
+from zlib import crc32
+
+from .server import RedisServer
+from .poller import READ, WRITE
+from .protocol import RedisError, ProtocolError, ReplyParser, encode_request
+
+log = logging.getLogger()
+
+# commands answered by the router itself
+LOCAL = frozenset(['command', 'config', 'info', 'monitor', 'ping', 'quit', 'select', 'shutdown'])
+
+
+def key_shard(key, shards):
+    """Map a key to a shard, honouring {hash tags} like Redis Cluster does"""
+    start = key.find('{')
+    if start >= 0:
+        end = key.find('}', start + 1)
+        if end > start + 1:
+            key = key[start+1:end]
+    return (crc32(key) & 0xffffffff) % shards
+
+
+def _first(replies):
+    return replies[0]
+
+
+def _sum(replies):
+    return sum(replies)
+
+
+def _concat(replies):
+    result = []
+    for r in replies:
+        result.extend(r)
+    return result
+
+
+def _random(replies):
+    replies = [r for r in replies if r is not None]
+    return choice(replies) if replies else None
+
+
+# keyless commands sent to every shard: name -> merge function
+BROADCAST = {
+    'bgrewriteaof': _first,
+    'bgsave':   _first,
+    'flushall': _first,
+    'flushdb':  _first,
+    'keys':     _concat,
+    'lastsave': min,
+    'randomkey': _random,
+    'save':     _first,
+}
+
+# multi-key commands that can be split across shards:
+# name -> (arguments per key, merge function)
+SPLIT = {
+    'del':  (1, _sum),
+    'mget': (1, None), # replies are put back in key order
+    'mset': (2, _first),
+}
+
+
+class Backend(object):
+    """Non-blocking, pipelined connection from a router to one shard. Every
+    request sent has a slot its reply goes to, in order (None for the
+    router's own SELECTs)"""
+
+    def __init__(self, address):
+        self.address = address
+        self.sock = None
+        self.reset()
+
+
+    def reset(self):
+        if self.sock:
+            self.sock.close()
+        self.sock = self.fd = None
+        self.db = 0
+        self.out = []
+        self.parser = ReplyParser()
+        self.waiting = deque()
+
+
+    def connect(self, attempts=1):
+        for attempt in xrange(attempts):
+            try:
+                self.sock = socket.create_connection(self.address)
+                break
+            except socket.error, e:
+                if attempt == attempts - 1:
+                    raise
+                time.sleep(0.1)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.sock.setblocking(0)
+        self.fd = self.sock.fileno()
+
+
+    def send(self, db, args, slot):
+        if db != self.db:
+            self.out.append(encode_request(['SELECT', str(db)]))
+            self.waiting.append(None)
+            self.db = db
+        self.out.append(encode_request(args))
+        self.waiting.append(slot)
+
+
+    def flush(self):
+        """Send as much queued output as the socket takes, returning whether
+        it all went"""
+        if not self.out:
+            return True
+        data = ''.join(self.out)
+        try:
+            sent = self.sock.send(data)
+        except socket.error, e:
+            if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                raise
+            sent = 0
+        self.out = [data[sent:]] if sent < len(data) else []
+        return not self.out
+
+
+    def read(self):
+        """Read what the shard has sent, returning the (slot, reply) pairs it
+        completed"""
+        while True:
+            try:
+                data = self.sock.recv(65536)
+            except socket.error, e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                    break
+                raise
+            if not data:
+                raise ProtocolError('Connection closed')
+            self.parser.feed(data)
+            if len(data) < 65536:
+                break
+        done = []
+        for reply in self.parser.replies():
+            slot = self.waiting.popleft()
+            if slot is None:
+                if isinstance(reply, RedisError):
+                    log.error("Shard %s:%d: %s" % (self.address + (reply,)))
+                continue
+            done.append((slot, reply))
+        return done
+
+
+class Plan(object):
+    """A client command being answered: the replies still due from the shards
+    and how to merge them, or the router's own result"""
+
+    __slots__ = ('merge', 'replies', 'missing', 'close')
+
+    def __init__(self, requests, merge):
+        self.merge = merge
+        self.replies = None if requests is None else [None] * len(requests)
+        self.missing = len(requests or ())
+        self.close = False  # whether the client goes once this is answered
+
+
+    def result(self):
+        if self.replies is None:
+            return self.merge
+        for reply in self.replies:
+            if isinstance(reply, RedisError):
+                return reply
+        return self.merge(self.replies)
+
+
+class ShardRouter(RedisServer):
+    """Front-end that routes each command to the shard(s) owning its keys"""
+
+    def __init__(self, shards, **kwargs):
+        kwargs['db_path'] = None
+        super(ShardRouter, self).__init__(**kwargs)
+        self.reuseport = True
+        self.backends = [Backend(address) for address in shards]
+        self.plans = {}     # client -> its commands being answered, in order
+
+
+    def load(self):
+        """Startup: connect to the shards, which may still be starting up"""
+        for backend in self.backends:
+            try:
+                self.connect_backend(backend, attempts=50)
+            except socket.error, e:
+                log.error("Shard %s:%d unavailable: %s" % (backend.address + (e,)))
+
+
+    def connect_backend(self, backend, attempts=1):
+        backend.connect(attempts)
+        self.poller.register(backend.fd, READ)
+        self.watched[backend.fd] = lambda events: self.on_backend(backend, events)
+
+
+    def process(self, client):
+        """Route every complete command in a client's buffer, pipelining them
+        all to the shards; their replies are sent back in order as they come"""
+        if client.closing:
+            return
+        parser = client.parser
+        queue = self.plans.setdefault(client, deque())
+        while not client.closing:
+            try:
+                args = parser.get()
+            except ProtocolError, e:
+                plan = Plan(None, RedisError(str(e)))
+                client.closing = True
+            else:
+                if args is None:
+                    break
+                requests, merge = self.route(client, args)
+                plan = Plan(requests, merge)
+                for i, (shard, db, args) in enumerate(requests or ()):
+                    self.backends[shard].send(db, args, (client, plan, i))
+            queue.append(plan)
+        if client.closing:
+            # close once the replies already due are sent
+            queue[-1].close = True
+            client.closing = False
+        for backend in self.backends:
+            if backend.out:
+                self.flush_backend(backend)
+        self.answer(client)
+
+
+    def answer(self, client):
+        """Send a client the replies to its commands that are complete, up to
+        the first one still waiting on a shard"""
+        queue = self.plans.get(client)
+        while queue and not queue[0].missing:
+            plan = queue.popleft()
+            self.dump(client, plan.result())
+            if plan.close:
+                client.closing = True
+                queue.clear()
+
+
+    def deliver_replies(self, done):
+        """Fill in the slots of shard replies, answering the clients that
+        were waiting on them"""
+        clients = set()
+        for (client, plan, i), reply in done:
+            plan.replies[i] = reply
+            plan.missing -= 1
+            if not plan.missing:
+                clients.add(client)
+        for client in clients:
+            self.answer(client)
+
+
+    def flush_backend(self, backend):
+        try:
+            if backend.sock is None:
+                self.connect_backend(backend)
+            done = backend.flush()
+        except socket.error, e:
+            self.fail_backend(backend, e)
+            return
+        self.poller.modify(backend.fd, READ if done else READ | WRITE)
+
+
+    def on_backend(self, backend, events):
+        if events & READ:
+            try:
+                done = backend.read()
+            except (socket.error, ProtocolError, IndexError), e:
+                self.fail_backend(backend, e)
+                return
+            self.deliver_replies(done)
+        if events & WRITE:
+            self.flush_backend(backend)
+
+
+    def fail_backend(self, backend, e):
+        """Drop a shard connection, failing the requests waiting on it; the
+        next request to the shard reconnects"""
+        log.error("Shard %s:%d failed: %s" % (backend.address + (e,)))
+        if backend.fd is not None:
+            self.watched.pop(backend.fd, None)
+            try:
+                self.poller.unregister(backend.fd)
+            except (KeyError, IOError, OSError):
+                pass
+        waiting = backend.waiting
+        backend.reset()
+        error = RedisError('shard %s:%d unavailable' % backend.address)
+        self.deliver_replies([(slot, error) for slot in waiting if slot is not None])
+
+
+    def disconnect(self, client):
+        self.plans.pop(client, None)
+        super(ShardRouter, self).disconnect(client)
+
+
+    def route(self, client, args):
+        """Plan a command: returns the (shard, db, args) requests to make and
+        a function merging their replies, or None and a local result"""
+        name = args[0].lower()
+        command = self.commands.get(name)
+        if command is None or not command.check_arity(len(args)) or name in LOCAL:
+            return None, self.call(client, args)
+        if 'pubsub' in command.flags or 'blocking' in command.flags:
+            # a router's clients share its connection to each shard, so these
+            # would hold up everyone else's requests to that shard
+            return None, RedisError("'%s' is not supported in sharded mode" % name)
+        n = len(self.backends)
+        if name in BROADCAST:
+            return [(i, client.db, args) for i in xrange(n)], BROADCAST[name]
+        if name == 'scan':
+            return self.route_scan(client, args)
+        keys = command.keys(args)
+        if not keys:
+            return None, self.call(client, args)
+        shards = set([key_shard(k, n) for k in keys])
+        if len(shards) == 1:
+            return [(shards.pop(), client.db, args)], _first
+        if name in SPLIT:
+            return self.split(client, args, *SPLIT[name])
+        return None, RedisError("Keys in request don't hash to the same shard", 'CROSSSLOT')
+
+
+    def route_scan(self, client, args):
+        """Plan a SCAN step: the client's cursor holds the shard being walked
+        and that shard's own cursor"""
+        n = len(self.backends)
+        try:
+            cursor = int(args[1])
+        except ValueError:
+            cursor = -1
+        if cursor < 0:
+            return None, RedisError('invalid cursor')
+        shard, cursor = cursor % n, cursor // n
+        def merge(replies):
+            cursor, keys = replies[0]
+            cursor = int(cursor)
+            if cursor:
+                cursor = cursor * n + shard
+            elif shard + 1 < n:
+                # move on to the next shard
+                cursor = shard + 1
+            return [str(cursor), keys]
+        return [(shard, client.db, [args[0], str(cursor)] + args[2:])], merge
+
+
+    def split(self, client, args, step, merge):
+        """Break up a multi-key command into one request per shard"""
+        n = len(self.backends)
+        groups = {}
+        for pos in xrange(1, len(args), step):
+            groups.setdefault(key_shard(args[pos], n), []).append(pos)
+        shards = sorted(groups)
+        requests = []
+        for shard in shards:
+            shard_args = [args[0]]
+            for pos in groups[shard]:
+                shard_args.extend(args[pos:pos+step])
+            requests.append((shard, client.db, shard_args))
+        if merge is None:
+            # put values back in the order of the keys that asked for them
+            def merge(replies):
+                result = [None] * ((len(args) - 1) / step)
+                for shard, reply in zip(shards, replies):
+                    for pos, value in zip(groups[shard], reply):
+                        result[(pos - 1) / step] = value
+                return result
+        return requests, merge
+
+
+    def handle_shutdown(self, client):
+        # the supervisor stops the shards once a router exits
+        self.log(client, 'SHUTDOWN')
+        self.halt = True
+        client.closing = True
+        return False
+
+
+    def save(self):
+        pass
+
+
+def spawn(cls, **kwargs):
+    """Run a server in a child process"""
+    pid = os.fork()
+    if pid:
+        return pid
+    server = cls(**kwargs)
+    signal.signal(signal.SIGTERM, lambda signum, frame: server.stop())
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    try:
+        server.run()
+    except Exception, e:
+        log.exception("%s on port %d failed" % (cls.__name__, kwargs.get('port')))
+    server.stop()
+    os._exit(0)
+
+
+def serve(host='127.0.0.1', port=6379, db_path='.', workers=2, appendonly=False):
+    """
+    Launch `workers` shard processes (listening on 127.0.0.1 from port + 1
+    upwards) and as many routers sharing the public port, then wait until
+    any of them exits, or a SIGTERM arrives, to stop them all.
+    """
+    shards = [('127.0.0.1', port + 1 + i) for i in xrange(workers)]
+    children = []
+    for i, (shard_host, shard_port) in enumerate(shards):
+        path = os.path.join(db_path, 'shard%d' % i) if db_path else None
+        children.append(spawn(RedisServer, host=shard_host, port=shard_port, db_path=path, appendonly=appendonly))
+    for i in xrange(workers):
+        children.append(spawn(ShardRouter, shards=shards, host=host, port=port))
+
+    def stop(signum=None, frame=None):
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    stopping = False
+    while children:
+        try:
+            pid, status = os.wait()
+        except OSError, e:
+            if e.errno == errno.EINTR:
+                continue
+            if e.errno == errno.ECHILD:
+                break
+            raise
+        if pid in children:
+            children.remove(pid)
+        if not stopping:
+            stopping = True
+            stop()
@@ -0,0 +1,213 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Command table: maps command names to handlers, arity, flags and key positions
+
+Published under the MIT license.
+"""
+
+import inspect
+
+# name: (flags, first key, last key, key step) - as in the Redis command table,
+# a negative last key counts from the end of the argument list
+COMMAND_SPECS = {
+    # Keys
+    'del':          ('write', 1, -1, 1),
+    'dump':         ('readonly', 1, 1, 1),
+    'exists':       ('readonly fast', 1, 1, 1),
+    'expire':       ('write fast', 1, 1, 1),
+    'expireat':     ('write fast', 1, 1, 1),
+    'keys':         ('readonly', 0, 0, 0),
+    'move':         ('write fast', 1, 1, 1),
+    'persist':      ('write fast', 1, 1, 1),
+    'pexpire':      ('write fast', 1, 1, 1),
+    'pexpireat':    ('write fast', 1, 1, 1),
+    'pttl':         ('readonly fast', 1, 1, 1),
+    'randomkey':    ('readonly random', 0, 0, 0),
+    'rename':       ('write', 1, 2, 1),
+    'renamenx':     ('write fast', 1, 2, 1),
+    'scan':         ('readonly random', 0, 0, 0),
+    'ttl':          ('readonly fast', 1, 1, 1),
+    'type':         ('readonly fast', 1, 1, 1),
+    # Strings
+    'append':       ('write denyoom', 1, 1, 1),
+    'decr':         ('write denyoom fast', 1, 1, 1),
+    'decrby':       ('write denyoom fast', 1, 1, 1),
+    'get':          ('readonly fast', 1, 1, 1),
+    'getset':       ('write denyoom', 1, 1, 1),
+    'incr':         ('write denyoom fast', 1, 1, 1),
+    'incrby':       ('write denyoom fast', 1, 1, 1),
+    'mget':         ('readonly', 1, -1, 1),
+    'mset':         ('write denyoom', 1, -1, 2),
+    'msetnx':       ('write denyoom', 1, -1, 2),
+    'set':          ('write denyoom', 1, 1, 1),
+    'setex':        ('write denyoom', 1, 1, 1),
+    'setnx':        ('write denyoom fast', 1, 1, 1),
+    # Lists
+    'blpop':        ('write blocking', 1, -2, 1),
+    'brpop':        ('write blocking', 1, -2, 1),
+    'brpoplpush':   ('write denyoom blocking', 1, 2, 1),
+    'llen':         ('readonly fast', 1, 1, 1),
+    'lpop':         ('write fast', 1, 1, 1),
+    'lpush':        ('write denyoom fast', 1, 1, 1),
+    'lrange':       ('readonly', 1, 1, 1),
+    'rpop':         ('write fast', 1, 1, 1),
+    'rpoplpush':    ('write denyoom', 1, 2, 1),
+    'rpush':        ('write denyoom fast', 1, 1, 1),
+    # Hashes
+    'hdel':         ('write fast', 1, 1, 1),
+    'hexists':      ('readonly fast', 1, 1, 1),
+    'hget':         ('readonly fast', 1, 1, 1),
+    'hgetall':      ('readonly', 1, 1, 1),
+    'hincrby':      ('write denyoom fast', 1, 1, 1),
+    'hkeys':        ('readonly', 1, 1, 1),
+    'hlen':         ('readonly fast', 1, 1, 1),
+    'hmget':        ('readonly', 1, 1, 1),
+    'hmset':        ('write denyoom', 1, 1, 1),
+    'hscan':        ('readonly random', 1, 1, 1),
+    'hset':         ('write denyoom fast', 1, 1, 1),
+    'hvals':        ('readonly', 1, 1, 1),
+    # Sets
+    'sadd':         ('write denyoom fast', 1, 1, 1),
+    'scard':        ('readonly fast', 1, 1, 1),
+    'sdiff':        ('readonly', 1, -1, 1),
+    'sdiffstore':   ('write denyoom', 1, -1, 1),
+    'sinter':       ('readonly', 1, -1, 1),
+    'sinterstore':  ('write denyoom', 1, -1, 1),
+    'sismember':    ('readonly fast', 1, 1, 1),
+    'smembers':     ('readonly', 1, 1, 1),
+    'smove':        ('write fast', 1, 2, 1),
+    'spop':         ('write random fast', 1, 1, 1),
+    'srandmember':  ('readonly random', 1, 1, 1),
+    'srem':         ('write fast', 1, 1, 1),
+    'sscan':        ('readonly random', 1, 1, 1),
+    'sunion':       ('readonly', 1, -1, 1),
+    'sunionstore':  ('write denyoom', 1, -1, 1),
+    # Sorted Sets
+    'zadd':         ('write denyoom fast', 1, 1, 1),
+    'zcard':        ('readonly fast', 1, 1, 1),
+    'zcount':       ('readonly fast', 1, 1, 1),
+    'zincrby':      ('write denyoom fast', 1, 1, 1),
+    'zinterstore':  ('write denyoom', 1, 1, 1),
+    'zrange':       ('readonly', 1, 1, 1),
+    'zrangebyscore': ('readonly', 1, 1, 1),
+    'zrank':        ('readonly fast', 1, 1, 1),
+    'zrem':         ('write fast', 1, 1, 1),
+    'zremrangebyrank': ('write', 1, 1, 1),
+    'zremrangebyscore': ('write', 1, 1, 1),
+    'zrevrange':    ('readonly', 1, 1, 1),
+    'zrevrangebyscore': ('readonly', 1, 1, 1),
+    'zrevrank':     ('readonly fast', 1, 1, 1),
+    'zscan':        ('readonly random', 1, 1, 1),
+    'zscore':       ('readonly fast', 1, 1, 1),
+    'zunionstore':  ('write denyoom', 1, 1, 1),
+    # Server
+    'bgrewriteaof': ('admin', 0, 0, 0),
+    'bgsave':       ('admin', 0, 0, 0),
+    'command':      ('loading', 0, 0, 0),
+    'config':       ('admin loading', 0, 0, 0),
+    'flushall':     ('write', 0, 0, 0),
+    'flushdb':      ('write', 0, 0, 0),
+    'info':         ('loading', 0, 0, 0),
+    'lastsave':     ('random fast', 0, 0, 0),
+    'monitor':      ('admin loading', 0, 0, 0),
+    'ping':         ('fast', 0, 0, 0),
+    'quit':         ('loading fast', 0, 0, 0),
+    'save':         ('admin', 0, 0, 0),
+    'select':       ('loading fast', 0, 0, 0),
+    'shutdown':     ('admin loading', 0, 0, 0),
+    # PubSub
+    'publish':      ('pubsub loading fast', 0, 0, 0),
+    'subscribe':    ('pubsub loading', 0, 0, 0),
+    'unsubscribe':  ('pubsub loading', 0, 0, 0),
+    'psubscribe':   ('pubsub loading', 0, 0, 0),
+    'punsubscribe': ('pubsub loading', 0, 0, 0),
+    'pubsub':       ('pubsub random loading', 0, 0, 0),
+}
+
+DEFAULT_SPEC = ('', 0, 0, 0)
+
+
+def numkeys_keys(args):
+    """Keys of commands like ZUNIONSTORE: a destination, then a count of
+    source keys, and the keys themselves"""
+    try:
+        count = int(args[2])
+    except (IndexError, ValueError):
+        count = 0
+    return [args[1]] + args[3:3+max(count, 0)]
+
+
+# commands whose keys can't be told by their positions alone: name -> function
+# returning the key arguments of a request
+KEY_FUNCTIONS = {
+    'zinterstore': numkeys_keys,
+    'zunionstore': numkeys_keys,
+}
+
+
+class Command(object):
+    """A command table entry, including its call statistics"""
+
+    __slots__ = ('name', 'handler', 'arity', 'flags', 'firstkey', 'lastkey', 'step', 'getkeys', 'calls', 'usec')
+
+    def __init__(self, name, handler, arity, flags, firstkey, lastkey, step, getkeys=None):
+        self.name = name
+        self.handler = handler
+        self.arity = arity
+        self.flags = frozenset(flags.split())
+        self.firstkey = firstkey
+        self.lastkey = lastkey
+        self.step = step
+        self.getkeys = getkeys
+        self.calls = 0
+        self.usec = 0
+
+
+    def check_arity(self, argc):
+        """Whether `argc` arguments (including the command name) are acceptable"""
+        if self.arity < 0:
+            return argc >= -self.arity
+        return argc == self.arity
+
+
+    def keys(self, args):
+        """Return the key arguments of a request (including the command name)"""
+        if self.getkeys:
+            return self.getkeys(args)
+        if not self.firstkey:
+            return []
+        last = self.lastkey
+        if last < 0:
+            last += len(args)
+        return args[self.firstkey:last+1:self.step]
+
+
+    def info(self):
+        """Reply for COMMAND INFO"""
+        return [self.name, self.arity, sorted(self.flags), self.firstkey, self.lastkey, self.step]
+
+
+def arity(handler):
+    """Derive a Redis-style arity from a handler's signature (which takes the
+    client as its first argument): optional and variadic arguments make it
+    negative, meaning "at least" that many"""
+    args, varargs, _, defaults = inspect.getargspec(handler)
+    # drop self and client, add the command name
+    count = len(args) - 1 - len(defaults or ())
+    if varargs or defaults:
+        return -count
+    return count
+
+
+def build_command_table(server):
+    """Build the command table for a server out of its handle_* methods"""
+    table = {}
+    for attr in dir(server):
+        if not attr.startswith('handle_'):
+            continue
+        name = attr[len('handle_'):]
+        handler = getattr(server, attr)
+        spec = COMMAND_SPECS.get(name, DEFAULT_SPEC)
+        table[name] = Command(name, handler, arity(handler), *spec, getkeys=KEY_FUNCTIONS.get(name))
+    return table
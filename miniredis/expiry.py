@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Time-ordered index of key deadlines, used for active and lazy expiry
+
+Published under the MIT license.
+"""
+
+from heapq import heapify, heappush, heappop
+
+
+class ExpiryIndex(object):
+    """
+    Maps (db, key) pairs to absolute deadlines (in seconds since the epoch).
+
+    Deadlines are kept in a dict for O(1) lookups on access, and mirrored in a
+    min-heap of (deadline, item) pairs so that due keys can be found without
+    looking at the rest. Heap entries are never removed when a deadline is
+    changed or cleared - stale entries are skipped when they reach the top,
+    and the heap is rebuilt once they outnumber the live ones.
+    """
+
+    def __init__(self, deadlines=None):
+        self.deadlines = {}
+        self.heap = []
+        if deadlines:
+            self.deadlines.update(deadlines)
+            self._rebuild()
+
+
+    def __len__(self):
+        return len(self.deadlines)
+
+
+    def __contains__(self, item):
+        return item in self.deadlines
+
+
+    def __getitem__(self, item):
+        return self.deadlines[item]
+
+
+    def __setitem__(self, item, when):
+        self.deadlines[item] = when
+        heappush(self.heap, (when, item))
+        if len(self.heap) > 2 * len(self.deadlines) + 64:
+            self._rebuild()
+
+
+    def __delitem__(self, item):
+        del self.deadlines[item]
+
+
+    def get(self, item, default=None):
+        return self.deadlines.get(item, default)
+
+
+    def discard(self, item):
+        """Clear a deadline, returning whether there was one"""
+        return self.deadlines.pop(item, None) is not None
+
+
+    def discard_db(self, db):
+        """Clear all deadlines for a database"""
+        for item in [i for i in self.deadlines if i[0] == db]:
+            del self.deadlines[item]
+
+
+    def clear(self):
+        self.deadlines.clear()
+        self.heap = []
+
+
+    def _rebuild(self):
+        self.heap = [(when, item) for item, when in self.deadlines.iteritems()]
+        heapify(self.heap)
+
+
+    def pop_expired(self, now, limit):
+        """Remove and return up to `limit` items whose deadline is due"""
+        result = []
+        heap, deadlines = self.heap, self.deadlines
+        while heap and len(result) < limit:
+            when, item = heap[0]
+            if when > now:
+                break
+            heappop(heap)
+            # skip entries that were cleared or rescheduled since being pushed
+            if deadlines.get(item) == when:
+                del deadlines[item]
+                result.append(item)
+        return result
+
+
+    def next_deadline(self):
+        """Earliest pending deadline, or None"""
+        heap, deadlines = self.heap, self.deadlines
+        while heap and deadlines.get(heap[0][1]) != heap[0][0]:
+            heappop(heap)
+        return heap[0][0] if heap else None
@@ -13,7 +13,8 @@ __author__ = ('Rui Carmo http://the.taoofmac.com')
 __revision__ = "$Id$"
 __version__ = "1.0"
 
-import os, sys, stat, mmap, thread, time, logging
+import os, sys, stat, mmap, thread, time, struct, marshal, logging
+from zlib import crc32
 
 log = logging.getLogger()
 
@@ -22,19 +23,77 @@ try:
 except ImportError:
     import marshal as pickle
 
+# The data file starts with a header carrying a generation number (renewed on
+# compaction) and doubles as the index journal: each record has a header with
+# a checksum, its kind, mtime and the sizes of the marshalled key and value
+# that follow it. The index is checkpointed now and then, and recovered by
+# replaying the records written after the last checkpoint.
+FILE_MAGIC = 'HAYSTACK'
+FILE_HEADER = struct.Struct('>8sQ')
+RECORD_HEADER = struct.Struct('>IBdII')
+PUT, DELETE = 1, 2
+CHECKPOINT_VERSION = 1
+CHECKPOINT_MIN = 1024 # records since the last checkpoint that are always worth replaying
+
+
+def _checksum(fields,key,value):
+    return crc32(value,crc32(key,crc32(fields))) & 0xffffffff
+
+
+def _write_record(f,kind,key,mtime,value=''):
+    """Append a record to a file, returning the offset of its value"""
+    key = marshal.dumps(key)
+    fields = RECORD_HEADER.pack(0,kind,mtime,len(key),len(value))[4:]
+    f.write(struct.pack('>I',_checksum(fields,key,value)) + fields + key)
+    f.write(value)
+    return f.tell() - len(value)
+
+
+def _write_file_header(f):
+    """Start a new data file, returning its generation"""
+    generation = int(time.time() * 1000000)
+    f.write(FILE_HEADER.pack(FILE_MAGIC,generation))
+    return generation
+
+
+def read_items(cache,entries,loads):
+    """Stream the items at the (offset, length, key) entries returned by
+    Haystack.locate out of a cache file. Only the file itself is needed,
+    so this can be run in another process"""
+    f = open(cache,"rb")
+    try:
+        size = os.fstat(f.fileno()).st_size
+        if not size:
+            return
+        data = mmap.mmap(f.fileno(),size,access=mmap.ACCESS_READ)
+    finally:
+        f.close()
+    for offset, length, key in entries:
+        yield key, loads(buffer(data,offset,length))
+
+
 class Haystack(dict):
 
-    def __init__(self,path,basename = "haystack", commit = 300, compact = 3600):
+    def __init__(self,path,basename = "haystack", commit = 300, compact = 0.5, dumps = None, loads = None):
         super(Haystack,self).__init__()
         self.enabled = True
+        # serializers for items - pickle unless told otherwise. loads() is
+        # handed a zero-copy buffer, which pickle needs turned into a string
+        self.dumps = dumps or (lambda val: pickle.dumps(val,2))
+        self.loads = loads or (lambda data: pickle.loads(str(data)))
         self.mutex = thread.allocate_lock()
         self.commitinterval = commit
-        self.compactinterval = compact
+        self.compactratio = compact      # share of the cache that may be garbage
+        self.compactmin = 1024 * 1024    # garbage bytes that are never worth compacting
+        self.compacting = None           # keys changed while a compaction runs
         self.path = path
         self.basename = basename
         self.cache = os.path.join(self.path,self.basename + '.bin')
         self.index = os.path.join(self.path,self.basename + '.idx')
         self.temp = os.path.join(self.path,self.basename + '.tmp')   
+        self.writer = self.reader = self.map = None
+        self.generation = None
+        self.records = 0                 # records written since the last checkpoint
         self._rebuild()
         self.created = self.modified = self.compacted = self.committed = time.time()
   
@@ -46,34 +105,216 @@ class Haystack(dict):
         except Exception, e:
             log.error("Error on makedirs(%s): %s" % (self.path, e))
             pass
-        try:
-            cache = open(self.cache,"rb")
-        except Exception, e:
-            log.error("Error while opening %s for reading: %s" % (self.cache, e))
-            cache = open(self.cache,"ab")
-        cache.close()
-        try:
-            self._index = pickle.loads(open(self.index,"rb").read())
-        except Exception, e:
-            log.error("index retrieval from disk failed: %s" % e)
-            self._index = {} # "key": [mtime,length,offset]
+        self._recover()
+        self._open()
+        live = sum(self._footprint(key,entry[1]) for key, entry in self._index.iteritems())
+        self.garbage = max(0,self.writer.tell() - FILE_HEADER.size - live)
         self.created = self.modified = self.compacted = self.committed = time.time()
         log.debug("Rebuild complete, %d items." % len(self._index.keys()))
         self.mutex.release()
   
 
+    def _recover(self):
+        """Load the last index checkpoint and replay the records appended to
+        the data file after it, dropping a torn write at the end"""
+        self._index = {} # "key": [mtime,length,offset]
+        self.records = 0
+        try:
+            f = open(self.cache,"r+b")
+        except IOError:
+            f = open(self.cache,"w+b")
+        try:
+            header = f.read(FILE_HEADER.size)
+            if not header:
+                self.generation = _write_file_header(f)
+                f.flush()
+                os.fsync(f.fileno())
+                return
+            magic, generation = FILE_HEADER.unpack(header) if len(header) == FILE_HEADER.size else (None,None)
+            # data files written by older versions have no header, nor record headers
+            self.generation = generation if magic == FILE_MAGIC else None
+            start = FILE_HEADER.size if self.generation is not None else None
+            checkpoint = self._load_checkpoint()
+            if checkpoint is not None and checkpoint[0] == self.generation:
+                generation, start, self._index = checkpoint
+            if start is None:
+                if not self._index:
+                    log.error("Index for %s lost, and it can't be recovered" % self.cache)
+                return
+            end = self._replay(f,start)
+            size = os.fstat(f.fileno()).st_size
+            if end < size:
+                log.warning("Truncating %s: %d bytes of incomplete records at the end" % (self.cache, size - end))
+                f.truncate(end)
+        finally:
+            f.close()
+
+
+    def _load_checkpoint(self):
+        """Return the checkpointed (generation, offset, index), or None"""
+        try:
+            data = open(self.index,"rb").read()
+        except IOError:
+            return None
+        try:
+            version, generation, offset, index = marshal.loads(data)
+            if version == CHECKPOINT_VERSION:
+                return generation, offset, index
+        except Exception:
+            pass
+        try:
+            # written by older versions, as a pickle
+            return None, None, pickle.loads(data)
+        except Exception, e:
+            log.error("index retrieval from disk failed: %s" % e)
+        return None
+
+
+    def _replay(self,f,offset):
+        """Apply the records from `offset` onwards to the index, returning
+        where the last intact one ends"""
+        f.seek(offset)
+        while True:
+            header = f.read(RECORD_HEADER.size)
+            if len(header) < RECORD_HEADER.size:
+                break
+            crc, kind, mtime, keylen, length = RECORD_HEADER.unpack(header)
+            key = f.read(keylen)
+            value = f.read(length)
+            if len(key) < keylen or len(value) < length or _checksum(header[4:],key,value) != crc:
+                break
+            start = offset + RECORD_HEADER.size + keylen
+            key = marshal.loads(key)
+            if kind == PUT:
+                self._index[key] = [mtime,length,start]
+            else:
+                self._index.pop(key,None)
+            offset = start + length
+            self.records += 1
+        log.debug("Replayed %d records from %s" % (self.records, self.cache))
+        return offset
+
+
+    def _checkpoint(self):
+        """Atomically write out the whole index - called with the lock held,
+        and once the data it points to has been synced"""
+        self._write_checkpoint(self.generation,self.writer.tell(),self._index)
+        self.records = 0
+
+
+    def _write_checkpoint(self,generation,offset,index):
+        temp = '%s.tmp-%d' % (self.index, os.getpid())
+        f = open(temp,"wb")
+        try:
+            f.write(marshal.dumps((CHECKPOINT_VERSION,generation,offset,index)))
+            f.flush()
+            os.fsync(f.fileno())
+        finally:
+            f.close()
+        os.rename(temp,self.index)
+
+
+    def replace(self,items):
+        """Write a new cache holding only the given (key, item) pairs and
+        atomically swap it in. Meant for a forked child, so this object is
+        left alone: the parent then picks up the new cache with reopen()"""
+        temp = '%s-%d' % (self.temp, os.getpid())
+        index = {}
+        f = open(temp,"wb",1024*1024)
+        try:
+            generation = _write_file_header(f)
+            mtime = time.time()
+            for key, val in items:
+                data = self.dumps(val)
+                index[key] = [mtime,len(data),_write_record(f,PUT,key,mtime,data)]
+            size = f.tell()
+            f.flush()
+            os.fsync(f.fileno())
+        finally:
+            f.close()
+        # as with compaction, a crash before the checkpoint is written is
+        # caught by the generation check, and the new file replayed in full
+        os.rename(temp,self.cache)
+        self._write_checkpoint(generation,size,index)
+        log.debug("Replaced %s: %d items in %d bytes" % (self.cache, len(index), size))
+
+
+    def reopen(self):
+        """Pick up a cache replaced by another process"""
+        self.close()
+        self._rebuild()
+
+
+    def _open(self):
+        """Open the long-lived handles on the data file: a buffered writer
+        that all appends go through, and a reader that gets mapped in"""
+        self._close()
+        self.writer = open(self.cache,"ab",1024*1024)
+        self.writer.seek(0,os.SEEK_END)
+        self.reader = open(self.cache,"rb")
+        self.map = None
+        self._remap()
+
+
+    def _close(self):
+        # maps are never closed explicitly: views handed out keep them alive,
+        # and they are unmapped once the last of them is gone
+        for f in (self.writer, self.reader):
+            if f is not None:
+                f.close()
+        self.writer = self.reader = self.map = None
+
+
+    def _remap(self):
+        """Map the data file again to cover everything written to it"""
+        self.writer.flush()
+        size = self.writer.tell()
+        if self.map is not None and len(self.map) == size:
+            return
+        self.map = None
+        # empty files can't be mapped
+        if size:
+            self.map = mmap.mmap(self.reader.fileno(),size,access=mmap.ACCESS_READ)
+
+
+    def view(self,key):
+        """Return a zero-copy view of an item's serialized form (a buffer,
+        since Python 2 mmaps don't support memoryviews)"""
+        mtime, length, offset = self._index[key]
+        if self.map is None or offset + length > len(self.map):
+            self._remap()
+        return buffer(self.map,offset,length)
+
+
+    def close(self):
+        self.mutex.acquire()
+        try:
+            self._close()
+        finally:
+            self.mutex.release()
+
+
     def commit(self):
+        """Make the items written so far durable. The records themselves are
+        the journal, so the index is only checkpointed once replaying them
+        would take longer than writing it out"""
         if not self.enabled:
             return
         self.mutex.acquire()
-        open(self.index,"wb").write(pickle.dumps(self._index))
+        self.writer.flush()
+        os.fsync(self.writer.fileno())
+        if self.records >= max(CHECKPOINT_MIN,len(self._index)):
+            self._checkpoint()
         self.committed = time.time()
         log.debug("Index %s commited, %d items." % (self.index, len(self._index.keys())))
         self.mutex.release()
+        if self._wasteful():
+            self.compact()
 
 
     def purge(self):
         self.mutex.acquire()
+        self._close()
         try:
             os.unlink(self.index)
         except OSError, e:
@@ -92,8 +333,36 @@ class Haystack(dict):
         now = time.time()
         if now > (self.committed + self.commitinterval):
             self.commit()
-        if now > (self.compacted + self.compactinterval):
-            self._compact()
+        elif self._wasteful():
+            self.compact()
+
+
+    def _wasteful(self):
+        """Whether enough of the cache is taken by dead items to compact it"""
+        return self.garbage > max(self.compactmin, self.writer.tell() * self.compactratio)
+
+
+    def _footprint(self,key,length):
+        """Size taken on disk by a record"""
+        return RECORD_HEADER.size + len(marshal.dumps(key)) + length
+
+
+    def _replaced(self,key):
+        """Account for an item about to be overwritten or removed"""
+        entry = self._index.get(key)
+        if entry is not None:
+            self.garbage += self._footprint(key,entry[1])
+        if self.compacting is not None:
+            self.compacting.add(key)
+
+
+    def _remove(self,key):
+        """Drop an item from the index, leaving a tombstone in the journal"""
+        self._replaced(key)
+        del self._index[key]
+        _write_record(self.writer,DELETE,key,time.time())
+        self.garbage += self._footprint(key,0)
+        self.records += 1
     
 
     def __eq__(self,other):
@@ -130,13 +399,21 @@ class Haystack(dict):
         self.mutex.acquire()
         for k in self._index.keys():
             if self._index[k][0] < when:
-                del self._index[k]
+                self._remove(k)
         self.mutex.release()
         self._cleanup()
   
 
     def keys(self):
         return self._index.keys()
+
+
+    def __contains__(self,key):
+        return key in self._index
+
+
+    def __len__(self):
+        return len(self._index)
       
 
     def stats(self,key):
@@ -158,14 +435,12 @@ class Haystack(dict):
             return
         self.mutex.acquire()
         try:
-            cache = open(self.cache,"ab")
-            buffer = pickle.dumps(val,2)
-            offset = cache.tell()
-            cache.write(buffer)
+            data = self.dumps(val)
             self.modified = mtime = time.time()
-            self._index[key] = [mtime,len(buffer),offset]
-            cache.flush()
-            cache.close()
+            offset = _write_record(self.writer,PUT,key,mtime,data)
+            self._replaced(key)
+            self._index[key] = [mtime,len(data),offset]
+            self.records += 1
             self.mutex.release()
         except Exception, e:
             log.error("Error while storing %s: %s" % (key, e))
@@ -173,13 +448,63 @@ class Haystack(dict):
             raise IOError
     
 
+    def update(self,items):
+        """Store several items with a single append to the cache"""
+        if not self.enabled:
+            return
+        self.mutex.acquire()
+        try:
+            self.modified = mtime = time.time()
+            for key, val in items:
+                data = self.dumps(val)
+                offset = _write_record(self.writer,PUT,key,mtime,data)
+                self._replaced(key)
+                self._index[key] = [mtime,len(data),offset]
+                self.records += 1
+            self.mutex.release()
+        except Exception, e:
+            log.error("Error while storing a batch: %s" % e)
+            self.mutex.release()
+            raise IOError
+
+
+    def iteritems(self,keys=None):
+        """Stream (key, item) pairs in file order, reading the cache sequentially
+        rather than seeking back and forth for every item"""
+        if not self.enabled:
+            return
+        self.mutex.acquire()
+        try:
+            if keys is None:
+                keys = self._index.keys()
+            entries = sorted((self._index[k][2],k) for k in keys if k in self._index)
+            self._remap()
+        finally:
+            self.mutex.release()
+        for offset, key in entries:
+            yield key, self[key]
+
+
+    def locate(self,keys=None):
+        """Return (offset, length, key) entries for the given items (or all
+        of them) in file order, for read_items"""
+        self.mutex.acquire()
+        try:
+            self.writer.flush()
+            if keys is None:
+                keys = self._index.keys()
+            return sorted((self._index[k][2],self._index[k][1],k) for k in keys if k in self._index)
+        finally:
+            self.mutex.release()
+
+
     def __delitem__(self,key):
         """Remove item from cache - in practice, we only remove it from the index"""
         if not self.enabled:
             return
         self.mutex.acquire()
         try:
-            del self._index[key]
+            self._remove(key)
             self.mutex.release()    
         except Exception, e:
             log.error("Error while deleting %s: %s" % (key, e))
@@ -200,17 +525,12 @@ class Haystack(dict):
             raise KeyError
         self.mutex.acquire()
         try:
-            cache = open(self.cache,"rb")
-            cache.seek(self._index[key][2])
-            buffer = cache.read(self._index[key][1])
-            item = pickle.loads(buffer)
+            item = self.loads(self.view(key))
             self.mutex.release()
         except Exception, e:
             log.error("Error while retrieving %s: %s" % (key, e))
             self.mutex.release()
             raise KeyError  
-        finally:
-            cache.close()
         return item
   
 
@@ -229,34 +549,80 @@ class Haystack(dict):
             raise KeyError
         
 
-    def _compact(self):
-        """Compact the cache"""
+    def compact(self,background=True):
+        """Rewrite the cache with only the live items. The bulk of the copy
+        is made without holding the lock, from a snapshot of the index, so
+        reads and writes carry on in the meantime"""
         self.mutex.acquire()
-        cache = open(self.cache,"rb")
-        compacted = open(self.temp,"ab")
-        newindex = {}
-        i = 0
-        for key in self._index.keys():
-            cache.seek(self._index[key][2])
-            offset = compacted.tell()
-            compacted.write(cache.read(self._index[key][1]))
-            newindex[key] = [time.time(),self._index[key][1],offset]
-            i = i + 1
-        cache.close()
-        size = compacted.tell()
-        compacted.flush()
-        os.fsync(compacted.fileno())
-        compacted.close()
-        os.rename(self.temp,self.cache)
-        self.compacted = time.time()
-        self._index = newindex
-        self.mutex.release()
-        self.commit()
-        log.debug("Compacted %s: %d items into %d bytes" % (self.cache, i, size))
+        try:
+            if self.compacting is not None:
+                return False
+            self._remap()
+            self.compacting = set()
+            snapshot = self._index.copy()
+            source = self.map
+        finally:
+            self.mutex.release()
+        if background:
+            thread.start_new_thread(self._compact,(snapshot,source))
+        else:
+            self._compact(snapshot,source)
+        return True
+
+
+    def _compact(self,snapshot,source):
+        compacted = None
+        try:
+            compacted = open(self.temp,"wb",1024*1024)
+            generation = _write_file_header(compacted)
+            newindex = {}
+            # copy items in file order, so they can still be streamed in sequentially
+            for key, (mtime, length, start) in sorted(snapshot.iteritems(), key=lambda item: item[1][2]):
+                offset = _write_record(compacted,PUT,key,mtime,buffer(source,start,length))
+                newindex[key] = [mtime,length,offset]
+            self.mutex.acquire()
+            try:
+                # catch up on the items written or removed during the copy
+                for key in self.compacting:
+                    if key in self._index:
+                        mtime, length, start = self._index[key]
+                        offset = _write_record(compacted,PUT,key,mtime,self.view(key))
+                        newindex[key] = [mtime,length,offset]
+                    else:
+                        newindex.pop(key,None)
+                size = compacted.tell()
+                compacted.flush()
+                os.fsync(compacted.fileno())
+                compacted.close()
+                # a crash before the checkpoint below is caught by the
+                # generation check, and the new file replayed in full
+                os.rename(self.temp,self.cache)
+                self.generation = generation
+                self._open()
+                self._index = newindex
+                self._checkpoint()
+                self.garbage = 0
+                self.compacted = time.time()
+            finally:
+                self.mutex.release()
+        except Exception, e:
+            log.error("Error while compacting %s: %s" % (self.cache, e))
+            return
+        finally:
+            # whatever happened, leave nothing behind that would keep the
+            # next compaction from running
+            if compacted is not None and not compacted.closed:
+                compacted.close()
+            if os.path.exists(self.temp):
+                os.unlink(self.temp)
+            self.mutex.acquire()
+            self.compacting = None
+            self.mutex.release()
+        log.debug("Compacted %s: %d items into %d bytes" % (self.cache, len(newindex), size))
 
 
 if __name__=="__main__":
-    c = Haystack('.', commit = 3, compact = 4)
+    c = Haystack('.', commit = 3)
     c['tired'] = "to expire in 2 seconds"
     for i in range(1,10):
         time.sleep(1)
@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Compact encoding for sets holding nothing but integers, modelled on the
+Redis intset
+
+Published under the MIT license.
+"""
+
+from array import array
+from bisect import bisect_left
+
+# array types from the narrowest up, with the integers each can hold; as in
+# Redis that is 16, 32 and 64 bits, where the platform has them
+WIDTHS = []
+for _code in 'hil':
+    _limit = 1 << (array(_code).itemsize * 8 - 1)
+    if not WIDTHS or _limit > WIDTHS[-1][1]:
+        WIDTHS.append((_code, _limit))
+LIMITS = dict(WIDTHS)
+LIMIT = WIDTHS[-1][1]
+
+
+def as_integer(member):
+    """The integer a member stands for, if it is written the way Redis would
+    print it and fits the widest encoding, or None"""
+    if not 0 < len(member) <= 20:
+        return None
+    try:
+        n = int(member)
+    except ValueError:
+        return None
+    if not -LIMIT <= n < LIMIT or str(n) != member:
+        return None
+    return n
+
+
+def _width(low, high):
+    """The array type holding integers from low to high"""
+    for code, limit in WIDTHS:
+        if -limit <= low and high < limit:
+            return code
+
+
+def encodable(members):
+    """Whether all the given members could go into an intset"""
+    for member in members:
+        if as_integer(member) is None:
+            return False
+    return True
+
+
+class IntSet(object):
+    """
+    A set of integer members (kept as their decimal strings by the rest of
+    the server) stored as a sorted array of machine integers, of the smallest
+    width that fits all of them, widened as larger ones are added. That takes
+    2 to 8 bytes a member rather than a hash table slot and a string object,
+    at the price of O(log N) lookups and O(N) inserts and removals, which is
+    why the server only keeps small sets this way.
+
+    It offers the parts of the set interface the server uses, taking and
+    giving members as strings.
+    """
+
+    __slots__ = ('values',)
+
+    def __init__(self, members=()):
+        values = sorted(set(as_integer(member) for member in members))
+        code = _width(values[0], values[-1]) if values else WIDTHS[0][0]
+        self.values = array(code, values)
+
+
+    def __len__(self):
+        return len(self.values)
+
+
+    def __iter__(self):
+        for n in self.values:
+            yield str(n)
+
+
+    def __contains__(self, member):
+        n = as_integer(member)
+        if n is None:
+            return False
+        values = self.values
+        i = bisect_left(values, n)
+        return i < len(values) and values[i] == n
+
+
+    def __repr__(self):
+        return 'IntSet(%r)' % list(self)
+
+
+    def __getstate__(self):
+        return self.values
+
+
+    def __setstate__(self, values):
+        self.values = values
+
+
+    def add(self, member):
+        """Add an integer member, returning whether it was new; the caller
+        must have checked that it is `encodable`"""
+        n = as_integer(member)
+        values = self.values
+        i = bisect_left(values, n)
+        if i < len(values) and values[i] == n:
+            return False
+        limit = LIMITS[values.typecode]
+        if not -limit <= n < limit:
+            values = self.values = array(_width(n, n), values)
+        values.insert(i, n)
+        return True
+
+
+    def update(self, members):
+        for member in members:
+            self.add(member)
+
+
+    def discard(self, member):
+        """Remove a member, returning whether it was there"""
+        n = as_integer(member)
+        if n is None:
+            return False
+        values = self.values
+        i = bisect_left(values, n)
+        if i < len(values) and values[i] == n:
+            del values[i]
+            return True
+        return False
+
+
+    def member(self, i):
+        """The member at a position in sorted order"""
+        return str(self.values[i])
+
+
+    def pop(self, i=-1):
+        """Remove and return the member at a position in sorted order"""
+        return str(self.values.pop(i))
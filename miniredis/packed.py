@@ -0,0 +1,197 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Compact encodings for small lists and hashes, in the spirit of the Redis
+ziplist: all the items live in one packed string rather than in a container
+of separate string objects
+
+Published under the MIT license.
+"""
+
+from itertools import izip
+from marshal import dumps, loads
+
+
+class PackedList(object):
+    """
+    A list held as a single marshalled tuple of its items, costing a few
+    bytes an item where a deque of strings would take dozens. Every change
+    unpacks and repacks the whole of it, which is quick enough (and done in
+    C) for the short lists the server keeps this way.
+
+    It offers the parts of the deque interface the server uses.
+    """
+
+    __slots__ = ('data',)
+
+    def __init__(self, items=()):
+        self.data = dumps(tuple(items))
+
+
+    def __len__(self):
+        return len(loads(self.data))
+
+
+    def __iter__(self):
+        return iter(loads(self.data))
+
+
+    def __repr__(self):
+        return 'PackedList(%r)' % (loads(self.data),)
+
+
+    def __getstate__(self):
+        return self.data
+
+
+    def __setstate__(self, data):
+        self.data = data
+
+
+    def items(self):
+        """All the items, as a tuple"""
+        return loads(self.data)
+
+
+    def append(self, item):
+        self.data = dumps(loads(self.data) + (item,))
+
+
+    def appendleft(self, item):
+        self.data = dumps((item,) + loads(self.data))
+
+
+    def extend(self, items):
+        self.data = dumps(loads(self.data) + tuple(items))
+
+
+    def extendleft(self, items):
+        # each item goes in front of the previous one, as with a deque
+        self.data = dumps(tuple(items)[::-1] + loads(self.data))
+
+
+    def pop(self):
+        items = loads(self.data)
+        if not items:
+            raise IndexError('pop from an empty list')
+        self.data = dumps(items[:-1])
+        return items[-1]
+
+
+    def popleft(self):
+        items = loads(self.data)
+        if not items:
+            raise IndexError('pop from an empty list')
+        self.data = dumps(items[1:])
+        return items[0]
+
+
+class PackedHash(object):
+    """
+    A hash held as a single marshalled tuple of its fields and values, one
+    after the other. Fields are looked up by a scan, and changes repack the
+    whole tuple, so the server only keeps small hashes this way.
+
+    It offers the parts of the dict interface the server uses.
+    """
+
+    __slots__ = ('data',)
+
+    def __init__(self, pairs=()):
+        self.data = dumps(())
+        self.update(pairs)
+
+
+    def __len__(self):
+        return len(loads(self.data)) // 2
+
+
+    def __contains__(self, field):
+        return field in loads(self.data)[::2]
+
+
+    def __iter__(self):
+        return iter(loads(self.data)[::2])
+
+
+    def __getitem__(self, field):
+        items = loads(self.data)
+        try:
+            return items[items[::2].index(field) * 2 + 1]
+        except ValueError:
+            raise KeyError(field)
+
+
+    def __setitem__(self, field, value):
+        self.update(((field, value),))
+
+
+    def __repr__(self):
+        return 'PackedHash(%r)' % dict(self.iteritems())
+
+
+    def __getstate__(self):
+        return self.data
+
+
+    def __setstate__(self, data):
+        self.data = data
+
+
+    def get(self, field, default=None):
+        items = loads(self.data)
+        try:
+            return items[items[::2].index(field) * 2 + 1]
+        except ValueError:
+            return default
+
+
+    def update(self, pairs):
+        """Set fields from (field, value) pairs, returning how many of them
+        were new"""
+        items = list(loads(self.data))
+        fields = items[::2]
+        added = 0
+        for field, value in pairs:
+            try:
+                items[fields.index(field) * 2 + 1] = value
+            except ValueError:
+                fields.append(field)
+                items.extend((field, value))
+                added += 1
+        self.data = dumps(tuple(items))
+        return added
+
+
+    def pop(self, field, *default):
+        items = loads(self.data)
+        try:
+            i = items[::2].index(field) * 2
+        except ValueError:
+            if default:
+                return default[0]
+            raise KeyError(field)
+        self.data = dumps(items[:i] + items[i + 2:])
+        return items[i + 1]
+
+
+    def flat(self):
+        """Fields and values one after the other, as HGETALL replies"""
+        return loads(self.data)
+
+
+    def keys(self):
+        return list(loads(self.data)[::2])
+
+
+    def values(self):
+        return list(loads(self.data)[1::2])
+
+
+    def iteritems(self):
+        items = loads(self.data)
+        return izip(items[::2], items[1::2])
+
+
+    def items(self):
+        return list(self.iteritems())
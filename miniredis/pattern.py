@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Redis glob-style patterns, as used by KEYS, SCAN MATCH, CONFIG GET and
+PSUBSCRIBE, and an optional sorted index of a database's keys for patterns
+starting with a literal prefix
+
+Published under the MIT license.
+"""
+
+import re
+from collections import OrderedDict
+
+from .sset import SkipList
+
+# compiled patterns kept around, the least recently used going first
+CACHE_SIZE = 512
+
+_cache = OrderedDict()
+
+
+def _translate(pattern):
+    """Turn a pattern into a regular expression, following the rules of
+    stringmatchlen() in Redis: * and ? match any characters, [...] a class
+    (negated by a leading ^, with a-z ranges in either order), and a
+    backslash escapes the next character, inside classes as well"""
+    parts = []
+    i, n = 0, len(pattern)
+    while i < n:
+        c = pattern[i]
+        i += 1
+        if c == '*':
+            while i < n and pattern[i] == '*':
+                i += 1
+            parts.append('.*')
+        elif c == '?':
+            parts.append('.')
+        elif c == '[':
+            negate = i < n and pattern[i] == '^'
+            if negate:
+                i += 1
+            members = []
+            while i < n and pattern[i] != ']':
+                if pattern[i] == '\\' and i + 1 < n:
+                    members.append(re.escape(pattern[i + 1]))
+                    i += 2
+                elif i + 2 < n and pattern[i + 1] == '-':
+                    low, high = sorted((pattern[i], pattern[i + 2]))
+                    members.append(re.escape(low) + '-' + re.escape(high))
+                    i += 3
+                else:
+                    members.append(re.escape(pattern[i]))
+                    i += 1
+            # an unterminated class runs to the end of the pattern
+            i += 1
+            if members:
+                parts.append('[%s%s]' % ('^' if negate else '', ''.join(members)))
+            else:
+                parts.append('.' if negate else '(?!)')
+        elif c == '\\' and i < n:
+            parts.append(re.escape(pattern[i]))
+            i += 1
+        else:
+            parts.append(re.escape(c))
+    return ''.join(parts) + r'\Z'
+
+
+def literal_prefix(pattern):
+    """Return the literal text a pattern starts with, and whether that is
+    the whole pattern"""
+    prefix = []
+    i, n = 0, len(pattern)
+    while i < n:
+        c = pattern[i]
+        if c in '*?[':
+            return ''.join(prefix), False
+        if c == '\\' and i + 1 < n:
+            i += 1
+            c = pattern[i]
+        prefix.append(c)
+        i += 1
+    return ''.join(prefix), True
+
+
+def matcher(pattern):
+    """Return a function telling whether a name matches a pattern"""
+    match = _cache.pop(pattern, None)
+    if match is None:
+        prefix, exact = literal_prefix(pattern)
+        if exact:
+            match = prefix.__eq__
+        elif pattern.strip('*') == '':
+            match = lambda name: True
+        else:
+            match = re.compile(_translate(pattern), re.DOTALL).match
+        if len(_cache) >= CACHE_SIZE:
+            _cache.popitem(last=False)
+    _cache[pattern] = match
+    return match
+
+
+def match(pattern, name):
+    """Whether a name matches a pattern"""
+    return bool(matcher(pattern)(name))
+
+
+class Table(dict):
+    """
+    A database's keyspace. When asked to, it also keeps its keys in a sorted
+    index (costing a skip list node per key, and an O(log N) step when keys
+    are added or removed), so that patterns starting with a literal prefix
+    such as `session:*` only look at the keys sharing it.
+    """
+
+    __slots__ = ('index',)
+
+    def __init__(self, *args, **kwargs):
+        dict.__init__(self, *args, **kwargs)
+        self.index = None
+
+
+    def set_index(self, enabled):
+        """Build or drop the key index"""
+        if not enabled:
+            self.index = None
+        elif self.index is None:
+            self.index = SkipList()
+            for key in sorted(self):
+                self.index.insert(key)
+
+
+    def __setitem__(self, key, value):
+        if self.index is not None and key not in self:
+            self.index.insert(key)
+        dict.__setitem__(self, key, value)
+
+
+    def __delitem__(self, key):
+        dict.__delitem__(self, key)
+        if self.index is not None:
+            self.index.remove(key)
+
+
+    def pop(self, key, *default):
+        if self.index is not None and key in self:
+            self.index.remove(key)
+        return dict.pop(self, key, *default)
+
+
+    def popitem(self):
+        key, value = dict.popitem(self)
+        if self.index is not None:
+            self.index.remove(key)
+        return key, value
+
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return dict.__getitem__(self, key)
+
+
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).iteritems():
+            self[key] = value
+
+
+    def clear(self):
+        dict.clear(self)
+        if self.index is not None:
+            self.index = SkipList()
+
+
+    def matching(self, pattern):
+        """Return the keys matching a pattern"""
+        prefix, exact = literal_prefix(pattern)
+        if exact:
+            return [prefix] if prefix in self else []
+        match = matcher(pattern)
+        if self.index is None or not prefix:
+            return [key for key in self if match(key)]
+        result = []
+        node = self.index.seek(prefix)
+        while node is not None and node.key.startswith(prefix):
+            if match(node.key):
+                result.append(node.key)
+            node = node.next[0]
+        return result
@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Minimal readiness notification wrapper over epoll, kqueue, poll or select,
+picking the best one the platform provides.
+
+Published under the MIT license.
+"""
+
+import select, errno
+
+READ = 1
+WRITE = 2
+
+
+class EpollPoller(object):
+    def __init__(self):
+        self.epoll = select.epoll()
+
+    def _mask(self, events):
+        mask = 0
+        if events & READ:
+            mask |= select.EPOLLIN
+        if events & WRITE:
+            mask |= select.EPOLLOUT
+        return mask
+
+    def register(self, fd, events):
+        self.epoll.register(fd, self._mask(events))
+
+    def modify(self, fd, events):
+        self.epoll.modify(fd, self._mask(events))
+
+    def unregister(self, fd):
+        self.epoll.unregister(fd)
+
+    def poll(self, timeout):
+        result = []
+        for fd, mask in self.epoll.poll(timeout):
+            events = 0
+            if mask & (select.EPOLLIN | select.EPOLLHUP | select.EPOLLERR):
+                events |= READ
+            if mask & select.EPOLLOUT:
+                events |= WRITE
+            result.append((fd, events))
+        return result
+
+    def close(self):
+        self.epoll.close()
+
+
+class KqueuePoller(object):
+    def __init__(self):
+        self.kqueue = select.kqueue()
+        self.fds = {}
+
+    def _control(self, fd, events, flags):
+        changes = []
+        if events & READ:
+            changes.append(select.kevent(fd, select.KQ_FILTER_READ, flags))
+        if events & WRITE:
+            changes.append(select.kevent(fd, select.KQ_FILTER_WRITE, flags))
+        if changes:
+            self.kqueue.control(changes, 0)
+
+    def register(self, fd, events):
+        self.fds[fd] = events
+        self._control(fd, events, select.KQ_EV_ADD)
+
+    def modify(self, fd, events):
+        old = self.fds[fd]
+        self._control(fd, old & ~events, select.KQ_EV_DELETE)
+        self._control(fd, events & ~old, select.KQ_EV_ADD)
+        self.fds[fd] = events
+
+    def unregister(self, fd):
+        events = self.fds.pop(fd)
+        try:
+            self._control(fd, events, select.KQ_EV_DELETE)
+        except OSError:
+            pass # already gone if the socket was closed
+
+    def poll(self, timeout):
+        ready = {}
+        for kev in self.kqueue.control(None, max(len(self.fds), 1), timeout):
+            if kev.filter == select.KQ_FILTER_READ:
+                ready[kev.ident] = ready.get(kev.ident, 0) | READ
+            elif kev.filter == select.KQ_FILTER_WRITE:
+                ready[kev.ident] = ready.get(kev.ident, 0) | WRITE
+        return ready.items()
+
+    def close(self):
+        self.kqueue.close()
+
+
+class PollPoller(object):
+    def __init__(self):
+        self.poller = select.poll()
+
+    def _mask(self, events):
+        mask = 0
+        if events & READ:
+            mask |= select.POLLIN
+        if events & WRITE:
+            mask |= select.POLLOUT
+        return mask
+
+    def register(self, fd, events):
+        self.poller.register(fd, self._mask(events))
+
+    def modify(self, fd, events):
+        self.poller.modify(fd, self._mask(events))
+
+    def unregister(self, fd):
+        self.poller.unregister(fd)
+
+    def poll(self, timeout):
+        result = []
+        for fd, mask in self.poller.poll(timeout * 1000):
+            events = 0
+            if mask & (select.POLLIN | select.POLLHUP | select.POLLERR):
+                events |= READ
+            if mask & select.POLLOUT:
+                events |= WRITE
+            result.append((fd, events))
+        return result
+
+    def close(self):
+        pass
+
+
+class SelectPoller(object):
+    def __init__(self):
+        self.readers = set()
+        self.writers = set()
+
+    def register(self, fd, events):
+        self.modify(fd, events)
+
+    def modify(self, fd, events):
+        self.unregister(fd)
+        if events & READ:
+            self.readers.add(fd)
+        if events & WRITE:
+            self.writers.add(fd)
+
+    def unregister(self, fd):
+        self.readers.discard(fd)
+        self.writers.discard(fd)
+
+    def poll(self, timeout):
+        readable, writable, _ = select.select(self.readers, self.writers, [], timeout)
+        ready = {}
+        for fd in readable:
+            ready[fd] = READ
+        for fd in writable:
+            ready[fd] = ready.get(fd, 0) | WRITE
+        return ready.items()
+
+    def close(self):
+        pass
+
+
+def Poller():
+    """Return the most scalable poller available on this platform"""
+    if hasattr(select, 'epoll'):
+        return EpollPoller()
+    if hasattr(select, 'kqueue'):
+        return KqueuePoller()
+    if hasattr(select, 'poll'):
+        return PollPoller()
+    return SelectPoller()
+
+
+def interrupted(e):
+    """Whether an exception raised by poll() is just a signal interruption"""
+    return getattr(e, 'errno', None) == errno.EINTR or \
+        (e.args and e.args[0] == errno.EINTR)
@@ -0,0 +1,333 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Incremental request parser and reply encoder for the Redis protocol
+
+Published under the MIT license.
+"""
+
+MAX_INLINE = 64 * 1024
+MAX_BULK = 512 * 1024 * 1024
+MAX_ITEMS = 1024 * 1024
+
+# bulk values at least this big are queued as-is rather than copied into
+# the surrounding reply
+BIG_BULK = 16 * 1024
+
+
+class ProtocolError(Exception):
+    pass
+
+
+class RedisConstant(object):
+    def __init__(self, type):
+        self.type = type
+
+    def __len__(self):
+        return 0
+
+    def __repr__(self):
+        return '<RedisConstant(%s)>' % self.type
+
+
+class RedisMessage(object):
+    def __init__(self, message):
+        self.message = message
+
+    def __str__(self):
+        return '+%s' % self.message
+
+    def __repr__(self):
+        return '<RedisMessage(%s)>' % self.message
+
+
+class RedisError(RedisMessage):
+    def __init__(self, message, prefix='ERR'):
+        self.message = message
+        self.prefix = prefix
+
+    def __str__(self):
+        return '-%s %s' % (self.prefix, self.message)
+
+    def __repr__(self):
+        return '<RedisError(%s)>' % self.message
+
+
+EMPTY_SCALAR = RedisConstant('EmptyScalar')
+EMPTY_LIST = RedisConstant('EmptyList')
+
+# precomputed replies and headers
+OK = '+OK\r\n'
+NIL = '$-1\r\n'
+NIL_MULTIBULK = '*-1\r\n'
+SHARED_INTEGERS = [':%d\r\n' % i for i in xrange(10000)]
+MULTIBULK_HEADERS = ['*%d\r\n' % i for i in xrange(1024)]
+
+
+def encode(write, o):
+    """Serialize a reply, passing the resulting chunks to `write`"""
+    if o is True:
+        write(OK)
+    elif o is False:
+        pass # show nothing for a false return; that means be quiet
+    elif isinstance(o, str):
+        _bulk(write, o)
+    elif isinstance(o, (int, long)):
+        write(SHARED_INTEGERS[o] if 0 <= o < 10000 else ':%d\r\n' % o)
+    elif isinstance(o, float):
+        _bulk(write, repr(o))
+    elif o is EMPTY_SCALAR or o is None:
+        write(NIL)
+    elif o is EMPTY_LIST:
+        write(NIL_MULTIBULK)
+    elif isinstance(o, (list, tuple)):
+        write(MULTIBULK_HEADERS[len(o)] if len(o) < 1024 else '*%d\r\n' % len(o))
+        for val in o:
+            if isinstance(val, str):
+                _bulk(write, val)
+            else:
+                encode(write, val)
+    elif isinstance(o, RedisMessage):
+        write('%s\r\n' % o)
+    elif isinstance(o, dict):
+        write('*%d\r\n' % (len(o)*2))
+        for k, v in o.iteritems():
+            _bulk(write, str(k))
+            _bulk(write, str(v))
+    else:
+        write('-ERR return type not yet implemented\r\n')
+
+
+def encode_request(args):
+    """Serialize a command as a multibulk request"""
+    return '*%d\r\n%s' % (len(args), ''.join(['$%d\r\n%s\r\n' % (len(a), a) for a in args]))
+
+
+def _bulk(write, s):
+    size = len(s)
+    if size < BIG_BULK:
+        write('$%d\r\n%s\r\n' % (size, s))
+    else:
+        # big values are passed on by themselves, so they are never copied
+        write('$%d\r\n' % size)
+        write(s)
+        write('\r\n')
+
+
+class RequestParser(object):
+    """
+    Parses client requests out of a growing `bytearray`.
+
+    Data read from a socket is appended to `buf` (or passed to `feed`), and
+    `get` returns the next complete request as a list of arguments, or None
+    when the buffer holds no more complete requests. Both multibulk requests
+    and inline (telnet-style) commands are understood.
+
+    Parsing state is kept across calls, so a request that arrives in several
+    pieces is never re-scanned from the start, and consumed data is only
+    trimmed from the front of the buffer once it has been exhausted. Bulk
+    arguments are copied straight out of the buffer through a memoryview,
+    which makes them a single copy each.
+    """
+
+    def __init__(self):
+        self.buf = bytearray()
+        self.pos = 0
+        self.items = 0    # bulk arguments still expected by the current request
+        self.bulk = -1    # length of the bulk argument being waited for
+        self.args = []
+
+
+    def feed(self, data):
+        self.buf.extend(data)
+
+
+    def __iter__(self):
+        while True:
+            args = self.get()
+            if args is None:
+                return
+            yield args
+
+
+    def _compact(self):
+        if self.pos:
+            del self.buf[:self.pos]
+            self.pos = 0
+
+
+    def get(self):
+        """Return the next complete request, or None if there is none yet"""
+        buf = self.buf
+        while True:
+            if self.pos >= len(buf):
+                self._compact()
+                return None
+            if self.items:
+                args = self._multibulk()
+            elif buf[self.pos] == 42: # '*'
+                args = self._header()
+            else:
+                args = self._inline()
+            if args is None:
+                # keep the unparsed tail small if we are waiting for a big value
+                if self.pos > MAX_INLINE:
+                    self._compact()
+                return None
+            if args:
+                return args
+            # empty requests are skipped, like Redis does
+
+
+    def _line(self):
+        """Return the end of the line starting at pos, or -1"""
+        end = self.buf.find('\r\n', self.pos)
+        if end < 0 and len(self.buf) - self.pos > MAX_INLINE:
+            raise ProtocolError('Protocol error: too big request')
+        return end
+
+
+    def _inline(self):
+        buf = self.buf
+        end = buf.find('\n', self.pos)
+        if end < 0:
+            if len(buf) - self.pos > MAX_INLINE:
+                raise ProtocolError('Protocol error: too big inline request')
+            return None
+        args = str(buf[self.pos:end]).split()
+        self.pos = end + 1
+        return args
+
+
+    def _header(self):
+        end = self._line()
+        if end < 0:
+            return None
+        try:
+            items = int(self.buf[self.pos+1:end])
+        except ValueError:
+            raise ProtocolError('Protocol error: invalid multibulk length')
+        if items > MAX_ITEMS:
+            raise ProtocolError('Protocol error: invalid multibulk length')
+        self.pos = end + 2
+        if items <= 0:
+            return []
+        self.items = items
+        self.args = []
+        return self._multibulk()
+
+
+    def _multibulk(self):
+        buf = self.buf
+        size = len(buf)
+        view = None
+        while self.items:
+            if self.bulk < 0:
+                end = self._line()
+                if end < 0:
+                    return None
+                if buf[self.pos] != 36: # '$'
+                    raise ProtocolError("Protocol error: expected '$', got '%s'" % chr(buf[self.pos]))
+                try:
+                    bulk = int(buf[self.pos+1:end])
+                except ValueError:
+                    raise ProtocolError('Protocol error: invalid bulk length')
+                if not 0 <= bulk <= MAX_BULK:
+                    raise ProtocolError('Protocol error: invalid bulk length')
+                self.bulk = bulk
+                self.pos = end + 2
+            start = self.pos
+            stop = start + self.bulk
+            if stop + 2 > size:
+                return None
+            if view is None:
+                view = memoryview(buf)
+            self.args.append(view[start:stop].tobytes())
+            self.pos = stop + 2
+            self.bulk = -1
+            self.items -= 1
+        args, self.args = self.args, []
+        return args
+
+
+class ReplyParser(object):
+    """
+    Parses replies out of a growing `bytearray`, as sent by a server.
+
+    `replies` returns the replies completed by the data fed so far, in the
+    form handlers return them. Arrays still being filled are kept on a
+    stack, so a big reply arriving in pieces is only parsed once.
+    """
+
+    def __init__(self):
+        self.buf = bytearray()
+        self.pos = 0
+        self.stack = []     # [items still expected, items so far] per open array
+
+
+    def feed(self, data):
+        self.buf.extend(data)
+
+
+    def replies(self):
+        """Return the replies completed since the last call"""
+        result = []
+        while True:
+            value = self._value()
+            if value is _PARTIAL:
+                break
+            if value is _ARRAY:
+                continue
+            while self.stack:
+                array = self.stack[-1]
+                array[1].append(value)
+                array[0] -= 1
+                if array[0]:
+                    break
+                value = self.stack.pop()[1]
+            else:
+                result.append(value)
+        if self.pos:
+            del self.buf[:self.pos]
+            self.pos = 0
+        return result
+
+
+    def _value(self):
+        """Parse the value at pos: a scalar, _ARRAY if an array was opened,
+        or _PARTIAL if it isn't all there yet"""
+        buf = self.buf
+        end = buf.find('\r\n', self.pos)
+        if end < 0:
+            return _PARTIAL
+        kind, body = buf[self.pos], str(buf[self.pos+1:end])
+        if kind == 36: # '$'
+            size = int(body)
+            if size < 0:
+                self.pos = end + 2
+                return None
+            if end + size + 4 > len(buf):
+                return _PARTIAL
+            self.pos = end + size + 4
+            return str(buf[end+2:end+2+size])
+        self.pos = end + 2
+        if kind == 43: # '+'
+            return True if body == 'OK' else RedisMessage(body)
+        if kind == 45: # '-'
+            prefix, _, message = body.partition(' ')
+            return RedisError(message, prefix)
+        if kind == 58: # ':'
+            return int(body)
+        if kind == 42: # '*'
+            size = int(body)
+            if size < 0:
+                return EMPTY_LIST
+            if size == 0:
+                return []
+            self.stack.append([size, []])
+            return _ARRAY
+        raise ProtocolError("Protocol error: unexpected reply type '%s'" % chr(kind))
+
+
+_PARTIAL = RedisConstant('Partial')
+_ARRAY = RedisConstant('Array')
@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Publish/subscribe: channel and pattern subscriptions, and message fan-out
+
+Published under the MIT license.
+"""
+
+from .pattern import matcher
+from .protocol import encode
+
+
+def encoded(reply):
+    """Serialize a reply once, so that it can be queued for many clients"""
+    chunks = []
+    encode(chunks.append, reply)
+    return ''.join(chunks)
+
+
+class PubSub(object):
+    """
+    Subscriptions are kept in both directions: exact channels in a dict
+    mapping them to their subscribers, so that publishing to a channel is a
+    single lookup, and patterns in a separate table along with their compiled
+    matchers, which every published channel is checked against. Clients hold
+    the channels and patterns they are subscribed to, so that they can be
+    dropped when they disconnect.
+
+    A published message is encoded once per channel or pattern it goes out
+    on, and the same string is queued for every subscriber by `deliver`.
+    """
+
+    def __init__(self, deliver):
+        self.deliver = deliver
+        self.channels = {}  # channel -> set of clients
+        self.patterns = {}  # pattern -> (matcher, set of clients)
+
+
+    def subscribe(self, client, channel):
+        """Subscribe a client to a channel, returning whether it was new"""
+        if channel in client.channels:
+            return False
+        client.channels.add(channel)
+        self.channels.setdefault(channel, set()).add(client)
+        return True
+
+
+    def unsubscribe(self, client, channel):
+        if channel not in client.channels:
+            return False
+        client.channels.discard(channel)
+        subscribers = self.channels[channel]
+        subscribers.discard(client)
+        if not subscribers:
+            del self.channels[channel]
+        return True
+
+
+    def psubscribe(self, client, pattern):
+        if pattern in client.patterns:
+            return False
+        client.patterns.add(pattern)
+        if pattern not in self.patterns:
+            self.patterns[pattern] = (matcher(pattern), set())
+        self.patterns[pattern][1].add(client)
+        return True
+
+
+    def punsubscribe(self, client, pattern):
+        if pattern not in client.patterns:
+            return False
+        client.patterns.discard(pattern)
+        subscribers = self.patterns[pattern][1]
+        subscribers.discard(client)
+        if not subscribers:
+            del self.patterns[pattern]
+        return True
+
+
+    def drop(self, client):
+        """Remove every subscription a client holds"""
+        for channel in list(client.channels):
+            self.unsubscribe(client, channel)
+        for pattern in list(client.patterns):
+            self.punsubscribe(client, pattern)
+
+
+    def publish(self, channel, message):
+        """Send a message to a channel, returning how many clients got it"""
+        count = 0
+        subscribers = self.channels.get(channel)
+        if subscribers:
+            data = encoded(['message', channel, message])
+            for client in subscribers:
+                self.deliver(client, data)
+            count += len(subscribers)
+        for pattern, (match, subscribers) in self.patterns.iteritems():
+            if match(channel):
+                data = encoded(['pmessage', pattern, channel, message])
+                for client in subscribers:
+                    self.deliver(client, data)
+                count += len(subscribers)
+        return count
+
+
+    def numsub(self, channel):
+        return len(self.channels.get(channel, ()))
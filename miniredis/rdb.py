@@ -0,0 +1,226 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Compact binary encoding for snapshot records, modelled on the Redis RDB format.
+
+A record is a value and its deadline (or None). The deadline, if any, comes
+first as an EXPIRETIME_MS opcode, followed by the value's type and payload:
+lengths use the RDB variable-size encoding, strings are length-prefixed (and
+stored as integers when they are canonical numbers in the 32-bit range, as
+RDB does), and collections are a member count followed by their members.
+
+Decoding works on any buffer, including views into a memory-mapped file, and
+never reads past the end of the record it was given.
+
+Published under the MIT license.
+"""
+
+import struct
+from collections import deque
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+from .sset import SortedSet
+from .intset import IntSet
+from .packed import PackedList, PackedHash
+
+# value types, numbered as in RDB where there is a match
+STRING, LIST, SET, HASH, ZSET, INTSET, INTEGER = 0, 1, 2, 4, 5, 11, 16
+EXPIRETIME_MS = 0xfc
+
+# length encodings
+LEN_6BIT, LEN_14BIT, LEN_32BIT, LEN_64BIT, ENCVAL = 0, 1, 0x80, 0x81, 3
+ENC_INT8, ENC_INT16, ENC_INT32 = 0, 1, 2
+
+INT8 = struct.Struct('<b')
+INT16 = struct.Struct('<h')
+INT32 = struct.Struct('<i')
+UINT32 = struct.Struct('>I')
+UINT64 = struct.Struct('>Q')
+INT64 = struct.Struct('<q')
+DOUBLE = struct.Struct('<d')
+
+# records written by older versions are pickles, which start with PROTO
+PICKLE_PROTO = '\x80'
+
+
+class DecodeError(Exception):
+    pass
+
+
+def _length(n):
+    if n < 0x40:
+        return chr(n)
+    if n < 0x4000:
+        return chr(0x40 | n >> 8) + chr(n & 0xff)
+    if n <= 0xffffffff:
+        return chr(LEN_32BIT) + UINT32.pack(n)
+    return chr(LEN_64BIT) + UINT64.pack(n)
+
+
+def _string(s):
+    if not isinstance(s, str):
+        s = str(s)
+    if 0 < len(s) <= 11:
+        try:
+            n = int(s)
+        except ValueError:
+            n = None
+        if n is not None and str(n) == s:
+            if -0x80 <= n < 0x80:
+                return chr(0xc0 | ENC_INT8) + INT8.pack(n)
+            if -0x8000 <= n < 0x8000:
+                return chr(0xc0 | ENC_INT16) + INT16.pack(n)
+            if -0x80000000 <= n < 0x80000000:
+                return chr(0xc0 | ENC_INT32) + INT32.pack(n)
+    return _length(len(s)) + s
+
+
+def dump(write, value, deadline=None):
+    """Encode a record, passing the resulting chunks to `write`"""
+    if deadline is not None:
+        write(chr(EXPIRETIME_MS) + INT64.pack(int(deadline * 1000)))
+    if isinstance(value, str):
+        write(chr(STRING))
+        if len(value) < 0x4000:
+            write(_string(value))
+        else:
+            # big values are passed on as they are, rather than copied
+            write(_length(len(value)))
+            write(value)
+    elif isinstance(value, (int, long)):
+        write(chr(INTEGER) + _string(str(value)))
+    elif isinstance(value, (deque, PackedList)):
+        write(chr(LIST) + _length(len(value)))
+        for item in value:
+            write(_string(item))
+    elif isinstance(value, (dict, PackedHash)):
+        # packed values are written out in full, and packed again on loading
+        write(chr(HASH) + _length(len(value)))
+        for field, v in value.iteritems():
+            write(_string(field) + _string(v))
+    elif isinstance(value, SortedSet):
+        write(chr(ZSET) + _length(len(value)))
+        for score, member in value:
+            write(_string(member) + DOUBLE.pack(score))
+    elif isinstance(value, (set, frozenset)):
+        write(chr(SET) + _length(len(value)))
+        for member in value:
+            write(_string(member))
+    elif isinstance(value, IntSet):
+        # same layout as a set, but loaded back in the same encoding
+        write(chr(INTSET) + _length(len(value)))
+        for member in value:
+            write(_string(member))
+    else:
+        raise TypeError("Can't encode %s" % type(value))
+
+
+def dumps(record):
+    """Encode a (value, deadline) record as a string"""
+    chunks = []
+    dump(chunks.append, *record)
+    return ''.join(chunks)
+
+
+class _Reader(object):
+    """Decodes values out of a buffer, from a given offset"""
+
+    def __init__(self, data, pos=0):
+        self.data = data
+        self.pos = pos
+
+    def byte(self):
+        try:
+            b = ord(self.data[self.pos])
+        except IndexError:
+            raise DecodeError('Unexpected end of record')
+        self.pos += 1
+        return b
+
+    def unpack(self, fmt):
+        try:
+            value, = fmt.unpack_from(self.data, self.pos)
+        except struct.error:
+            raise DecodeError('Unexpected end of record')
+        self.pos += fmt.size
+        return value
+
+    def length(self, first=None):
+        b = self.byte() if first is None else first
+        kind = b >> 6
+        if kind == LEN_6BIT:
+            return b & 0x3f
+        if kind == LEN_14BIT:
+            return (b & 0x3f) << 8 | self.byte()
+        if b == LEN_32BIT:
+            return self.unpack(UINT32)
+        if b == LEN_64BIT:
+            return self.unpack(UINT64)
+        raise DecodeError('Bad length encoding %d' % b)
+
+    def string(self):
+        b = self.byte()
+        if b >> 6 == ENCVAL:
+            fmt = {ENC_INT8: INT8, ENC_INT16: INT16, ENC_INT32: INT32}.get(b & 0x3f)
+            if fmt is None:
+                raise DecodeError('Bad string encoding %d' % b)
+            return str(self.unpack(fmt))
+        n = self.length(b)
+        end = self.pos + n
+        if end > len(self.data):
+            raise DecodeError('Unexpected end of record')
+        s = self.data[self.pos:end]
+        self.pos = end
+        return s
+
+    def value(self, kind):
+        if kind == STRING:
+            return self.string()
+        if kind == INTEGER:
+            return int(self.string())
+        if kind == LIST:
+            return deque([self.string() for i in xrange(self.length())])
+        if kind == SET:
+            return set([self.string() for i in xrange(self.length())])
+        if kind == INTSET:
+            return IntSet([self.string() for i in xrange(self.length())])
+        if kind == HASH:
+            value = {}
+            for i in xrange(self.length()):
+                field = self.string()
+                value[field] = self.string()
+            return value
+        if kind == ZSET:
+            value = SortedSet()
+            for i in xrange(self.length()):
+                member = self.string()
+                value.insert(member, self.unpack(DOUBLE))
+            return value
+        raise DecodeError('Unknown value type %d' % kind)
+
+
+def load(data, pos=0):
+    """Decode a record from a buffer, returning (value, deadline, end)"""
+    reader = _Reader(data, pos)
+    deadline = None
+    kind = reader.byte()
+    if kind == EXPIRETIME_MS:
+        deadline = reader.unpack(INT64) / 1000.0
+        kind = reader.byte()
+    value = reader.value(kind)
+    return value, deadline, reader.pos
+
+
+def loads(data):
+    """Decode a (value, deadline) record. Snapshots written by older versions
+    held pickles, which are still read, but never written"""
+    if data[:1] == PICKLE_PROTO:
+        return pickle.loads(str(data))
+    value, deadline, end = load(data)
+    if end != len(data):
+        raise DecodeError('%d trailing bytes in record' % (len(data) - end))
+    return value, deadline
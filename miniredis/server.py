@@ -8,157 +8,659 @@ Published under the MIT license.
 """
 
 from __future__ import with_statement
-from collections import deque
-import os, sys, time, logging, signal, getopt, re
-import socket, select, thread, errno
-from random import sample, choice
+from collections import deque, OrderedDict
+from heapq import heappush, heappop
+from itertools import count
+import os, sys, time, logging, signal, getopt
+import socket, select, thread, errno, multiprocessing
+from random import choice, random, sample, shuffle
 
 log = logging.getLogger()
 
-from .haystack import Haystack
+from .haystack import Haystack, read_items
+from . import rdb
+from .aof import AppendOnlyFile, FSYNC_POLICIES
+from .expiry import ExpiryIndex
+from .sset import SortedSet
+from .intset import IntSet, as_integer, encodable
+from .packed import PackedList, PackedHash
+from .shared import SharedValues
+from .pattern import Table, match
+from .pubsub import PubSub
+from .poller import Poller, READ, WRITE, interrupted
+from .commands import build_command_table
+from .protocol import RequestParser, ProtocolError, RedisConstant, RedisMessage, RedisError, \
+    EMPTY_SCALAR, EMPTY_LIST, BIG_BULK, encode
 
-class RedisConstant(object):
-    def __init__(self, type):
-        self.type = type
+BAD_VALUE = RedisError('Operation against a key holding the wrong kind of value')
+SYNTAX_ERROR = RedisError('syntax error')
+NOT_INTEGER = RedisError('value is not an integer or out of range')
+NOT_FLOAT = RedisError('value is not a valid float')
+INF = float('inf')
+
+# the encodings of strings, lists, hashes and sets
+STRINGS = (str, int, long)
+LISTS = (deque, PackedList)
+HASHES = (dict, PackedHash)
+SETS = (set, IntSet)
+
+LOGLEVELS = {'debug': logging.DEBUG, 'verbose': logging.INFO, 'notice': logging.INFO, 'warning': logging.WARNING}
+
+
+def snapshot_key(db, key):
+    """Name of the snapshot record holding a key"""
+    return '%d %s' % (db, key)
+
+
+# records restored between looks at the network while loading
+LOAD_BATCH = 1024
+
+# commands clients can still send once they have subscriptions
+SUBSCRIBER_COMMANDS = frozenset(['subscribe', 'unsubscribe', 'psubscribe', 'punsubscribe', 'ping', 'quit'])
+
+# elements all open SCAN-family iterations may hold between them, and how
+# long an iteration must have gone unused before it is dropped to make room
+SCAN_MAX_ELEMENTS = 1 << 22
+SCAN_IDLE_TIMEOUT = 60
+# cursor bits identifying an iteration
+SCAN_ID_BITS = 20
+SCAN_ID_MASK = (1 << SCAN_ID_BITS) - 1
+SCAN_COUNT = 10
+
+
+def save_points(value):
+    """Parser for the `save` CONFIG parameter: "<seconds> <changes>" pairs"""
+    numbers = [int(n) for n in value.split()]
+    if len(numbers) % 2 or min(numbers or [0]) < 0:
+        raise ValueError(value)
+    return ' '.join(map(str, numbers))
+
+
+def parse_score(value):
+    """Parse a sorted set score, which may be +inf or -inf but not NaN"""
+    score = float(value)
+    if score != score:
+        raise ValueError(value)
+    return score
+
+
+def parse_score_bound(value):
+    """Parse the end of a score range: returns (score, exclusive)"""
+    if value.startswith('('):
+        return parse_score(value[1:]), True
+    return parse_score(value), False
+
+
+def format_score(score):
+    """Render a score as Redis does: integral values without a fraction"""
+    if score in (INF, -INF):
+        return 'inf' if score > 0 else '-inf'
+    if score == int(score) and abs(score) < 1e17:
+        return '%d' % score
+    return repr(score)
+
+
+def type_name(value):
+    """The name TYPE gives to a value"""
+    if isinstance(value, LISTS):
+        return 'list'
+    elif isinstance(value, SETS):
+        return 'set'
+    elif isinstance(value, HASHES):
+        return 'hash'
+    elif isinstance(value, SortedSet):
+        return 'zset'
+    elif isinstance(value, STRINGS):
+        return 'string'
+    return None
+
+
+def random_members(value, count):
+    """Up to `count` distinct members of a set, picked at random. Plain sets
+    can't be indexed, so they are copied to draw from, in O(N)"""
+    if count >= len(value):
+        return list(value)
+    if isinstance(value, IntSet):
+        return [value.member(i) for i in sample(xrange(len(value)), count)]
+    return sample(value, count)
+
+
+def matches(pattern, name):
+    """Whether a name matches a glob-style pattern (None matching anything)"""
+    return pattern is None or match(pattern, name)
+
+
+def parse_scan_options(options):
+    """Parse the MATCH, COUNT and TYPE options of SCAN-family commands,
+    returning (pattern, count, type) or an error"""
+    pattern, count, kind = None, SCAN_COUNT, None
+    for i in xrange(0, len(options), 2):
+        option = options[i].lower()
+        if i + 1 == len(options):
+            return SYNTAX_ERROR
+        value = options[i + 1]
+        if option == 'match':
+            pattern = None if value == '*' else value
+        elif option == 'count':
+            try:
+                count = int(value)
+            except ValueError:
+                return NOT_INTEGER
+            if count < 1:
+                return SYNTAX_ERROR
+        elif option == 'type':
+            kind = value.lower()
+        else:
+            return SYNTAX_ERROR
+    return pattern, count, kind
 
-    def __len__(self):
-        return 0
 
-    def __repr__(self):
-        return '<RedisConstant(%s)>' % self.type
+def score_ranks(zset, low, high):
+    """The ranks [start, end) of the members of a sorted set whose scores
+    are within the bounds returned by parse_score_bound"""
+    start = zset.scorerank(low[0], right=low[1])
+    end = zset.scorerank(high[0], right=not high[1])
+    return start, max(start, end)
 
 
-class RedisMessage(object):
-    def __init__(self, message):
-        self.message = message
+def zset_reply(pairs, withscores):
+    """Reply listing (score, member) pairs as members, or members and scores"""
+    if withscores:
+        return [x for score, member in pairs for x in (member, format_score(score))]
+    return [member for score, member in pairs]
 
-    def __str__(self):
-        return '+%s' % self.message
 
-    def __repr__(self):
-        return '<RedisMessage(%s)>' % self.message
+def zset_items(value):
+    """(member, score) pairs of a sorted set, or of a set with scores of 1"""
+    if isinstance(value, SortedSet):
+        return value.iteritems()
+    return ((member, 1.0) for member in value)
 
 
-class RedisError(RedisMessage):
-    def __init__(self, message):
-        self.message = message
+def zset_score(value, member):
+    """The score of a member of a sorted set or set, or None"""
+    if isinstance(value, SortedSet):
+        return value.score(member)
+    return 1.0 if member in value else None
 
-    def __str__(self):
-        return '-ERR %s' % self.message
 
-    def __repr__(self):
-        return '<RedisError(%s)>' % self.message
+def weighted(score, weight):
+    # inf * 0 is taken as 0, as Redis does
+    score *= weight
+    return 0.0 if score != score else score
 
 
-EMPTY_SCALAR = RedisConstant('EmptyScalar')
-EMPTY_LIST = RedisConstant('EmptyList')
-BAD_VALUE = RedisError('Operation against a key holding the wrong kind of value')
+def aggregate_sum(a, b):
+    # and so is inf + -inf
+    total = a + b
+    return 0.0 if total != total else total
+
+
+AGGREGATES = {'sum': aggregate_sum, 'min': min, 'max': max}
+
+
+def in_range(kind, low, high):
+    """Parser for a numeric CONFIG parameter with bounds"""
+    def parse(value):
+        value = kind(value)
+        if not low <= value <= high:
+            raise ValueError(value)
+        return value
+    return parse
+
+
+def one_of(*choices):
+    """Parser for a CONFIG parameter taking one of a set of values"""
+    def parse(value):
+        value = value.lower()
+        if value not in choices:
+            raise ValueError(value)
+        return value
+    return parse
 
 
 class RedisConnection(object):
     """Class to represent a client connection"""
     def __init__(self, socket):
         self.socket = socket
-        self.wfile = socket.makefile('wb')
-        self.rfile = socket.makefile('rb')
+        self.fd = socket.fileno() if socket else None
+        try:
+            self.peer = '%s:%s' % socket.getpeername()[:2]
+        except Exception:
+            self.peer = '<unknown>'
+        self.parser = RequestParser()
+        self.wbuf = deque()
+        self.woffset = 0
+        self.pieces = []
+        self.closing = False
         self.db = None
         self.table = None
+        self.channels = set()   # subscriptions, which put it in subscriber mode
+        self.patterns = set()
+        self.blocked = None     # (db, keys, end popped from, destination) while in BLPOP & co
+
+
+    def write(self, data):
+        """Queue output; small pieces are gathered and joined when flushed,
+        big ones are kept as separate chunks so they are never copied"""
+        if len(data) < BIG_BULK:
+            self.pieces.append(data)
+        else:
+            if self.pieces:
+                self.wbuf.append(''.join(self.pieces))
+                self.pieces = []
+            self.wbuf.append(data)
+
+
+    def flush(self):
+        """Send queued output, returning True once it has all been written"""
+        if self.pieces:
+            self.wbuf.append(''.join(self.pieces))
+            self.pieces = []
+        wbuf = self.wbuf
+        while wbuf:
+            chunk = wbuf[0]
+            try:
+                if self.woffset:
+                    sent = self.socket.send(buffer(chunk, self.woffset))
+                else:
+                    sent = self.socket.send(chunk)
+            except socket.error, e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                    return False
+                raise
+            self.woffset += sent
+            if self.woffset < len(chunk):
+                if self.socket.gettimeout() == 0.0:
+                    return False
+            else:
+                wbuf.popleft()
+                self.woffset = 0
+        return True
 
 
 class RedisServer(object):
-    def __init__(self, host='127.0.0.1', port=6379, db_path='.'):
+
+    # CONFIG GET/SET parameters: name -> (attribute, type)
+    config_params = {
+        'appendfsync': ('appendfsync', one_of(*FSYNC_POLICIES)),
+        'appendonly': ('appendonly', one_of('yes', 'no')),
+        'hash-max-ziplist-entries': ('hash_max_ziplist_entries', in_range(int, 0, 8192)),
+        'hash-max-ziplist-value': ('hash_max_ziplist_value', in_range(int, 0, 8192)),
+        'hz': ('hz', in_range(int, 1, 500)),
+        'key-index': ('key_index', one_of('yes', 'no')),
+        'list-max-ziplist-entries': ('list_max_ziplist_entries', in_range(int, 0, 8192)),
+        'list-max-ziplist-value': ('list_max_ziplist_value', in_range(int, 0, 8192)),
+        'loglevel': ('loglevel', one_of(*LOGLEVELS)),
+        'save': ('save_params', save_points),
+        'set-max-intset-entries': ('set_max_intset_entries', in_range(int, 0, 65536)),
+        'shared-integers-max': ('shared_integers_max', in_range(int, -100000, 100000)),
+        'shared-integers-min': ('shared_integers_min', in_range(int, -100000, 100000)),
+        'shared-value-max-length': ('shared_value_max_length', in_range(int, 0, 1024)),
+        'trace-sample-rate': ('trace_rate', in_range(float, 0, 1)),
+    }
+
+    def __init__(self, host='127.0.0.1', port=6379, db_path='.', appendonly=False, load_workers=0):
         super(RedisServer, self).__init__()
         self.host = host
         self.port = port
         self.halt = True
         self.clients = {}
+        self.pending = set()
+        self.poller = None
+        self.watched = {}       # other polled fds -> handler(events)
+        self.backlog = 511
+        self.reuseport = False
         self.tables = {}
-        self.channels = {}
+        self.key_index = 'no'   # whether tables keep their keys sorted, for KEYS
+        # sizes up to which collections keep their compact encodings
+        self.list_max_ziplist_entries = self.hash_max_ziplist_entries = 128
+        self.list_max_ziplist_value = self.hash_max_ziplist_value = 64
+        self.set_max_intset_entries = 512
+        # stored integers in this range, and strings up to this long, are shared
+        self.shared_integers_min, self.shared_integers_max = 0, 9999
+        self.shared_value_max_length = 16
+        self.shared = SharedValues(self.shared_integers_min, self.shared_integers_max, self.shared_value_max_length)
+        self.pubsub = PubSub(self.deliver)
+        self.waiters = {}       # (db, key) -> clients blocked on it, in arrival order
+        self.block_timeouts = []    # heap of (deadline, seq, client, blocked)
+        self.block_seq = count()
+        self.ready = set()      # (db, key) pairs pushed to while clients wait on them
+        self.unblocked = set()  # clients with commands left to run once unblocked
+        self.scans = OrderedDict()  # cursor id -> ((db, key), elements, last used) for SCAN
+        self.scan_elements = 0      # elements held by open iterations
+        self.last_scan = 0
         self.lastsave = int(time.time())
         self.path = db_path
-        self.meta = Haystack(self.path,'redisdb')
-        self.timeouts = self.meta.get('timeouts',{})
+        # no path means a purely in-memory server
+        self.meta = Haystack(self.path,'redisdb',dumps=rdb.dumps,loads=rdb.loads) if self.path else None
+        self.timeouts = ExpiryIndex(self.load_timeouts())
+        self.dirty = set()      # (db, key) pairs changed since the last save
+        self.resync = False     # whether the whole snapshot must be rewritten
+        self.changes = 0        # writes since the last save
+        self.save_params = '3600 1 300 100 60 10000'
+        self.apply_config('save')
+        self.bgsave_pid = None
+        self.bgsave_started = None
+        self.bgsave_state = None        # what to restore should the child fail
+        self.last_bgsave_status = 'ok'
+        self.last_bgsave_try = 0
+        self.last_bgsave_duration = -1
+        self.loading = False
+        self.load_workers = load_workers  # processes decoding databases in parallel at startup
+        self.loading_started = None
+        self.loading_total = self.loading_loaded = 0
+        self.last_load_duration = -1
+        self.last_load_keys = 0
+        self.listener = None
+        self.hz = 10
+        self.next_cron = 0
+        self.expire_cycle_budget = 0.025
+        self.started = time.time()
+        self.stats = {'total_connections_received': 0, 'total_commands_processed': 0,
+                      'rejected_calls': 0, 'expired_keys': 0}
+        self.commands = build_command_table(self)
+        self.monitors = set()
+        self.trace_rate = 0.0
+        self.tracing = False
+        self.loglevel = min(LOGLEVELS, key=lambda l: abs(LOGLEVELS[l] - log.getEffectiveLevel()))
+        self.debug = log.isEnabledFor(logging.DEBUG)
+        self.from_snapshot = True
+        self.aof = None
+        self.appendfsync = 'everysec'
+        self.appendonly = 'yes' if appendonly and self.path else 'no'
+        if self.appendonly == 'yes':
+            self.start_aof(replay=True)
 
 
     def dump(self, client, o):
-        """Output a result to a client"""
-        nl = '\r\n'
-        if isinstance(o, bool):
-            if o:
-                client.wfile.write('+OK\r\n')
-            # Show nothing for a false return; that means be quiet
-        elif o == EMPTY_SCALAR:
-            client.wfile.write('$-1\r\n')
-        elif o == EMPTY_LIST:
-            client.wfile.write('*-1\r\n')
-        elif isinstance(o, int):
-            client.wfile.write(':' + str(o) + nl)
-        elif isinstance(o, str):
-            client.wfile.write('$' + str(len(o)) + nl)
-            client.wfile.write(o + nl)
-        elif isinstance(o, list):
-            client.wfile.write('*' + str(len(o)) + nl)
-            for val in o:
-                self.dump(client, str(val))
-        elif isinstance(o, RedisMessage):
-            client.wfile.write('%s\r\n' % o)
-        elif isinstance(o, dict):
-            client.wfile.write('*' + str(len(o)*2) + nl)
-            for k in o.keys():
-                self.dump(client, str(k))
-                self.dump(client, str(o[k]))
+        """Queue a result for output to a client; queued output is flushed
+        once per loop iteration"""
+        self.pending.add(client)
+        encode(client.write, o)
+
+
+    def deliver(self, client, data):
+        """Queue already encoded output for a client"""
+        client.write(data)
+        self.pending.add(client)
+
+
+    def log(self, client, s, *args):
+        """Server logging - messages are only formatted if DEBUG is on"""
+        if self.debug:
+            log.debug('%s: ' + s, client.peer if client else 'SERVER', *args)
+
+
+    def trace(self, client, args):
+        """Feed a command to MONITOR clients and, sampled, to the log"""
+        line = '[%d %s] "%s"' % (client.db, client.peer,
+            '" "'.join(a.encode('string_escape').replace('"', '\\"') for a in args))
+        if self.monitors:
+            reply = '+%.6f %s\r\n' % (time.time(), line)
+            for m in self.monitors:
+                m.write(reply)
+                self.pending.add(m)
+        if self.trace_rate and random() < self.trace_rate:
+            log.info('TRACE %s', line)
+
+
+    def update_tracing(self):
+        self.tracing = bool(self.monitors) or self.trace_rate > 0
+
+
+    def process(self, client):
+        """Run every complete command waiting in a client's read buffer"""
+        parser = client.parser
+        while not client.closing and not client.blocked:
+            try:
+                args = parser.get()
+            except ProtocolError, e:
+                self.log(client, '%s', e)
+                self.dump(client, RedisError(str(e)))
+                client.closing = True
+                break
+            if args is None:
+                break
+            self.dump(client, self.call(client, args))
+
+
+    def call(self, client, args):
+        """Look up, validate and run a command"""
+        command = self.commands.get(args[0].lower())
+        if command is None:
+            self.stats['rejected_calls'] += 1
+            return RedisError("unknown command '%s'" % args[0])
+        if not command.check_arity(len(args)):
+            self.stats['rejected_calls'] += 1
+            return RedisError("wrong number of arguments for '%s' command" % command.name)
+        if self.loading and 'loading' not in command.flags:
+            return RedisError('Redis is loading the dataset in memory', 'LOADING')
+        if (client.channels or client.patterns) and command.name not in SUBSCRIBER_COMMANDS:
+            return RedisError("Can't execute '%s': only (P)SUBSCRIBE / (P)UNSUBSCRIBE / PING / QUIT are allowed in this context" % command.name)
+        if self.tracing:
+            self.trace(client, args)
+        start = time.time()
+        try:
+            result = command.handler(client, *args[1:])
+        except Exception, e:
+            log.exception("%s failed", command.name)
+            result = RedisError(str(e))
+        # (blocking commands return False when they block, having done nothing)
+        if 'write' in command.flags and result is not False and not isinstance(result, RedisError):
+            self.changes += 1
+            if self.meta is not None:
+                for key in command.keys(args):
+                    self.dirty.add((client.db, key))
+            if self.aof:
+                for logged in self.propagated(client, command.name, args, result):
+                    self.aof.feed(client.db, logged)
+            if self.waiters:
+                for key in command.keys(args):
+                    if (client.db, key) in self.waiters:
+                        self.ready.add((client.db, key))
+                if self.ready:
+                    self.serve_blocked()
+        command.calls += 1
+        command.usec += int((time.time() - start) * 1000000)
+        self.stats['total_commands_processed'] += 1
+        return result
+
+
+    def propagated(self, client, name, args, result):
+        """The commands to log for a write: relative expiry times are made
+        absolute, blocking pops are logged as the pops they turned into, and
+        random ones as removals of what they took, so that replaying them
+        later has the same effect"""
+        if name in ('blpop', 'brpop'):
+            return [[name[1:].upper(), result[0]]]
+        if name == 'brpoplpush':
+            return [['RPOPLPUSH', args[1], args[2]]]
+        if name == 'spop':
+            # the members popped at random are removed by name on replay
+            popped = result if isinstance(result, list) else [result] if isinstance(result, str) else []
+            return [['SREM', args[1]] + popped] if popped else []
+        if name in ('expire', 'pexpire', 'expireat', 'setex'):
+            when = self.timeouts.get((client.db, args[1]))
+            expire = ['PEXPIREAT', args[1], str(int(when * 1000))] if when is not None else ['PERSIST', args[1]]
+            if name == 'setex':
+                return [['SET', args[1], args[3]], expire]
+            return [expire]
+        return [args]
+
+
+    def start_aof(self, replay=False):
+        """Open the append-only file. With `replay` (only at startup) an
+        existing log is loaded, as it holds the whole dataset; otherwise the
+        log is rewritten from the current dataset, and nothing is appended to
+        it until that rewrite is done"""
+        path = os.path.join(self.path, 'appendonly.aof')
+        aof = AppendOnlyFile(path, self.appendfsync)
+        if replay and os.path.exists(path) and os.path.getsize(path) > 0:
+            # the log holds the whole dataset
+            self.from_snapshot = False
+            self.resync = self.meta is not None
+            self.tables.clear()
+            self.timeouts.clear()
+            client = RedisConnection(None)
+            self.select(client, 0)
+            start = time.time()
+            count = aof.load(lambda args: self.call(client, args))
+            log.info("Replayed %d commands from %s in %.2fs" % (count, path, time.time() - start))
+            self.aof = aof
         else:
-            client.wfile.write('return type not yet implemented\r\n')
-        client.wfile.flush()
+            self.load_all()
+            self.aof = aof
+            aof.wait_rewrite = True
+            aof.start_rewrite(self.tables, self.timeouts)
+
+
+    def stop_aof(self):
+        if self.aof.rewrite_pid:
+            os.kill(self.aof.rewrite_pid, signal.SIGKILL)
+            os.waitpid(self.aof.rewrite_pid, 0)
+            self.aof.finish_rewrite(-1)
+        self.aof.close()
+        self.aof = None
+
+
+    def check_children(self):
+        """Reap finished background processes without blocking"""
+        if self.aof and self.aof.rewrite_pid:
+            pid, status = os.waitpid(self.aof.rewrite_pid, os.WNOHANG)
+            if pid:
+                self.aof.finish_rewrite(status)
+        if self.bgsave_pid:
+            pid, status = os.waitpid(self.bgsave_pid, os.WNOHANG)
+            if pid:
+                self.finish_bgsave(status)
+
+
+    def flush_pending(self):
+        """Write out replies queued during this loop iteration, after
+        committing the writes that produced them to the append-only file"""
+        if self.aof:
+            self.aof.flush()
+        pending, self.pending = self.pending, set()
+        for client in pending:
+            if client.fd not in self.clients:
+                continue
+            try:
+                done = client.flush()
+            except socket.error, e:
+                self.log(client, 'write error: %s', e)
+                self.disconnect(client)
+                continue
+            if not done:
+                # wait for the socket to drain before sending the rest
+                self.poller.modify(client.fd, READ | WRITE)
+            elif client.closing:
+                self.disconnect(client)
+
+
+    def connect(self, client_socket):
+        client = RedisConnection(client_socket)
+        self.clients[client.fd] = client
+        self.stats['total_connections_received'] += 1
+        self.log(client, 'client connected')
+        self.select(client, 0)
+        return client
 
 
-    def log(self, client, s):
-        """Server logging"""
+    def disconnect(self, client):
+        if self.clients.pop(client.fd, None) is None:
+            return
+        self.log(client, 'client disconnected')
+        self.pending.discard(client)
+        if client in self.monitors:
+            self.monitors.discard(client)
+            self.update_tracing()
+        if client.channels or client.patterns:
+            self.pubsub.drop(client)
+        if client.blocked:
+            self.unblock(client)
+        self.unblocked.discard(client)
+        if self.poller:
+            try:
+                self.poller.unregister(client.fd)
+            except (KeyError, IOError, OSError):
+                pass
         try:
-            who = '%s:%s' % client.socket.getpeername() if client else 'SERVER'
-        except:
-            who = '<CLOSED>'
-        log.debug("%s: %s" % (who, s))
+            client.socket.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        client.socket.close()
 
 
     def handle(self, client):
-        """Handle commands"""
+        """Handle commands on a blocking connection"""
+        self.cron()
+        data = client.socket.recv(65536)
+        if not data:
+            self.disconnect(client)
+            return
+        client.parser.feed(data)
+        self.process(client)
+        self.time_out_blocked(time.time())
+        self.resume_unblocked()
+        if self.aof:
+            self.aof.flush()
+        for c in list(self.pending):
+            c.flush()
+        self.pending.clear()
+        if client.closing:
+            self.disconnect(client)
+
+
+    def on_readable(self, client):
+        """Drain a readable non-blocking socket and run whatever it sent"""
+        try:
+            while True:
+                data = client.socket.recv(65536)
+                if not data:
+                    self.disconnect(client)
+                    return
+                client.parser.feed(data)
+                if len(data) < 65536:
+                    break
+        except socket.error, e:
+            if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                self.log(client, 'read error: %s', e)
+                self.disconnect(client)
+                return
+        try:
+            self.process(client)
+        except Exception, e:
+            self.log(client, 'exception: %s', e)
+            self.disconnect(client)
 
-        # check 25% of keys, like "real" Redis
-        for e in [k for k in sample(self.timeouts.keys(), len(self.timeouts.keys())/4)]:
-            self.check_ttl(client, e)
 
-        line = client.rfile.readline()
-        if not line:
-            self.log(client, 'client disconnected')
-            del self.clients[client.socket]
-            client.socket.close()
+    def on_writable(self, client):
+        """Resume sending output to a client whose socket became writable"""
+        try:
+            done = client.flush()
+        except socket.error, e:
+            self.log(client, 'write error: %s', e)
+            self.disconnect(client)
             return
-        items = int(line[1:].strip())
-        args = []
-        for x in xrange(0, items):
-            length = int(client.rfile.readline().strip()[1:])
-            args.append(client.rfile.read(length))
-            client.rfile.read(2) # throw out newline
-        command = args[0].lower()
-        self.dump(client, getattr(self, 'handle_' + command)(client, *args[1:]))
+        if done:
+            if client.closing:
+                self.disconnect(client)
+            else:
+                self.poller.modify(client.fd, READ)
 
 
     def gevent_handler(self, client_socket, address):
         """gevent Streamserver handler"""
-        client = RedisConnection(client_socket)
-        self.clients[client_socket] = client
-        self.log(client, 'client connected')
-        self.select(client,0)
+        client = self.connect(client_socket)
         self.log(client, 'Entering loop.')
-        while not self.halt:
-            self.log(client, 'Handling...')
+        while not self.halt and client.fd in self.clients:
             try:
                 self.handle(client)
             except Exception, e:
-                self.log(client, 'exception: %s' % e)
+                self.log(client, 'exception: %s', e)
                 break
-        self.handle_quit(client)
+        self.disconnect(client)
         self.log(client, 'exiting handler')
 
 
@@ -169,83 +671,474 @@ class RedisServer(object):
 
 
     def run(self):
-        """Main loop for standard socket handling"""
+        """Main loop: non-blocking sockets multiplexed over epoll (or the best
+        poller available), with per-connection read and write buffers"""
         self.halt = False
         server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if self.reuseport:
+            # let several processes accept on the same port
+            server.setsockopt(socket.SOL_SOCKET, getattr(socket, 'SO_REUSEPORT', 15), 1)
         server.bind((self.host, self.port))
-        server.listen(5)
+        server.listen(self.backlog)
+        server.setblocking(0)
+        self.poller = Poller()
+        self.poller.register(server.fileno(), READ)
+        self.listener = server
+        self.load()
         while not self.halt:
+            timeout = 1.0/self.hz
+            if self.block_timeouts:
+                timeout = max(0, min(timeout, self.block_timeouts[0][0] - time.time()))
+            self.process_events(timeout)
+            self.time_out_blocked(time.time())
+            self.resume_unblocked()
+            self.cron()
+            self.flush_pending()
+        for client in self.clients.values():
+            self.disconnect(client)
+        self.poller.close()
+        self.poller = None
+        self.listener = None
+        server.close()
+
+
+    def process_events(self, timeout):
+        """Wait up to `timeout` for socket events, and handle them"""
+        try:
+            events = self.poller.poll(timeout)
+        except (select.error, IOError, OSError), e:
+            if interrupted(e):
+                return
+            raise
+        for fd, mask in events:
+            if fd == self.listener.fileno():
+                self.accept(self.listener)
+                continue
+            if fd in self.watched:
+                self.watched[fd](mask)
+                continue
+            client = self.clients.get(fd)
+            if client and mask & WRITE:
+                self.on_writable(client)
+            if client and mask & READ:
+                self.on_readable(client)
+
+
+    def accept(self, server):
+        """Accept every pending connection on the listening socket"""
+        while True:
             try:
-                readable, _, _ = select.select([server] + self.clients.keys(), [], [], 1.0)
-            except select.error, e:
-                if e.args[0] == errno.EINTR:
-                    continue
+                client_socket, address = server.accept()
+            except socket.error, e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                    return
+                if e.args[0] in (errno.EMFILE, errno.ENFILE, errno.ECONNABORTED):
+                    self.log(None, 'accept error: %s', e)
+                    return
                 raise
-            for sock in readable:
-                if sock == server:
-                    (client_socket, address) = server.accept()
-                    client = RedisConnection(client_socket)
-                    self.clients[client_socket] = client
-                    self.log(client, 'client connected')
-                    self.select(client, 0)
-                else:
-                    try:
-                        self.handle(self.clients[sock])
-                    except Exception, e:
-                        self.log(client, 'exception: %s' % e)
-                        self.handle_quit(client)
-        for client_socket in self.clients.iterkeys():
-            client_socket.close()
-        self.clients.clear()
-        server.close()
+            client_socket.setblocking(0)
+            client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            client = self.connect(client_socket)
+            self.poller.register(client.fd, READ)
 
 
     def run_gevent(self):
         """Main loop for gevent handling"""
+        self.load()
         server = gevent.server.StreamServer((self.host, self.port), self.gevent_handler)
         server.serve_forever()
 
 
+    def cron(self):
+        """Periodic housekeeping, run at most `hz` times a second"""
+        now = time.time()
+        if now < self.next_cron:
+            return
+        self.next_cron = now + 1.0/self.hz
+        self.active_expire_cycle(now)
+        if self.aof:
+            self.aof.cron()
+        self.check_children()
+        if self.aof and self.aof.wait_rewrite and not self.aof.rewrite_pid and now - self.aof.rewrite_started >= 1:
+            # the log is of no use until its first rewrite succeeds
+            self.aof.start_rewrite(self.tables, self.timeouts)
+        if self.changes and self.meta is not None and self.bgsave_pid is None:
+            self.check_save_points(now)
+
+
+    def check_save_points(self, now):
+        """Start a background save once any of the `save` thresholds is met,
+        waiting a little before retrying after a failure"""
+        if self.last_bgsave_status != 'ok' and now - self.last_bgsave_try < 5:
+            return
+        for seconds, changes in self.save_points:
+            if self.changes >= changes and now - self.lastsave >= seconds:
+                log.info("%d changes in %d seconds. Saving..." % (changes, seconds))
+                if not hasattr(os, 'fork'):
+                    self.save()
+                elif self.can_bgsave() is None:
+                    self.bgsave()
+                return
+
+
     def save(self):
-        """Serialize tables to disk"""
-        self.meta['timeouts'] = self.timeouts
-        for db in self.tables:
-            self.meta[db] = self.tables[db]
+        """Write the keys changed since the last save to disk, each as its
+        own (value, deadline) record"""
+        if self.meta is None:
+            return
+        if self.bgsave_pid:
+            self.kill_bgsave()
+        if self.resync:
+            self.resync_snapshot()
+        updates = []
+        for db, key in self.dirty:
+            value = self.get_table(db).get(key)
+            if value is None:
+                try:
+                    del self.meta[snapshot_key(db, key)]
+                except KeyError:
+                    pass
+            else:
+                updates.append((snapshot_key(db, key), (value, self.timeouts.get((db, key)))))
+        self.meta.update(updates)
+        self.dirty = set()
         self.meta.commit()
+        self.changes = 0
         self.lastsave = int(time.time())
 
 
-    def select(self, client, db):
+    def can_bgsave(self):
+        """Return why a background save can't start right now, if so"""
+        if self.meta is None:
+            return 'No snapshot path configured'
+        if self.bgsave_pid:
+            return 'Background save already in progress'
+        if self.aof and self.aof.rewrite_pid:
+            return "An AOF log rewriting in progress: can't BGSAVE right now"
+        if self.meta.compacting is not None:
+            return "Snapshot compaction in progress: can't BGSAVE right now"
+        return None
+
+
+    def bgsave(self):
+        """Fork a child that writes a full snapshot from its copy-on-write
+        view of the dataset, to a new file that replaces the current one"""
+        self.load_all()
+        self.last_bgsave_try = time.time()
+        pid = os.fork()
+        if not pid:
+            try:
+                self.meta.replace((snapshot_key(db, key), (value, self.timeouts.get((db, key))))
+                                  for db, table in self.tables.iteritems()
+                                  for key, value in table.iteritems())
+            except Exception, e:
+                log.exception("Background save failed")
+                os._exit(1)
+            os._exit(0)
+        log.info("Background saving started by pid %d" % pid)
+        self.bgsave_pid = pid
+        self.bgsave_started = time.time()
+        # the child covers every change made so far
+        self.bgsave_state = (self.dirty, self.changes, self.resync)
+        self.dirty = set()
+        self.resync = False
+        return pid
+
+
+    def finish_bgsave(self, status):
+        """Called with the child's exit status"""
+        dirty, changes, resync = self.bgsave_state
+        self.bgsave_pid = self.bgsave_state = None
+        self.last_bgsave_duration = time.time() - self.bgsave_started
+        if status == 0:
+            self.meta.reopen()
+            self.changes -= changes
+            self.lastsave = int(time.time())
+            self.last_bgsave_status = 'ok'
+            log.info("Background saving terminated with success in %.2fs" % self.last_bgsave_duration)
+        else:
+            self.dirty |= dirty
+            self.changes += changes
+            self.resync = self.resync or resync
+            self.last_bgsave_status = 'err'
+            log.warning("Background saving failed")
+
+
+    def kill_bgsave(self):
+        os.kill(self.bgsave_pid, signal.SIGKILL)
+        os.waitpid(self.bgsave_pid, 0)
+        self.finish_bgsave(-1)
+
+
+    def resync_snapshot(self):
+        """Drop every record that does not come from the current dataset
+        (e.g., after it was replayed from the append-only file, or when
+        converting a snapshot from the older one-record-per-database format)
+        and mark all keys for saving"""
+        self.load_all()
+        self.resync = False
+        for mkey in self.meta.keys():
+            del self.meta[mkey]
+        for db, table in self.tables.iteritems():
+            self.dirty.update((db, key) for key in table)
+
+
+    def load_timeouts(self):
+        """Load key deadlines from the older one-record-per-database
+        snapshot format, converting from its even older "db key" format"""
+        timeouts = {}
+        if self.meta is None or 'timeouts' not in self.meta:
+            return timeouts
+        for k, when in self.meta['timeouts'].iteritems():
+            if isinstance(k, basestring):
+                db, key = k.split(' ', 1)
+                k = (int(db), key)
+            timeouts[k] = when
+        return timeouts
+
+
+    def new_table(self):
+        table = Table()
+        table.set_index(self.key_index == 'yes')
+        return table
+
+
+    def get_table(self, db):
         if db not in self.tables:
-            self.tables[db] = self.meta.get(db,{})
+            self.tables[db] = self.load_table(db)
+        return self.tables[db]
+
+
+    def load_table(self, db):
+        """Stream a database's records in from the snapshot"""
+        table = self.new_table()
+        if self.meta is None or not self.from_snapshot:
+            return table
+        if db in self.meta:
+            # written in the older format, with the whole table in one record
+            self.resync = True
+            table.update(self.meta[db])
+            return table
+        prefix = snapshot_key(db, '')
+        keys = [k for k in self.meta.keys() if isinstance(k, str) and k.startswith(prefix)]
+        self.restore(db, table, self.meta.iteritems(keys))
+        return table
+
+
+    def restore(self, db, table, records):
+        """Fill in a table from (name, (value, deadline)) snapshot records,
+        leaving out keys that expired while the server was down"""
+        now = time.time()
+        start = len(snapshot_key(db, ''))
+        for mkey, (value, when) in records:
+            key = mkey[start:]
+            if when is not None:
+                if when <= now:
+                    # and drop it from the snapshot on the next save
+                    self.dirty.add((db, key))
+                    continue
+                self.timeouts[(db, key)] = when
+            table[key] = self.compact(value)
+            self.loading_loaded += 1
+            if self.loading and not self.loading_loaded % LOAD_BATCH:
+                self.loading_events()
+
+
+    def compact(self, value):
+        """A loaded value in its most compact form: strings and integers are
+        shared, and lists and hashes small enough for it packed (snapshots
+        hold them in full form)"""
+        if isinstance(value, str):
+            return self.shared.string(value)
+        if isinstance(value, (int, long)):
+            return self.shared.integer(value)
+        if isinstance(value, deque):
+            if len(value) <= self.list_max_ziplist_entries and \
+                    all(len(item) <= self.list_max_ziplist_value for item in value):
+                return PackedList(value)
+        elif type(value) is dict:
+            limit = self.hash_max_ziplist_value
+            if len(value) <= self.hash_max_ziplist_entries and \
+                    all(len(f) <= limit and len(v) <= limit for f, v in value.iteritems()):
+                return PackedHash(value.iteritems())
+        return value
+
+
+    def load(self):
+        """Startup load phase: stream every database in from the snapshot,
+        decoding them in parallel if `load_workers` is set, while clients
+        are answered with -LOADING"""
+        if self.meta is None or not self.from_snapshot:
+            return
+        self.loading = True
+        self.loading_started = time.time()
+        self.loading_total = len(self.meta)
+        self.loading_loaded = 0
+        groups = {}
+        for mkey in self.meta.keys():
+            if isinstance(mkey, int):
+                self.get_table(mkey)
+            elif mkey != 'timeouts':
+                groups.setdefault(int(mkey.split(' ', 1)[0]), []).append(mkey)
+        jobs = [(db, self.meta.locate(keys)) for db, keys in groups.iteritems() if db not in self.tables]
+        for db, entries in jobs:
+            # in place from the start, for clients selecting them meanwhile
+            self.tables[db] = self.new_table()
+        try:
+            if self.load_workers > 1 and len(jobs) > 1:
+                pool = multiprocessing.Pool(min(self.load_workers, len(jobs)))
+                try:
+                    for db, records in pool.imap_unordered(decode_records, [(self.meta.cache, db, entries) for db, entries in jobs]):
+                        self.restore(db, self.tables[db], records)
+                finally:
+                    pool.terminate()
+            else:
+                for db, entries in jobs:
+                    self.restore(db, self.tables[db], read_items(self.meta.cache, entries, self.meta.loads))
+        finally:
+            self.loading = False
+        self.last_load_duration = time.time() - self.loading_started
+        self.last_load_keys = self.loading_loaded
+        log.info("DB loaded from disk: %d keys in %.3f seconds" % (self.last_load_keys, self.last_load_duration))
+
+
+    def loading_events(self):
+        """Serve clients for a moment in the middle of loading"""
+        if self.poller is None:
+            return
+        self.process_events(0)
+        self.flush_pending()
+
+
+    def load_all(self):
+        """Make sure every database in the snapshot has been loaded"""
+        if self.meta is not None and self.from_snapshot:
+            for mkey in self.meta.keys():
+                if isinstance(mkey, int):
+                    self.get_table(mkey)
+                elif mkey != 'timeouts':
+                    self.get_table(int(mkey.split(' ', 1)[0]))
+
+
+    def select(self, client, db):
         client.db = db
-        client.table = self.tables[db]
+        client.table = self.get_table(db)
+
+
+    def info(self, section):
+        """Build the lines of an INFO reply"""
+        lines = []
+        everything = section in ('all', 'everything')
+        if section in ('default', 'server') or everything:
+            lines += ['# Server',
+                      'process_id:%d' % os.getpid(),
+                      'tcp_port:%d' % self.port,
+                      'uptime_in_seconds:%d' % (time.time() - self.started),
+                      'hz:%d' % self.hz, '']
+        if section in ('default', 'clients') or everything:
+            lines += ['# Clients',
+                      'connected_clients:%d' % len(self.clients),
+                      'blocked_clients:%d' % sum(1 for c in self.clients.itervalues() if c.blocked), '']
+        if section in ('default', 'memory') or everything:
+            saved, used = self.shared.saved()
+            lines += ['# Memory',
+                      'shared_integers:%d' % len(self.shared.integers),
+                      'shared_strings:%d' % len(self.shared.strings),
+                      'shared_objects_in_use:%d' % used,
+                      'shared_memory_saved:%d' % saved, '']
+        if section in ('default', 'persistence') or everything:
+            lines += ['# Persistence',
+                      'loading:%d' % self.loading]
+            if self.loading:
+                elapsed = time.time() - self.loading_started
+                done = float(self.loading_loaded) / max(self.loading_total, 1)
+                lines += ['loading_start_time:%d' % self.loading_started,
+                          'loading_total_keys:%d' % self.loading_total,
+                          'loading_loaded_keys:%d' % self.loading_loaded,
+                          'loading_loaded_perc:%.2f' % (done * 100),
+                          'loading_eta_seconds:%d' % (elapsed / done - elapsed if done else 1)]
+            lines += ['rdb_last_load_keys_loaded:%d' % self.last_load_keys,
+                      'rdb_last_load_time_sec:%.3f' % self.last_load_duration,
+                      'rdb_changes_since_last_save:%d' % self.changes,
+                      'rdb_bgsave_in_progress:%d' % bool(self.bgsave_pid),
+                      'rdb_last_save_time:%d' % self.lastsave,
+                      'rdb_last_bgsave_status:%s' % self.last_bgsave_status,
+                      'rdb_last_bgsave_time_sec:%d' % self.last_bgsave_duration,
+                      'rdb_current_bgsave_time_sec:%d' % (time.time() - self.bgsave_started if self.bgsave_pid else -1),
+                      'aof_enabled:%d' % bool(self.aof)]
+            if self.aof:
+                lines += ['aof_rewrite_in_progress:%d' % bool(self.aof.rewrite_pid),
+                          'aof_last_bgrewrite_status:%s' % self.aof.last_rewrite_status,
+                          'aof_current_size:%d' % self.aof.size()]
+            lines.append('')
+        if section in ('default', 'stats') or everything:
+            stats = dict(self.stats, pubsub_channels=len(self.pubsub.channels), pubsub_patterns=len(self.pubsub.patterns))
+            lines += ['# Stats'] + ['%s:%d' % i for i in sorted(stats.items())] + ['']
+        if section == 'commandstats' or everything:
+            lines.append('# Commandstats')
+            for name, c in sorted(self.commands.items()):
+                if c.calls:
+                    lines.append('cmdstat_%s:calls=%d,usec=%d,usec_per_call=%.2f' % (name, c.calls, c.usec, float(c.usec)/c.calls))
+            lines.append('')
+        if section in ('default', 'keyspace') or everything:
+            lines.append('# Keyspace')
+            for db, table in sorted(self.tables.items()):
+                if table:
+                    expires = len([k for k in self.timeouts.deadlines if k[0] == db])
+                    lines.append('db%d:keys=%d,expires=%d' % (db, len(table), expires))
+            lines.append('')
+        return lines
 
 
     def stop(self):
         if not self.halt:
             self.log(None, 'STOPPING')
             self.save()
+            if self.aof:
+                self.stop_aof()
             self.halt = True
 
 
     def check_ttl(self, client, key):
-        k = "%s %s" % (client.db,key)
-        if k in self.timeouts:
-            if self.timeouts[k] <= time.time():
-                self.handle_del(client, key)
+        """Lazily expire a key when it is accessed"""
+        when = self.timeouts.get((client.db, key))
+        if when is not None and when <= time.time():
+            self.expire_key(client.db, key)
+
+
+    def expire_key(self, db, key):
+        self.log(None, 'EXPIRED %s %s', db, key)
+        self.stats['expired_keys'] += 1
+        self.timeouts.discard((db, key))
+        self.get_table(db).pop(key, None)
+        self.changes += 1
+        if self.meta is not None:
+            self.dirty.add((db, key))
+        if self.aof:
+            self.aof.feed(db, ['DEL', key])
+
+
+    def active_expire_cycle(self, now):
+        """Remove due keys in small batches, within a fixed time budget"""
+        stop = now + self.expire_cycle_budget
+        while True:
+            expired = self.timeouts.pop_expired(now, 20)
+            for db, key in expired:
+                self.expire_key(db, key)
+            if len(expired) < 20 or time.time() > stop:
+                break
 
 
     # command handlers, sorted by order of redis.io docs
 
     # Keys
 
-    def handle_del(self, client, *args):
+    def handle_del(self, client, key, *keys):
         count = 0
-        for key in args:
-            self.handle_persist(client, key)
-            self.log(client, 'DEL %s' % key)
+        for key in (key,) + keys:
+            self.check_ttl(client, key)
+            self.timeouts.discard((client.db, key))
             if key not in client.table:
                 continue
             del client.table[key]
@@ -254,7 +1147,9 @@ class RedisServer(object):
 
 
     def handle_dump(self, client, key):
-        self.log(client, 'DUMP %s' % key)
+        self.check_ttl(client, key)
+        if key not in client.table:
+            return EMPTY_SCALAR
         # no special internal representation
         return str(client.table[key])
 
@@ -268,42 +1163,52 @@ class RedisServer(object):
 
     def handle_expire(self, client, key, ttl):
         ttl = int(ttl)
-        self.log(client, 'EXPIRE %s %d' % (key, ttl))
+        self.check_ttl(client, key)
         if key not in client.table:
             return 0
-        self.timeouts["%s %s" % (client.db,key)] = time.time() + ttl
+        self.timeouts[(client.db, key)] = time.time() + ttl
         return 1
 
 
     def handle_expireat(self, client, key, when):
         when = int(when)
-        self.log(client, 'EXPIREAT %s %d' % (key, when))
+        self.check_ttl(client, key)
         if key not in client.table:
             return 0
-        self.timeouts["%s %s" % (client.db,key)] = when
+        self.timeouts[(client.db, key)] = when
         return 1
 
 
     def handle_keys(self, client, pattern):
-        r = re.compile('^' + pattern.replace('*', '.*') + '$') 
-        self.log(client, 'KEYS %s' % pattern)
-        return [k for k in client.table.keys() if r.match(k)]
+        keys = client.table.matching(pattern)
+        # due keys the active cycle hasn't reaped yet are expired on the way
+        for key in keys:
+            self.check_ttl(client, key)
+        return [key for key in keys if key in client.table]
 
 
     # def handle_migrate(self, client, host, port, key, db, timeout, option):
 
 
     def handle_move(self, client, key, db):
-        self.log(client, 'MOVE %s' % key)
-        if key not in client.table:
+        db = int(db)
+        self.check_ttl(client, key)
+        if key not in client.table or db == client.db:
             return 0
-        self.handle_persist(client, key)
-        if db not in self.tables:
-            self.tables[db] = self.meta.get(db,{})
-        if key in self.tables[db]:
+        table = self.get_table(db)
+        when = self.timeouts.get((db, key))
+        if when is not None and when <= time.time():
+            self.expire_key(db, key)
+        if key in table:
             return 0
-        self.tables[db][key] = client.table[key]
-        del client.table[key]
+        table[key] = client.table.pop(key)
+        if self.meta is not None:
+            self.dirty.add((db, key))
+        # the TTL travels with the key
+        when = self.timeouts.get((client.db, key))
+        if when is not None:
+            self.timeouts.discard((client.db, key))
+            self.timeouts[(db, key)] = when
         return 1
 
 
@@ -311,59 +1216,71 @@ class RedisServer(object):
 
 
     def handle_persist(self, client, key):
-        try:
-            del self.timeouts["%s %s" % (client.db,key)]
-        except:
-            pass
+        self.check_ttl(client, key)
+        if key not in client.table:
+            return 0
+        return int(self.timeouts.discard((client.db, key)))
 
 
     def handle_pexpire(self, client, key, mttl):
+        self.check_ttl(client, key)
         if key not in client.table:
             return 0
-        self.timeouts["%s %s" % (client.db,key)] = time.time() + (mttl*1000)
+        self.timeouts[(client.db, key)] = time.time() + int(mttl)/1000.0
         return 1
 
 
     def handle_pexpireat(self, client, key, mwhen):
+        self.check_ttl(client, key)
         if key not in client.table:
             return 0
-        self.timeouts["%s %s" % (client.db,key)] = mwhen*1000
+        self.timeouts[(client.db, key)] = int(mwhen)/1000.0
         return 1
 
 
     def handle_pttl(self, client, key):
-        self.log(client, 'PTTL %s' % key)
+        self.check_ttl(client, key)
         if key not in client.table:
             return -2
-        k = "%s %s" % (client.db, key)
-        if k not in self.timeouts:
+        when = self.timeouts.get((client.db, key))
+        if when is None:
             return -1
-        return int(self.timeouts[k]*1000)
+        return int((when - time.time())*1000)
 
 
     def handle_randomkey(self, client):
-        self.log(client, 'RANDOMKEY')
-        if len(client.table):
-            return self.get(client, choice(client.table.keys()))
-        return 0
+        keys = client.table.keys()
+        shuffle(keys)
+        # skip keys that turn out to be due
+        for key in keys:
+            self.check_ttl(client, key)
+            if key in client.table:
+                return key
+        return EMPTY_SCALAR
 
 
     def handle_rename(self, client, key, newkey):
-        client.table[newkey] = client.table[key]
-        k = "%s %s" % (client.db,key)
-        # transfer TTL
-        if k in self.timeouts:
-            self.timeouts["%s %s" % (client.db,key)] = self.timeouts[k]
-            del self.timeouts[k]
-        del client.table[key]
-        self.log(client, 'RENAME %s -> %s' % (key, newkey))
+        self.check_ttl(client, key)
+        if key not in client.table:
+            return RedisError('no such key')
+        if key == newkey:
+            return True
+        client.table[newkey] = client.table.pop(key)
+        # transfer TTL, replacing any the target key had
+        self.timeouts.discard((client.db, newkey))
+        when = self.timeouts.get((client.db, key))
+        if when is not None:
+            self.timeouts.discard((client.db, key))
+            self.timeouts[(client.db, newkey)] = when
         return True
 
 
     def handle_renamenx(self, client, key, newkey):
-        self.log(client, 'RENAMENX %s -> %s' % (key, newkey))
+        self.check_ttl(client, newkey)
         if newkey not in client.table:
-            self.handle_rename(client, key, newkey)
+            result = self.handle_rename(client, key, newkey)
+            if isinstance(result, RedisError):
+                return result
             return 1
         return 0
 
@@ -372,45 +1289,120 @@ class RedisServer(object):
 
 
     def handle_ttl(self, client, key):
+        self.check_ttl(client, key)
         if key not in client.table:
             return -2
-        k = "%s %s" % (client.db, key)
-        if k not in self.timeouts:
+        when = self.timeouts.get((client.db, key))
+        if when is None:
             return -1
-        return int(self.timeouts[k] - time.time() + 0.1)
+        return int(when - time.time() + 0.1)
 
 
     def handle_type(self, client, key):
+        self.check_ttl(client, key)
         if key not in client.table:
             return RedisMessage('none')
-
-        data = client.table[key]
-        if isinstance(data, deque):
-            return RedisMessage('list')
-        elif isinstance(data, set):
-            return RedisMessage('set')
-        elif isinstance(data, dict):
-            return RedisMessage('hash')
-        elif isinstance(data, str):
-            return RedisMessage('string')
-        else:
+        name = type_name(client.table[key])
+        if name is None:
             return RedisError('unknown data type')
+        return RedisMessage(name)
+
+
+    def handle_scan(self, client, cursor, *options):
+        options = parse_scan_options(options)
+        if isinstance(options, RedisError):
+            return options
+        pattern, count, kind = options
+        step = self.scan(client, None, cursor, count, client.table.keys)
+        if isinstance(step, RedisError):
+            return step
+        cursor, keys = step
+        result = []
+        for key in keys:
+            self.check_ttl(client, key)
+            if key not in client.table:
+                continue
+            if not matches(pattern, key):
+                continue
+            if kind and type_name(client.table[key]) != kind:
+                continue
+            result.append(key)
+        return [cursor, result]
 
 
-    # def handle_scan(self, client, *args)
+    def scan(self, client, key, cursor, count, elements):
+        """One step of a SCAN-family iteration over a collection (the keyspace
+        when `key` is None), which `elements` lists. That list is taken when
+        an iteration starts and kept until it ends, so every element present
+        throughout is returned exactly once, however the collection grows or
+        shrinks in between; callers skip the elements since removed. Returns
+        the next cursor and this step's elements, or an error"""
+        try:
+            cursor = int(cursor)
+        except ValueError:
+            cursor = -1
+        if cursor < 0:
+            return RedisError('invalid cursor')
+        target = (client.db, key)
+        now = time.time()
+        if cursor == 0:
+            elements = elements()
+            if len(elements) <= count:
+                return '0', elements
+            scan_id, pos = self.open_scan(target, elements, now), 0
+            if scan_id is None:
+                return RedisError('too many SCAN iterations in progress, try again later', 'BUSY')
+        else:
+            scan_id, pos = cursor & SCAN_ID_MASK, cursor >> SCAN_ID_BITS
+            entry = self.scans.get(scan_id)
+            if entry is None or entry[0] != target:
+                return RedisError('invalid cursor')
+            elements = entry[1]
+            # keep the least recently used iterations first
+            del self.scans[scan_id]
+            self.scans[scan_id] = (target, elements, now)
+        end = pos + count
+        if end >= len(elements):
+            del self.scans[scan_id]
+            self.scan_elements -= len(elements)
+            return '0', elements[pos:]
+        return str(end << SCAN_ID_BITS | scan_id), elements[pos:end]
+
+
+    def open_scan(self, target, elements, now):
+        """Keep the elements of a new iteration, returning its id, or None if
+        they don't fit. Only iterations left unused for SCAN_IDLE_TIMEOUT are
+        dropped to make room, so a cursor still being followed stays valid"""
+        while self.scans and self.scan_elements + len(elements) > SCAN_MAX_ELEMENTS:
+            scan_id, (_, old, used) = next(self.scans.iteritems())
+            if now - used < SCAN_IDLE_TIMEOUT:
+                break
+            del self.scans[scan_id]
+            self.scan_elements -= len(old)
+        # a lone iteration is let through, however big
+        if self.scans and self.scan_elements + len(elements) > SCAN_MAX_ELEMENTS:
+            return None
+        scan_id = self.last_scan
+        while True:
+            scan_id = scan_id % SCAN_ID_MASK + 1
+            if scan_id not in self.scans:
+                break
+        self.last_scan = scan_id
+        self.scans[scan_id] = (target, elements, now)
+        self.scan_elements += len(elements)
+        return scan_id
 
 
     # Strings
 
     def handle_append(self, client, key, value):
+        self.check_ttl(client, key)
         if key not in client.table:
             self.handle_set(client, key, value)
             return len(client.table[key])
         data = client.table[key]
         if isinstance(data, str):
-            self.handle_persist(client, key)
             client.table[key] += value
-            self.log(client, 'APPEND %s -> %d' % (key, len(client.table[key])))
             return len(client.table[key])
         return BAD_VALUE
 
@@ -421,24 +1413,23 @@ class RedisServer(object):
 
     def handle_decr(self, client, key):
         self.check_ttl(client, key)
-        return self.handle_decrby(self, client, key, 1)
+        return self.handle_decrby(client, key, 1)
 
 
     def handle_decrby(self, client, key, by):
         self.check_ttl(client, key)
-        return self.handle_incrby(self, client, key, -by)
+        return self.handle_incrby(client, key, -int(by))
 
 
     def handle_get(self, client, key):
         self.check_ttl(client, key)
         data = client.table.get(key, None)
-        if isinstance(data, deque):
+        if data is not None and not isinstance(data, STRINGS):
             return BAD_VALUE
         if data != None:
             data = str(data)
         else:
             data = EMPTY_SCALAR
-        self.log(client, 'GET %s -> %d' % (key, len(data)))
         return data
 
 
@@ -447,16 +1438,16 @@ class RedisServer(object):
 
 
     def handle_getset(self, client, key, data):
-        self.handle_persist(client, key)
+        self.check_ttl(client, key)
         old_data = client.table.get(key, None)
-        if isinstance(old_data, deque):
+        if old_data is not None and not isinstance(old_data, STRINGS):
             return BAD_VALUE
+        self.timeouts.discard((client.db, key))
         if old_data != None:
             old_data = str(old_data)
         else:
             old_data = EMPTY_SCALAR
-        client.table[key] = data
-        self.log(client, 'GETSET %s %s -> %s' % (key, data, old_data))
+        client.table[key] = self.shared.string(data)
         return old_data
 
 
@@ -467,43 +1458,62 @@ class RedisServer(object):
 
     def handle_incrby(self, client, key, by):
         self.check_ttl(client, key)
+        data = client.table.get(key, 0)
+        if not isinstance(data, STRINGS):
+            return BAD_VALUE
         try:
-            client.table[key] = int(client.table[key])
-            client.table[key] += int(by)
-        except (KeyError, TypeError, ValueError):
-            client.table[key] = 1
-        self.log(client, 'INCRBY %s %s -> %s' % (key, by, client.table[key]))
-        return client.table[key]
+            value = int(data) + int(by)
+        except ValueError:
+            return NOT_INTEGER
+        client.table[key] = self.shared.integer(value)
+        return value
 
 
     # def handle_incrbyfloat(self, client, key, by):
 
 
-    def handle_mget(self, client, keys):
+    def handle_mget(self, client, key, *keys):
         result = []
-        for k in keys:
+        for k in (key,) + keys:
             self.check_ttl(client, k)
             data = client.table.get(k, None)
-            if isinstance(data, deque):
-                return BAD_VALUE
-            if data != None:
+            # keys holding other types read as missing, as in Redis
+            if isinstance(data, STRINGS):
                 data = str(data)
             else:
                 data = EMPTY_SCALAR
             result.append(data)
-        self.log(client, 'MGET %s -> %s' % (keys, result))
         return result
 
 
-    # def handle_mset(self, client, *args):
-    # def handle_msetnx(self, client, *args):
+    def handle_mset(self, client, key, data, *args):
+        if len(args) % 2:
+            return RedisError("wrong number of arguments for 'mset' command")
+        args = (key, data) + args
+        for i in xrange(0, len(args), 2):
+            self.timeouts.discard((client.db, args[i]))
+            client.table[args[i]] = self.shared.string(args[i + 1])
+        return True
+
+
+    def handle_msetnx(self, client, key, data, *args):
+        if len(args) % 2:
+            return RedisError("wrong number of arguments for 'msetnx' command")
+        args = (key, data) + args
+        for i in xrange(0, len(args), 2):
+            self.check_ttl(client, args[i])
+            if args[i] in client.table:
+                return 0
+        self.handle_mset(client, *args)
+        return 1
+
+
     # def handle_psetex(self, client, key, ms, value):
 
 
     def handle_set(self, client, key, data):
-        self.handle_persist(client, key)
-        client.table[key] = data
-        self.log(client, 'SET %s -> %d' % (key, len(data)))
+        self.timeouts.discard((client.db, key))
+        client.table[key] = self.shared.string(data)
         return True
 
 
@@ -516,11 +1526,10 @@ class RedisServer(object):
 
 
     def handle_setnx(self, client, key, data):
+        self.check_ttl(client, key)
         if key in client.table:
-            self.log(client, 'SETNX %s -> %d FAILED' % (key, len(data)))
             return 0
-        client.table[key] = data
-        self.log(client, 'SETNX %s -> %d' % (key, len(data)))
+        client.table[key] = self.shared.string(data)
         return 1
 
 
@@ -532,62 +1541,214 @@ class RedisServer(object):
 
     # Lists
 
-    # def handle_blpop(self, client, *args)
-    # def handle_brpop(self, client, *args)
-    # def handle_brpoplpush(self, client, *args)
+    def get_list(self, client, key):
+        """The list held at a key, in either encoding: None if there is none,
+        or BAD_VALUE if the key holds something else"""
+        self.check_ttl(client, key)
+        value = client.table.get(key)
+        if value is not None and not isinstance(value, LISTS):
+            return BAD_VALUE
+        return value
+
+
+    def new_list(self, table, key):
+        """Put an empty list at a key"""
+        value = table[key] = PackedList() if self.list_max_ziplist_entries > 0 else deque()
+        return value
+
+
+    def push(self, table, key, value, items, left=False):
+        """Add items to one end of a list, returning its length. A packed list
+        is turned into a deque once it would grow past list-max-ziplist-entries
+        or be given an item longer than list-max-ziplist-value, as Redis does."""
+        if isinstance(value, PackedList) and \
+                (len(value) + len(items) > self.list_max_ziplist_entries or
+                 any(len(item) > self.list_max_ziplist_value for item in items)):
+            value = table[key] = deque(value)
+        if left:
+            value.extendleft(items)
+        else:
+            value.extend(items)
+        return len(value)
+
+
+    def handle_blpop(self, client, key, timeout, *args):
+        # the timeout always comes last, after any further keys
+        args = (key, timeout) + args
+        return self.bpop(client, args[:-1], args[-1], 'lpop')
+
+
+    def handle_brpop(self, client, key, timeout, *args):
+        # the timeout always comes last, after any further keys
+        args = (key, timeout) + args
+        return self.bpop(client, args[:-1], args[-1], 'rpop')
+
+
+    def handle_brpoplpush(self, client, source, destination, timeout):
+        return self.bpop(client, (source,), timeout, 'rpop', destination)
+
+
+    def bpop(self, client, keys, timeout, end, destination=None):
+        """Pop from the first non-empty list among `keys`, or block the client
+        until an element is pushed to one of them or `timeout` (in seconds, 0
+        meaning forever) runs out"""
+        try:
+            timeout = float(timeout)
+        except ValueError:
+            return RedisError('timeout is not a float or out of range')
+        if timeout < 0:
+            return RedisError('timeout is negative')
+        for key in keys:
+            value = self.get_list(client, key)
+            if value is None:
+                continue
+            if isinstance(value, RedisError):
+                return value
+            if value:
+                if destination is not None:
+                    return self.handle_rpoplpush(client, key, destination)
+                return [key, value.popleft() if end == 'lpop' else value.pop()]
+        blocked = client.blocked = (client.db, keys, end, destination)
+        for key in keys:
+            self.waiters.setdefault((client.db, key), deque()).append(client)
+        if timeout:
+            heappush(self.block_timeouts, (time.time() + timeout, next(self.block_seq), client, blocked))
+        return False
+
+
+    def unblock(self, client, reply=False):
+        """Stop a client waiting, sending it a reply if there is one, and
+        have the commands it sent meanwhile run"""
+        db, keys, end, destination = client.blocked
+        client.blocked = None
+        for key in keys:
+            waiters = self.waiters.get((db, key))
+            if waiters is None:
+                continue
+            try:
+                waiters.remove(client)
+            except ValueError:
+                pass
+            if not waiters:
+                del self.waiters[(db, key)]
+        if reply is not False:
+            self.dump(client, reply)
+        self.unblocked.add(client)
+
+
+    def serve_blocked(self):
+        """Hand elements pushed to lists that clients are waiting on to the
+        clients that have waited longest"""
+        while self.ready:
+            db, key = self.ready.pop()
+            table = self.get_table(db)
+            waiters = self.waiters.get((db, key))
+            while waiters:
+                value = table.get(key)
+                if not isinstance(value, LISTS) or not value:
+                    break
+                self.serve(waiters[0], db, key, value)
+                waiters = self.waiters.get((db, key))
+
+
+    def serve(self, client, db, key, value):
+        """Pop an element for a blocked client, logging it as the pop it is"""
+        blocked_db, keys, end, destination = client.blocked
+        table = self.get_table(db)
+        if destination is not None:
+            target = table.get(destination)
+            if target is not None and not isinstance(target, LISTS):
+                self.unblock(client, BAD_VALUE)
+                return
+        element = value.popleft() if end == 'lpop' else value.pop()
+        self.changes += 1
+        if self.meta is not None:
+            self.dirty.add((db, key))
+        if destination is None:
+            self.unblock(client, [key, element])
+            logged = [end.upper(), key]
+        else:
+            if target is None:
+                target = self.new_list(table, destination)
+            self.push(table, destination, target, (element,), left=True)
+            # not a key of the command that woke this client up
+            if self.meta is not None:
+                self.dirty.add((db, destination))
+            if (db, destination) in self.waiters:
+                self.ready.add((db, destination))
+            self.unblock(client, element)
+            logged = ['RPOPLPUSH', key, destination]
+        self.discard_empty(client, key)
+        if self.aof:
+            self.aof.feed(db, logged)
+
+
+    def time_out_blocked(self, now):
+        """Answer clients whose blocking pops timed out with a nil reply"""
+        heap = self.block_timeouts
+        while heap and heap[0][0] <= now:
+            when, seq, client, blocked = heappop(heap)
+            # skip clients since served, or blocked again
+            if client.blocked is blocked:
+                self.unblock(client, EMPTY_SCALAR if blocked[3] is not None else EMPTY_LIST)
+
+
+    def resume_unblocked(self):
+        """Run the commands clients sent while they were blocked"""
+        while self.unblocked:
+            client = self.unblocked.pop()
+            if client.fd in self.clients:
+                self.process(client)
 
     # def handle_lindex(self, client, key, index)
     # def handle_linsert(self, client, key, *args)
 
 
     def handle_llen(self, client, key):
-        self.check_ttl(client, key)
-        if key not in client.table:
+        value = self.get_list(client, key)
+        if value is None:
             return 0
-        if not isinstance(client.table[key], deque):
-            return BAD_VALUE
-        return len(client.table[key])
+        if isinstance(value, RedisError):
+            return value
+        return len(value)
 
 
     def handle_lpop(self, client, key):
-        self.check_ttl(client, key)
-        if key not in client.table:
+        value = self.get_list(client, key)
+        if value is None:
             return EMPTY_SCALAR
-        if not isinstance(client.table[key], deque):
-            return BAD_VALUE
-        if len(client.table[key]) > 0:
-            data = client.table[key].popleft()
+        if isinstance(value, RedisError):
+            return value
+        if len(value) > 0:
+            data = value.popleft()
         else:
             data = EMPTY_SCALAR
-        self.log(client, 'LPOP %s -> %s' % (key, data))
+        self.discard_empty(client, key)
         return data
 
 
-    def handle_lpush(self, client, key, data):
-        self.check_ttl(client, key)
-        if key not in client.table:
-            client.table[key] = deque()
-        elif not isinstance(client.table[key], deque):
-            return BAD_VALUE
-        client.table[key].appendleft(data)
-        self.log(client, 'LPUSH %s %s' % (key, data))
-        return True
+    def handle_lpush(self, client, key, data, *values):
+        value = self.get_list(client, key)
+        if isinstance(value, RedisError):
+            return value
+        if value is None:
+            value = self.new_list(client.table, key)
+        return self.push(client.table, key, value, (data,) + values, left=True)
 
 
     # def handle_lpushx(self, client, key, data):
 
 
     def handle_lrange(self, client, key, start, stop):
-        self.check_ttl(client, key)
         start, stop = int(start), int(stop)
         if start == 0 and stop == -1:
             stop = None
-        if key not in client.table:
+        value = self.get_list(client, key)
+        if value is None:
             return EMPTY_LIST
-        if not isinstance(client.table[key], deque):
-            return BAD_VALUE
-        l = list(client.table[key])[start:stop]
-        self.log(client, 'LRANGE %s %s %s -> %s' % (key, start, stop, l))
+        if isinstance(value, RedisError):
+            return value
+        l = list(value)[start:stop]
         return l
 
 
@@ -597,171 +1758,966 @@ class RedisServer(object):
 
 
     def handle_rpop(self, client, key):
-        self.check_ttl(client, key)
-        if key not in client.table:
+        value = self.get_list(client, key)
+        if value is None:
             return EMPTY_SCALAR
-        if not isinstance(client.table[key], deque):
-            return BAD_VALUE
-        if len(client.table[key]) > 0:
-            data = client.table[key].pop()
+        if isinstance(value, RedisError):
+            return value
+        if len(value) > 0:
+            data = value.pop()
         else:
             data = EMPTY_SCALAR
-        self.log(client, 'RPOP %s -> %s' % (key, data))
+        self.discard_empty(client, key)
         return data
 
 
-    # def handle_rpoplpush(self, source, destination)
+    def handle_rpoplpush(self, client, source, destination):
+        value = self.get_list(client, source)
+        target = self.get_list(client, destination)
+        if value is None:
+            return EMPTY_SCALAR
+        for v in (value, target):
+            if isinstance(v, RedisError):
+                return v
+        if not value:
+            return EMPTY_SCALAR
+        element = value.pop()
+        if target is None:
+            target = self.new_list(client.table, destination)
+        self.push(client.table, destination, target, (element,), left=True)
+        self.discard_empty(client, source)
+        return element
 
 
-    def handle_rpush(self, client, key, data):
-        self.check_ttl(client, key)
-        if key not in client.table:
-            client.table[key] = deque()
-        elif not isinstance(client.table[key], deque):
-            return BAD_VALUE
-        client.table[key].append(data)
-        self.log(client, 'RPUSH %s %s' % (key, data))
-        return True
+    def handle_rpush(self, client, key, data, *values):
+        value = self.get_list(client, key)
+        if isinstance(value, RedisError):
+            return value
+        if value is None:
+            value = self.new_list(client.table, key)
+        return self.push(client.table, key, value, (data,) + values)
 
 
     # def handle_rpushx(self, client, key, data)
 
 
-    # Hashes (TODO: add type checks)
+    # Hashes
 
-    def handle_hdel(self, client, key, *keys):
-        if key not in client.table:
-            return 0
+    def get_hash(self, client, key):
+        """The hash held at a key, in either encoding: None if there is none,
+        or BAD_VALUE if the key holds something else"""
         self.check_ttl(client, key)
-        return len(map(client.table[key].pop, keys))
+        value = client.table.get(key)
+        if value is not None and not isinstance(value, HASHES):
+            return BAD_VALUE
+        return value
+
+
+    def new_hash(self, client, key):
+        """Put an empty hash at a key"""
+        value = client.table[key] = PackedHash() if self.hash_max_ziplist_entries > 0 else {}
+        return value
+
+
+    def set_fields(self, client, key, value, pairs):
+        """Set fields of a hash from (field, value) pairs, returning how many
+        were new. A packed hash is turned into a dict once it would grow past
+        hash-max-ziplist-entries or be given a field or value longer than
+        hash-max-ziplist-value, as Redis does. Fields and values going into
+        a dict are shared, while packed ones are copies anyway."""
+        string = self.shared.string
+        if isinstance(value, PackedHash):
+            limit = self.hash_max_ziplist_value
+            if any(len(f) > limit or len(v) > limit for f, v in pairs):
+                value = client.table[key] = dict((string(f), string(v)) for f, v in value.iteritems())
+            else:
+                added = value.update(pairs)
+                if len(value) > self.hash_max_ziplist_entries:
+                    client.table[key] = dict((string(f), string(v)) for f, v in value.iteritems())
+                return added
+        size = len(value)
+        value.update((string(f), string(v)) for f, v in pairs)
+        return len(value) - size
+
+
+    def handle_hdel(self, client, key, field, *fields):
+        value = self.get_hash(client, key)
+        if value is None:
+            return 0
+        if isinstance(value, RedisError):
+            return value
+        removed = 0
+        for f in (field,) + fields:
+            if value.pop(f, None) is not None:
+                removed += 1
+        self.discard_empty(client, key)
+        return removed
 
 
     def handle_hexists(self, client, key, field):
-        if key not in client.table:
+        value = self.get_hash(client, key)
+        if value is None:
             return 0
-        self.check_ttl(client, key)
-        return field in client.table[key]
+        if isinstance(value, RedisError):
+            return value
+        return 1 if field in value else 0
 
 
     def handle_hget(self, client, key, field):
-        if key not in client.table:
-            return 0
-        self.check_ttl(client, key)
-        return client.table[key][field] if field in client.table[key] else None 
+        value = self.get_hash(client, key)
+        if value is None:
+            return EMPTY_SCALAR
+        if isinstance(value, RedisError):
+            return value
+        return value.get(field)
 
 
     def handle_hgetall(self, client, key):
-        self.check_ttl(client, key)
-        try:
-            return client.table[key]
-        except:
+        value = self.get_hash(client, key)
+        if value is None:
             return []
+        if isinstance(value, RedisError):
+            return value
+        # dicts are sent as they are
+        return value.flat() if isinstance(value, PackedHash) else value
 
 
     def handle_hincrby(self, client, key, field, increment):
-        if key not in client.table:
-            client.table[key] = {}
-        prev = long(client.table[key].get(field, '0'))
-
-        client.table[key][field] = str(prev + increment)
-        return client.table[key][field]
+        try:
+            increment = int(increment)
+        except ValueError:
+            return NOT_INTEGER
+        value = self.get_hash(client, key)
+        if isinstance(value, RedisError):
+            return value
+        if value is None:
+            value = self.new_hash(client, key)
+        try:
+            result = int(value.get(field, '0')) + increment
+        except ValueError:
+            return RedisError('hash value is not an integer')
+        self.set_fields(client, key, value, ((field, str(result)),))
+        return result
 
 
     # def handle_hincrbyfloat(self, client, key, field, increment):
 
 
     def handle_hkeys(self, client, key):
-        if key not in client.table:
+        value = self.get_hash(client, key)
+        if value is None:
             return []
-        return client.table[key].keys()
+        if isinstance(value, RedisError):
+            return value
+        return value.keys()
 
 
     def handle_hlen(self, client, key):
-        self.check_ttl(client, key)
-        return len(client.table[key])
+        value = self.get_hash(client, key)
+        if value is None:
+            return 0
+        if isinstance(value, RedisError):
+            return value
+        return len(value)
+
+
+    def handle_hmget(self, client, key, field, *fields):
+        fields = (field,) + fields
+        value = self.get_hash(client, key)
+        if value is None:
+            return [None] * len(fields)
+        if isinstance(value, RedisError):
+            return value
+        return [value.get(f) for f in fields]
+
+
+    def handle_hmset(self, client, key, field, data, *args):
+        if len(args) % 2:
+            return RedisError("wrong number of arguments for 'hmset' command")
+        value = self.get_hash(client, key)
+        if isinstance(value, RedisError):
+            return value
+        if value is None:
+            value = self.new_hash(client, key)
+        self.set_fields(client, key, value, [(field, data)] + zip(args[::2], args[1::2]))
+        return True
 
 
-    def handle_hmget(self, client, key, fields):
-        self.check_ttl(client, key)
-        return [client.table[key].get(f) for f in fields]
+    def handle_hset(self, client, key, field, data):
+        value = self.get_hash(client, key)
+        if isinstance(value, RedisError):
+            return value
+        if value is None:
+            value = self.new_hash(client, key)
+        return self.set_fields(client, key, value, ((field, data),))
 
 
-    def handle_hmset(self, client, key, items):
-        self.check_ttl(client, key)
-        for k, v in items.items():
-            client[key][k] = v
-        return True
+    # def handle_hsetnx(self, client, key, field, value)
+
 
+    def handle_hvals(self, client, key):
+        value = self.get_hash(client, key)
+        if value is None:
+            return []
+        if isinstance(value, RedisError):
+            return value
+        return value.values()
+
+
+    def handle_hscan(self, client, key, cursor, *options):
+        options = parse_scan_options(options)
+        if isinstance(options, RedisError):
+            return options
+        pattern, count, kind = options
+        if kind:
+            return SYNTAX_ERROR
+        value = self.get_hash(client, key)
+        if value is None:
+            return ['0', []]
+        if isinstance(value, RedisError):
+            return value
+        step = self.scan(client, key, cursor, count, value.keys)
+        if isinstance(step, RedisError):
+            return step
+        cursor, fields = step
+        result = []
+        for field in fields:
+            if field in value and matches(pattern, field):
+                result.extend((field, value[field]))
+        return [cursor, result]
 
-    def handle_hset(self, client, key, field, value):
+
+    # Sets
+
+    def get_set(self, client, key):
+        """The set held at a key, in either encoding: None if there is none,
+        or BAD_VALUE if the key holds something else"""
         self.check_ttl(client, key)
-        if key not in client.table:
-            client.table[key] = {}
-        if field not in client.table[key]:
-            client.table[key][field] = value
+        value = client.table.get(key)
+        if value is not None and not isinstance(value, SETS):
+            return BAD_VALUE
+        return value
+
+
+    def new_set(self, members):
+        """A set holding the given members, as an intset if they allow it"""
+        if len(members) <= self.set_max_intset_entries and encodable(members):
+            return IntSet(members)
+        return members if isinstance(members, set) else set(members)
+
+
+    def add_members(self, client, key, value, members):
+        """Add members to a set, returning how many were new. An intset is
+        turned into a plain set once a member isn't an integer or it would
+        grow past set-max-intset-entries, as Redis does."""
+        size = len(value)
+        if isinstance(value, IntSet):
+            for i, member in enumerate(members):
+                if as_integer(member) is None or \
+                        (len(value) >= self.set_max_intset_entries and member not in value):
+                    value = client.table[key] = set(value)
+                    value.update(members[i:])
+                    break
+                value.add(member)
+        else:
+            value.update(members)
+        return len(value) - size
+
+
+    def set_operation(self, client, keys, operation):
+        """The members SINTER, SUNION or SDIFF give for some keys, as a set
+        (or BAD_VALUE). Intersections start from the smallest set and stop
+        as soon as nothing is left, differences once nothing is left of the
+        first set."""
+        values = []
+        for key in keys:
+            value = self.get_set(client, key)
+            if isinstance(value, RedisError):
+                return value
+            values.append(value if value is not None else ())
+        if operation == 'inter':
+            if not all(values):
+                return set()
+            values.sort(key=len)
+            result = set(values[0])
+            for value in values[1:]:
+                if not result:
+                    break
+                if isinstance(value, IntSet):
+                    result = set(m for m in result if m in value)
+                else:
+                    # walks the smaller of the two
+                    result &= value
+        elif operation == 'union':
+            values.sort(key=len, reverse=True)
+            result = set(values[0])
+            for value in values[1:]:
+                result.update(value)
+        else:
+            result = set(values[0])
+            for value in values[1:]:
+                if not result:
+                    break
+                # walks whichever of the two is smaller
+                result = result.difference(value)
+        return result
+
+
+    def store_set(self, client, dest, result):
+        """Put the result of a set operation at a key, replacing whatever was
+        there, and return its size"""
+        if isinstance(result, RedisError):
+            return result
+        self.timeouts.discard((client.db, dest))
+        client.table.pop(dest, None)
+        if result:
+            client.table[dest] = self.new_set(result)
+        return len(result)
+
+
+    def handle_sadd(self, client, key, member, *members):
+        value = self.get_set(client, key)
+        if isinstance(value, RedisError):
+            return value
+        if value is None:
+            value = client.table[key] = IntSet() if as_integer(member) is not None else set()
+        return self.add_members(client, key, value, (member,) + members)
+
+
+    def handle_scard(self, client, key):
+        value = self.get_set(client, key)
+        if value is None:
+            return 0
+        if isinstance(value, RedisError):
+            return value
+        return len(value)
+
+
+    def handle_sdiff(self, client, key, *keys):
+        result = self.set_operation(client, (key,) + keys, 'diff')
+        return list(result) if isinstance(result, set) else result
+
+
+    def handle_sdiffstore(self, client, dest, key, *keys):
+        return self.store_set(client, dest, self.set_operation(client, (key,) + keys, 'diff'))
+
+
+    def handle_sinter(self, client, key, *keys):
+        result = self.set_operation(client, (key,) + keys, 'inter')
+        return list(result) if isinstance(result, set) else result
+
+
+    def handle_sinterstore(self, client, dest, key, *keys):
+        return self.store_set(client, dest, self.set_operation(client, (key,) + keys, 'inter'))
+
+
+    def handle_sismember(self, client, key, member):
+        value = self.get_set(client, key)
+        if value is None:
+            return 0
+        if isinstance(value, RedisError):
+            return value
+        return 1 if member in value else 0
+
+
+    def handle_smembers(self, client, key):
+        value = self.get_set(client, key)
+        if value is None:
+            return []
+        if isinstance(value, RedisError):
+            return value
+        return list(value)
+
+
+    def handle_smove(self, client, source, destination, member):
+        value = self.get_set(client, source)
+        target = self.get_set(client, destination)
+        for v in (value, target):
+            if isinstance(v, RedisError):
+                return v
+        if value is None or member not in value:
+            return 0
+        if value is target:
             return 1
-        client.table[key][field] = value
-        return 0
+        value.discard(member)
+        self.discard_empty(client, source)
+        if target is None:
+            target = client.table[destination] = IntSet() if as_integer(member) is not None else set()
+        self.add_members(client, destination, target, (member,))
+        return 1
 
 
-    # def handle_hsetnx(self, client, key, field, value)
+    def handle_spop(self, client, key, count=None):
+        value = self.get_set(client, key)
+        if isinstance(value, RedisError):
+            return value
+        if count is not None:
+            try:
+                count = int(count)
+            except ValueError:
+                return NOT_INTEGER
+            if count < 0:
+                return RedisError('value is out of range, must be positive')
+        if value is None:
+            return [] if count is not None else EMPTY_SCALAR
+        members = random_members(value, 1 if count is None else count)
+        for member in members:
+            value.discard(member)
+        self.discard_empty(client, key)
+        return members if count is not None else members[0]
+
+
+    def handle_srandmember(self, client, key, count=None):
+        value = self.get_set(client, key)
+        if isinstance(value, RedisError):
+            return value
+        if count is not None:
+            try:
+                count = int(count)
+            except ValueError:
+                return NOT_INTEGER
+        if value is None:
+            return [] if count is not None else EMPTY_SCALAR
+        if count is None:
+            return random_members(value, 1)[0]
+        if count >= 0:
+            return random_members(value, count)
+        # a negative count asks for that many picks, which may repeat
+        if isinstance(value, IntSet):
+            return [value.member(int(random() * len(value))) for i in xrange(-count)]
+        members = list(value)
+        return [choice(members) for i in xrange(-count)]
+
+
+    def handle_srem(self, client, key, member, *members):
+        value = self.get_set(client, key)
+        if value is None:
+            return 0
+        if isinstance(value, RedisError):
+            return value
+        size = len(value)
+        value.discard(member)
+        for m in members:
+            value.discard(m)
+        self.discard_empty(client, key)
+        return size - len(value)
+
+
+    def handle_sscan(self, client, key, cursor, *options):
+        options = parse_scan_options(options)
+        if isinstance(options, RedisError):
+            return options
+        pattern, count, kind = options
+        if kind:
+            return SYNTAX_ERROR
+        value = self.get_set(client, key)
+        if value is None:
+            return ['0', []]
+        if isinstance(value, RedisError):
+            return value
+        step = self.scan(client, key, cursor, count, lambda: list(value))
+        if isinstance(step, RedisError):
+            return step
+        cursor, members = step
+        return [cursor, [m for m in members if m in value and matches(pattern, m)]]
+
+
+    def handle_sunion(self, client, key, *keys):
+        result = self.set_operation(client, (key,) + keys, 'union')
+        return list(result) if isinstance(result, set) else result
+
+
+    def handle_sunionstore(self, client, dest, key, *keys):
+        return self.store_set(client, dest, self.set_operation(client, (key,) + keys, 'union'))
+
+
+    # Sorted Sets
+
+    def get_zset(self, client, key, create=False):
+        """The sorted set held at a key: None if there is none (or a new one,
+        with `create`), or BAD_VALUE if the key holds something else"""
+        self.check_ttl(client, key)
+        zset = client.table.get(key)
+        if zset is None:
+            if create:
+                zset = client.table[key] = SortedSet()
+            return zset
+        if not isinstance(zset, SortedSet):
+            return BAD_VALUE
+        return zset
 
 
-    def handle_hvals(self, client, key):
-        if key not in client.table:
+    def discard_empty(self, client, key):
+        """Remove a key whose collection was left empty, as Redis does"""
+        if key in client.table and not len(client.table[key]):
+            del client.table[key]
+            self.timeouts.discard((client.db, key))
+
+
+    def handle_zadd(self, client, key, *args):
+        flags = set()
+        args = list(args)
+        while args and args[0].lower() in ('nx', 'xx', 'gt', 'lt', 'ch', 'incr'):
+            flags.add(args.pop(0).lower())
+        if not args or len(args) % 2:
+            return SYNTAX_ERROR
+        if 'nx' in flags and 'xx' in flags:
+            return RedisError('XX and NX options at the same time are not compatible')
+        if len(flags & set(['nx', 'gt', 'lt'])) > 1:
+            return RedisError('GT, LT, and/or NX options at the same time are not compatible')
+        if 'incr' in flags and len(args) > 2:
+            return RedisError('INCR option supports a single increment-element pair')
+        try:
+            pairs = [(parse_score(args[i]), args[i + 1]) for i in xrange(0, len(args), 2)]
+        except ValueError:
+            return NOT_FLOAT
+        zset = self.get_zset(client, key, create=True)
+        if zset is BAD_VALUE:
+            return zset
+        added = changed = 0
+        result = None
+        for score, member in pairs:
+            old = zset.score(member)
+            if old is None:
+                if 'xx' in flags:
+                    continue
+                added += 1
+            else:
+                if 'nx' in flags:
+                    continue
+                if 'incr' in flags:
+                    score += old
+                    if score != score:
+                        return RedisError('resulting score is not a number (NaN)')
+                if ('gt' in flags and score <= old) or ('lt' in flags and score >= old):
+                    continue
+                if score != old:
+                    changed += 1
+            zset.insert(member, score)
+            result = score
+        self.discard_empty(client, key)
+        if 'incr' in flags:
+            return format_score(result) if result is not None else EMPTY_SCALAR
+        return added + changed if 'ch' in flags else added
+
+
+    def handle_zcard(self, client, key):
+        zset = self.get_zset(client, key)
+        if zset is None:
+            return 0
+        if zset is BAD_VALUE:
+            return zset
+        return len(zset)
+
+
+    def handle_zcount(self, client, key, low, high):
+        try:
+            low, high = parse_score_bound(low), parse_score_bound(high)
+        except ValueError:
+            return RedisError('min or max is not a float')
+        zset = self.get_zset(client, key)
+        if zset is None:
+            return 0
+        if zset is BAD_VALUE:
+            return zset
+        start, end = score_ranks(zset, low, high)
+        return end - start
+
+
+    def handle_zincrby(self, client, key, increment, member):
+        return self.handle_zadd(client, key, 'INCR', increment, member)
+
+
+    def handle_zinterstore(self, client, dest, numkeys, *args):
+        return self.zstore(client, dest, numkeys, args, union=False)
+
+
+    def handle_zrange(self, client, key, start, stop, *options):
+        return self.zrange(client, key, start, stop, options, desc=False)
+
+
+    def handle_zrangebyscore(self, client, key, low, high, *options):
+        return self.zrangebyscore(client, key, low, high, options, desc=False)
+
+
+    def handle_zrank(self, client, key, member):
+        zset = self.get_zset(client, key)
+        if zset is None:
+            return EMPTY_SCALAR
+        if zset is BAD_VALUE:
+            return zset
+        rank = zset.rank(member)
+        return EMPTY_SCALAR if rank is None else rank
+
+
+    def handle_zrem(self, client, key, member, *members):
+        zset = self.get_zset(client, key)
+        if zset is None:
+            return 0
+        if zset is BAD_VALUE:
+            return zset
+        count = 0
+        for member in (member,) + members:
+            count += zset.remove(member)
+        self.discard_empty(client, key)
+        return count
+
+
+    def handle_zremrangebyrank(self, client, key, start, stop):
+        try:
+            start, stop = int(start), int(stop)
+        except ValueError:
+            return NOT_INTEGER
+        zset = self.get_zset(client, key)
+        if zset is None:
+            return 0
+        if zset is BAD_VALUE:
+            return zset
+        return self.zremove(client, key, zset, zset.range(start, stop))
+
+
+    def handle_zremrangebyscore(self, client, key, low, high):
+        try:
+            low, high = parse_score_bound(low), parse_score_bound(high)
+        except ValueError:
+            return RedisError('min or max is not a float')
+        zset = self.get_zset(client, key)
+        if zset is None:
+            return 0
+        if zset is BAD_VALUE:
+            return zset
+        start, end = score_ranks(zset, low, high)
+        return self.zremove(client, key, zset, zset.range(start, end - 1) if end > start else [])
+
+
+    def handle_zrevrange(self, client, key, start, stop, *options):
+        return self.zrange(client, key, start, stop, options, desc=True)
+
+
+    def handle_zrevrangebyscore(self, client, key, high, low, *options):
+        return self.zrangebyscore(client, key, low, high, options, desc=True)
+
+
+    def handle_zrevrank(self, client, key, member):
+        rank = self.handle_zrank(client, key, member)
+        if isinstance(rank, int):
+            return len(client.table[key]) - 1 - rank
+        return rank
+
+
+    def handle_zscore(self, client, key, member):
+        zset = self.get_zset(client, key)
+        if zset is None:
+            return EMPTY_SCALAR
+        if zset is BAD_VALUE:
+            return zset
+        score = zset.score(member)
+        return EMPTY_SCALAR if score is None else format_score(score)
+
+
+    def handle_zscan(self, client, key, cursor, *options):
+        options = parse_scan_options(options)
+        if isinstance(options, RedisError):
+            return options
+        pattern, count, kind = options
+        if kind:
+            return SYNTAX_ERROR
+        zset = self.get_zset(client, key)
+        if zset is None:
+            return ['0', []]
+        if zset is BAD_VALUE:
+            return zset
+        step = self.scan(client, key, cursor, count, zset.members)
+        if isinstance(step, RedisError):
+            return step
+        cursor, members = step
+        result = []
+        for member in members:
+            score = zset.score(member)
+            if score is not None and matches(pattern, member):
+                result.extend((member, format_score(score)))
+        return [cursor, result]
+
+
+    def handle_zunionstore(self, client, dest, numkeys, *args):
+        return self.zstore(client, dest, numkeys, args, union=True)
+
+
+    def zrange(self, client, key, start, stop, options, desc):
+        """ZRANGE and ZREVRANGE: only the requested ranks are visited"""
+        try:
+            start, stop = int(start), int(stop)
+        except ValueError:
+            return NOT_INTEGER
+        if [o.lower() for o in options] not in ([], ['withscores']):
+            return SYNTAX_ERROR
+        zset = self.get_zset(client, key)
+        if zset is None:
             return []
-        return client.table[key].values()
+        if zset is BAD_VALUE:
+            return zset
+        return zset_reply(zset.range(start, stop, desc), bool(options))
 
 
-    # def hscan(self, client, key, cursor, *args)
+    def zrangebyscore(self, client, key, low, high, options, desc):
+        """ZRANGEBYSCORE and ZREVRANGEBYSCORE: the range and its LIMIT are
+        turned into ranks, so that only the members returned are visited"""
+        try:
+            low, high = parse_score_bound(low), parse_score_bound(high)
+        except ValueError:
+            return RedisError('min or max is not a float')
+        withscores, offset, count = False, 0, -1
+        i = 0
+        while i < len(options):
+            option = options[i].lower()
+            if option == 'withscores':
+                withscores = True
+                i += 1
+            elif option == 'limit' and i + 2 < len(options):
+                try:
+                    offset, count = int(options[i + 1]), int(options[i + 2])
+                except ValueError:
+                    return NOT_INTEGER
+                i += 3
+            else:
+                return SYNTAX_ERROR
+        zset = self.get_zset(client, key)
+        if zset is None:
+            return []
+        if zset is BAD_VALUE:
+            return zset
+        start, end = score_ranks(zset, low, high)
+        if offset < 0:
+            return []
+        # ranks counted from the end of the set when going backwards
+        if desc:
+            start, end = len(zset) - end, len(zset) - start
+        start += offset
+        if count >= 0:
+            end = min(end, start + count)
+        if start >= end:
+            return []
+        return zset_reply(zset.range(start, end - 1, desc), withscores)
+
+
+    def zremove(self, client, key, zset, pairs):
+        """Remove (score, member) pairs from a sorted set, returning how many"""
+        for score, member in pairs:
+            zset.remove(member)
+        self.discard_empty(client, key)
+        return len(pairs)
+
+
+    def zstore(self, client, dest, numkeys, args, union):
+        """ZUNIONSTORE and ZINTERSTORE, which also take plain sets as inputs
+        (with scores of 1). Intersections start from the smallest input."""
+        try:
+            numkeys = int(numkeys)
+        except ValueError:
+            return NOT_INTEGER
+        if numkeys < 1:
+            return RedisError('at least 1 input key is needed for ZUNIONSTORE/ZINTERSTORE')
+        if numkeys > len(args):
+            return SYNTAX_ERROR
+        keys, weights, aggregate = args[:numkeys], [1.0] * numkeys, 'sum'
+        i = numkeys
+        while i < len(args):
+            option = args[i].lower()
+            if option == 'weights' and i + numkeys < len(args):
+                try:
+                    weights = [parse_score(w) for w in args[i + 1:i + 1 + numkeys]]
+                except ValueError:
+                    return RedisError('weight value is not a float')
+                i += numkeys + 1
+            elif option == 'aggregate' and i + 1 < len(args) and args[i + 1].lower() in AGGREGATES:
+                aggregate = args[i + 1].lower()
+                i += 2
+            else:
+                return SYNTAX_ERROR
+        inputs = []
+        for key, weight in zip(keys, weights):
+            self.check_ttl(client, key)
+            value = client.table.get(key)
+            if value is None:
+                value = set()
+            elif not isinstance(value, (SortedSet,) + SETS):
+                return BAD_VALUE
+            inputs.append((value, weight))
+        combine = AGGREGATES[aggregate]
+        result = {}
+        if union:
+            for value, weight in inputs:
+                for member, score in zset_items(value):
+                    score = weighted(score, weight)
+                    if member in result:
+                        score = combine(result[member], score)
+                    result[member] = score
+        else:
+            inputs.sort(key=lambda (value, weight): len(value))
+            (first, weight), others = inputs[0], inputs[1:]
+            for member, score in zset_items(first):
+                score = weighted(score, weight)
+                for value, weight in others:
+                    other = zset_score(value, member)
+                    if other is None:
+                        break
+                    score = combine(score, weighted(other, weight))
+                else:
+                    result[member] = score
+        self.timeouts.discard((client.db, dest))
+        client.table.pop(dest, None)
+        if result:
+            zset = client.table[dest] = SortedSet()
+            for member, score in result.iteritems():
+                zset.insert(member, score)
+        return len(result)
 
 
 
     # Server
 
+    def handle_bgrewriteaof(self, client):
+        if not self.aof:
+            return RedisError('Append only file is disabled')
+        if self.aof.rewrite_pid:
+            return RedisError('Background append only file rewriting already in progress')
+        if self.bgsave_pid:
+            return RedisError("Background save in progress: can't BGREWRITEAOF right now")
+        self.aof.start_rewrite(self.tables, self.timeouts)
+        return RedisMessage('Background append only file rewriting started')
+
+
     def handle_bgsave(self, client):
-        if hasattr(os, 'fork'):
-            if not os.fork():
-                self.save()
-                sys.exit(0)
-        else:
-            self.save()
-        self.log(client, 'BGSAVE')
+        if not hasattr(os, 'fork'):
+            return RedisError('Background saving is not supported on this platform')
+        reason = self.can_bgsave()
+        if reason:
+            return RedisError(reason)
+        self.bgsave()
         return RedisMessage('Background saving started')
 
 
+    def handle_command(self, client, subcommand=None, *args):
+        if subcommand is None:
+            return [c.info() for c in self.commands.itervalues()]
+        subcommand = subcommand.lower()
+        if subcommand == 'count':
+            return len(self.commands)
+        if subcommand == 'info':
+            return [self.commands[n.lower()].info() if n.lower() in self.commands else None for n in args]
+        if subcommand == 'getkeys':
+            if not args or args[0].lower() not in self.commands:
+                return RedisError('Invalid command specified')
+            return self.commands[args[0].lower()].keys(list(args))
+        return RedisError('Unknown subcommand or wrong number of arguments for %s' % subcommand)
+
+
+    def handle_config(self, client, subcommand, *args):
+        subcommand = subcommand.lower()
+        if subcommand == 'get' and len(args) == 1:
+            result = []
+            for name, (attr, _) in sorted(self.config_params.items()):
+                if match(args[0].lower(), name):
+                    result += [name, str(getattr(self, attr))]
+            return result
+        if subcommand == 'set' and len(args) == 2:
+            name, value = args[0].lower(), args[1]
+            if name not in self.config_params:
+                return RedisError('Unsupported CONFIG parameter: %s' % name)
+            attr, kind = self.config_params[name]
+            try:
+                value = kind(value)
+            except ValueError:
+                return RedisError("Invalid argument '%s' for CONFIG SET '%s'" % (args[1], name))
+            setattr(self, attr, value)
+            self.apply_config(name)
+            return True
+        if subcommand == 'resetstat' and not args:
+            for k in self.stats:
+                self.stats[k] = 0
+            for c in self.commands.itervalues():
+                c.calls = c.usec = 0
+            return True
+        return RedisError('Unknown subcommand or wrong number of arguments for CONFIG %s' % subcommand)
+
+
+    def apply_config(self, name):
+        """Act on a parameter changed through CONFIG SET"""
+        if name == 'loglevel':
+            log.setLevel(LOGLEVELS[self.loglevel])
+            self.debug = log.isEnabledFor(logging.DEBUG)
+        elif name == 'trace-sample-rate':
+            self.update_tracing()
+        elif name == 'key-index':
+            for table in self.tables.itervalues():
+                table.set_index(self.key_index == 'yes')
+        elif name == 'save':
+            numbers = map(int, self.save_params.split())
+            self.save_points = zip(numbers[::2], numbers[1::2])
+        elif name == 'appendonly':
+            if self.appendonly == 'yes' and not self.aof and self.path:
+                self.start_aof()
+            elif self.appendonly == 'no' and self.aof:
+                self.stop_aof()
+        elif name == 'appendfsync' and self.aof:
+            self.aof.fsync = self.appendfsync
+        elif name in ('shared-integers-min', 'shared-integers-max'):
+            self.shared.configure(self.shared_integers_min, self.shared_integers_max)
+        elif name == 'shared-value-max-length':
+            self.shared.max_length = self.shared_value_max_length
+
+
     def handle_flushdb(self, client):
-        self.log(client, 'FLUSHDB')
+        if self.meta is not None:
+            self.dirty.update((client.db, key) for key in client.table)
         client.table.clear()
+        self.timeouts.discard_db(client.db)
         return True
 
 
     def handle_flushall(self, client):
-        self.log(client, 'FLUSHALL')
-        for table in self.tables.itervalues():
+        self.load_all()
+        for db, table in self.tables.iteritems():
+            if self.meta is not None:
+                self.dirty.update((db, key) for key in table)
             table.clear()
+        self.timeouts.clear()
         return True
 
 
+    def handle_info(self, client, section=None):
+        sections = self.info(section.lower() if section else 'default')
+        return '\r\n'.join(sections) + '\r\n'
+
+
     def handle_lastsave(self, client):
         return self.lastsave
 
 
 
-    def handle_ping(self, client):
-        self.log(client, 'PING -> PONG')
+    def handle_monitor(self, client):
+        self.monitors.add(client)
+        self.update_tracing()
+        return True
+
+
+    def handle_ping(self, client, message=None):
+        if client.channels or client.patterns:
+            return ['pong', message or '']
+        if message is not None:
+            return message
         return RedisMessage('PONG')
 
 
     def handle_quit(self, client):
-        client.socket.shutdown(socket.SHUT_RDWR)
-        client.socket.close()
-        self.log(client, 'QUIT')
-        del self.clients[client.socket]
-        return False
+        # the connection is closed once the reply has been sent
+        client.closing = True
+        return True
 
 
     def handle_save(self, client):
+        if self.bgsave_pid:
+            return RedisError('Background save already in progress')
         self.save()
         self.log(client, 'SAVE')
         return True
@@ -770,57 +2726,70 @@ class RedisServer(object):
     def handle_select(self, client, db):
         db = int(db)
         self.select(client, db)
-        self.log(client, 'SELECT %s' % db)
         return True
 
 
     # PubSub
 
+    def handle_pubsub(self, client, subcommand, *args):
+        subcommand = subcommand.lower()
+        if subcommand == 'channels' and len(args) <= 1:
+            return [c for c in self.pubsub.channels if not args or match(args[0], c)]
+        if subcommand == 'numsub':
+            return [x for c in args for x in (c, self.pubsub.numsub(c))]
+        if subcommand == 'numpat' and not args:
+            return len(self.pubsub.patterns)
+        return RedisError('Unknown subcommand or wrong number of arguments for PUBSUB %s' % subcommand)
+
+
     def handle_publish(self, client, channel, message):
-        for p in self.channels.keys():
-            if re.match(p, channel):
-                for c in self.channels[channel]:
-                    c.wfile.write('*3\r\n')
-                    c.wfile.write('$%d\r\n' % len('message'))
-                    c.wfile.write('message\r\n')
-                    c.wfile.write('$%d\r\n' % len(channel))
-                    c.wfile.write(channel + '\r\n')
-                    c.wfile.write('$%d\r\n' % len(message))
-                    c.wfile.write(message + '\r\n')
-        return True
+        return self.pubsub.publish(channel, message)
 
 
-    def handle_subscribe(self, client, channels):
-        for c in channels.trim().split(' '):
-            if c not in self.channels.keys():
-                self.channels[c] = []
-            self.channels[c].append(client)
-        return True
+    def handle_subscribe(self, client, channel, *channels):
+        for channel in (channel,) + channels:
+            self.pubsub.subscribe(client, channel)
+            self.dump(client, ['subscribe', channel, self.subscriptions(client)])
+        return False
 
 
-    def handle_unsubscribe(self, client, channels):
-        # TODO: handle no args (full unsubscribe)
-        for c in channels.trim().split(' '):
-            try:
-                self.channels[c].remove(client)
-            except:
-                return False
-        return True
+    def handle_unsubscribe(self, client, *channels):
+        self.unsubscribe(client, 'unsubscribe', channels or list(client.channels), self.pubsub.unsubscribe)
+        return False
+
+
+    def handle_psubscribe(self, client, pattern, *patterns):
+        for pattern in (pattern,) + patterns:
+            self.pubsub.psubscribe(client, pattern)
+            self.dump(client, ['psubscribe', pattern, self.subscriptions(client)])
+        return False
 
 
-    def handle_psubscribe(self, client, patterns):
-        pass
+    def handle_punsubscribe(self, client, *patterns):
+        self.unsubscribe(client, 'punsubscribe', patterns or list(client.patterns), self.pubsub.punsubscribe)
+        return False
+
+
+    def subscriptions(self, client):
+        return len(client.channels) + len(client.patterns)
 
 
-    def handle_punsubscribe(self, client, patterns):
-        pass
+    def unsubscribe(self, client, kind, names, remove):
+        """Confirm each channel or pattern dropped (even if it wasn't
+        subscribed to), or that there were none to drop"""
+        if not names:
+            self.dump(client, [kind, None, self.subscriptions(client)])
+        for name in names:
+            remove(client, name)
+            self.dump(client, [kind, name, self.subscriptions(client)])
 
 
     def handle_shutdown(self, client):
         self.log(client, 'SHUTDOWN')
         self.halt = True
         self.save()
-        return self.handle_quit(client)
+        client.closing = True
+        return False
 
 
 class ThreadedRedisServer(RedisServer):
@@ -839,32 +2808,42 @@ class ThreadedRedisServer(RedisServer):
 
 
     def __init__(self, **kwargs):
-        super(ThreadedRedisServer, self).__init__(*kwargs)
+        super(ThreadedRedisServer, self).__init__(**kwargs)
+        self.load()
 
     def thread(self, sock, address):
-        client = RedisConnection(sock)
-        self.clients[sock] = client
-        self.log(client, 'client connected')
-        self.select(client,0)
-        while True:
+        client = self.connect(sock)
+        while client.fd in self.clients:
             try:
-                self.handle(self.clients[sock])
+                self.handle(client)
             except Exception, e:
-                self.log(client, 'exception: %s' % e)
+                self.log(client, 'exception: %s', e)
                 break
         try:
-            self.handle_quit(client)
+            self.disconnect(client)
         except Exception, e:
             log.debug(">>> %s" % e)
             pass
 
 
-def fork(**kwargs):
+def decode_records(job):
+    """Process pool job: decode the snapshot records of a database"""
+    cache, db, entries = job
+    return db, list(read_items(cache, entries, rdb.loads))
+
+
+def fork(workers=0, **kwargs):
+    """Run a server in a child process, returning its pid. With `workers`,
+    the child supervises a sharded group of processes (see cluster.py)"""
     try:
         pid = os.fork()
         if pid > 0:
             return pid
-        m = RedisServer(*kwargs)
+        if workers:
+            from .cluster import serve
+            serve(workers=workers, **kwargs)
+            os._exit(0)
+        m = RedisServer(**kwargs)
         m.run()
     except KeyboardInterrupt:
         m.stop()
@@ -883,8 +2862,9 @@ def main(args):
         signal.signal(signal.SIGTERM, sigterm)
         signal.signal(signal.SIGHUP, sighup)
 
-    host, port, log_file, db_file = '127.0.0.1', 6379, None, None
-    opts, args = getopt.getopt(args, 'h:p:d:l:f:')
+    host, port, log_file, db_file = '127.0.0.1', 6379, None, '.'
+    workers, appendonly, load_workers = 0, False, 0
+    opts, args = getopt.getopt(args, 'h:p:d:l:f:w:aj:')
     pid_file = None
     for o, a in opts:
         if o == '-h':
@@ -897,11 +2877,26 @@ def main(args):
             db_file = os.path.abspath(a)
         elif o == '-f':
             pid_file = os.path.abspath(a)
+        elif o == '-w':
+            workers = int(a)
+        elif o == '-a':
+            appendonly = True
+        elif o == '-j':
+            load_workers = int(a)
     if pid_file:
         with open(pid_file, 'w') as f:
             f.write('%s\n' % os.getpid())
 
-    m = RedisServer(host=host, port=port, log_file=log_file, db_file=db_file)
+    if log_file:
+        logging.basicConfig(filename=log_file)
+    if workers:
+        from .cluster import serve
+        serve(host=host, port=port, db_path=db_file, workers=workers, appendonly=appendonly)
+        if pid_file:
+            os.unlink(pid_file)
+        sys.exit(0)
+
+    m = RedisServer(host=host, port=port, db_path=db_file, appendonly=appendonly, load_workers=load_workers)
     try:
         m.run()
     except KeyboardInterrupt:
@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+Shared objects for stored values: a pool of integers, after the shared
+integers of Redis, and a table of interned short strings, so that values
+repeated across many keys are held once
+
+Published under the MIT license.
+"""
+
+import sys
+
+# short strings interned at most, to bound the table
+MAX_STRINGS = 1 << 16
+
+# CPython shares integers in this range itself
+CACHED_LOW, CACHED_HIGH = -5, 256
+
+
+class SharedValues(object):
+    """
+    Stored values are swapped for shared objects equal to them as they are
+    written: integers in a configured range come from a pool made in
+    advance, and strings up to a configured length from a table that keeps
+    the first copy written (the ones later read from the network being left
+    to the garbage collector).
+
+    How much that saves is worked out from reference counts when asked for,
+    every reference to a shared object past the first counting as a copy
+    not made. References held elsewhere for a moment, such as by a request
+    being handled, make it an estimate.
+    """
+
+    def __init__(self, low=0, high=9999, max_length=16):
+        self.strings = {}
+        self.max_length = max_length
+        self.misses = 0
+        self.configure(low, high)
+
+
+    def configure(self, low, high):
+        """Build the integer pool, for the range from low to high"""
+        self.low = low
+        self.integers = [int(str(n)) for n in xrange(low, high + 1)]
+
+
+    def integer(self, n):
+        """The shared integer equal to n, or n itself"""
+        i = n - self.low
+        if 0 <= i < len(self.integers):
+            return self.integers[i]
+        return n
+
+
+    def string(self, s):
+        """The shared string equal to s, or s itself, which is interned if it
+        is short enough and there is room"""
+        if len(s) > self.max_length:
+            return s
+        shared = self.strings.get(s)
+        if shared is not None:
+            return shared
+        if len(self.strings) >= MAX_STRINGS:
+            # make room now and then, by dropping strings nothing holds
+            self.misses += 1
+            if self.misses < MAX_STRINGS:
+                return s
+            self.misses = 0
+            self.prune()
+            if len(self.strings) >= MAX_STRINGS:
+                return s
+        self.strings[s] = s
+        return s
+
+
+    def prune(self):
+        """Drop interned strings no longer held by anything else"""
+        # referenced as a key and a value of the table, by the loop and by
+        # the argument
+        unused = [s for s in self.strings if sys.getrefcount(s) <= 4]
+        for s in unused:
+            del self.strings[s]
+
+
+    def saved(self):
+        """Estimate the bytes shared objects save, returning that and how
+        many of them are in use"""
+        total = used = 0
+        for n in self.integers:
+            if CACHED_LOW <= n <= CACHED_HIGH:
+                continue
+            # held by the pool, the loop and the argument
+            users = sys.getrefcount(n) - 3
+            if users > 0:
+                used += 1
+                total += (users - 1) * sys.getsizeof(n)
+        for s in self.strings:
+            # and by the table twice over, as key and value
+            users = sys.getrefcount(s) - 4
+            if users > 0:
+                used += 1
+                total += (users - 1) * sys.getsizeof(s)
+        return total, used
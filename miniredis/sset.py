@@ -1,5 +1,175 @@
 # Apache LIcensed code from https://github.com/locationlabs/mockredis
-from bisect import bisect_left, bisect_right
+from random import random
+
+# as in Redis: up to 32 levels, each holding a quarter of the nodes below
+MAXLEVEL = 32
+P = 0.25
+
+
+class _Node(object):
+    """
+    A skip list node. `next[i]` is the following node at level i, and
+    `span[i]` the number of level 0 steps that link covers.
+    """
+    __slots__ = ('key', 'next', 'span', 'prev')
+
+    def __init__(self, key, level):
+        self.key = key
+        self.next = [None] * level
+        self.span = [0] * level
+        self.prev = None
+
+
+class SkipList(object):
+    """
+    Indexable skip list of unique keys - the (score, member) pairs of a
+    sorted set - modelled on the one Redis uses for sorted sets: every link
+    records how many nodes it skips, so positions can be found, and nodes
+    found by position, in O(log N).
+    """
+    def __init__(self):
+        self.head = _Node(None, MAXLEVEL)
+        self.tail = None
+        self.level = 1
+        self.length = 0
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        x = self.head.next[0]
+        while x is not None:
+            yield x.key
+            x = x.next[0]
+
+    def __reversed__(self):
+        x = self.tail
+        while x is not None:
+            yield x.key
+            x = x.prev
+
+    def _level(self):
+        level = 1
+        while random() < P and level < MAXLEVEL:
+            level += 1
+        return level
+
+    def insert(self, key):
+        """
+        Insert a key, which must not be present already.
+        """
+        update = [None] * MAXLEVEL
+        rank = [0] * MAXLEVEL
+        x = self.head
+        for i in xrange(self.level - 1, -1, -1):
+            rank[i] = 0 if i == self.level - 1 else rank[i + 1]
+            while x.next[i] is not None and x.next[i].key < key:
+                rank[i] += x.span[i]
+                x = x.next[i]
+            update[i] = x
+        level = self._level()
+        if level > self.level:
+            for i in xrange(self.level, level):
+                update[i] = self.head
+                self.head.span[i] = self.length
+            self.level = level
+        x = _Node(key, level)
+        for i in xrange(level):
+            x.next[i] = update[i].next[i]
+            update[i].next[i] = x
+            x.span[i] = update[i].span[i] - (rank[0] - rank[i])
+            update[i].span[i] = rank[0] - rank[i] + 1
+        for i in xrange(level, self.level):
+            update[i].span[i] += 1
+        x.prev = update[0] if update[0] is not self.head else None
+        if x.next[0] is not None:
+            x.next[0].prev = x
+        else:
+            self.tail = x
+        self.length += 1
+
+    def remove(self, key):
+        """
+        Remove a key, returning whether it was found.
+        """
+        update = [None] * MAXLEVEL
+        x = self.head
+        for i in xrange(self.level - 1, -1, -1):
+            while x.next[i] is not None and x.next[i].key < key:
+                x = x.next[i]
+            update[i] = x
+        x = x.next[0]
+        if x is None or x.key != key:
+            return False
+        for i in xrange(self.level):
+            if update[i].next[i] is x:
+                update[i].span[i] += x.span[i] - 1
+                update[i].next[i] = x.next[i]
+            else:
+                update[i].span[i] -= 1
+        if x.next[0] is not None:
+            x.next[0].prev = x.prev
+        else:
+            self.tail = x.prev
+        while self.level > 1 and self.head.next[self.level - 1] is None:
+            self.level -= 1
+        self.length -= 1
+        return True
+
+    def rank(self, key):
+        """
+        Return the 0-based position of a key, or None.
+        """
+        rank = 0
+        x = self.head
+        for i in xrange(self.level - 1, -1, -1):
+            while x.next[i] is not None and x.next[i].key <= key:
+                rank += x.span[i]
+                x = x.next[i]
+            if x is not self.head and x.key == key:
+                return rank - 1
+        return None
+
+    def bisect(self, score, right=False):
+        """
+        Return the position of the first key whose score is not lower than
+        `score` (or higher than it, with `right`), and its node (or None
+        if there isn't one).
+        """
+        rank = 0
+        x = self.head
+        for i in xrange(self.level - 1, -1, -1):
+            while x.next[i] is not None and (x.next[i].key[0] <= score if right else x.next[i].key[0] < score):
+                rank += x.span[i]
+                x = x.next[i]
+        return rank, x.next[0]
+
+    def seek(self, key):
+        """
+        Return the first node whose key is not lower than `key`, or None.
+        """
+        x = self.head
+        for i in xrange(self.level - 1, -1, -1):
+            while x.next[i] is not None and x.next[i].key < key:
+                x = x.next[i]
+        return x.next[0]
+
+    def node(self, rank):
+        """
+        Return the node at a 0-based position, or None.
+        """
+        if not 0 <= rank < self.length:
+            return None
+        rank += 1
+        traversed = 0
+        x = self.head
+        for i in xrange(self.level - 1, -1, -1):
+            while x.next[i] is not None and traversed + x.span[i] <= rank:
+                traversed += x.span[i]
+                x = x.next[i]
+            if traversed == rank:
+                return x
+        return None
 
 
 class SortedSet(object):
@@ -11,17 +181,16 @@ class SortedSet(object):
     1. A multimap from score to member
     2. A dictionary from member to score.
 
-    The multimap is implemented using a sorted list of (score, member) pairs. The bisect operations
-    used to maintain the multimap are O(log N), but insertion into and removal from a list are O(N),
-    so insertion and removal O(N). It should be possible to swap in an indexable skip list to get
-    the expected O(log N) behavior.
+    The multimap is an indexable skip list of (score, member) pairs, so
+    insertion, removal, ranking and finding where a range starts are all
+    O(log N), and ranges are read by walking from there.
     """
     def __init__(self):
         """
         Create an empty sorted set.
         """
-        # sorted list of (score, member)
-        self._scores = []
+        # skip list of (score, member)
+        self._scores = SkipList()
         # dictionary from member to score
         self._members = {}
 
@@ -41,7 +210,7 @@ class SortedSet(object):
         return self.__repr__()
 
     def __repr__(self):
-        return "SortedSet({})".format(self._scores)
+        return "SortedSet({})".format(list(self._scores))
 
     def __setitem__(self, member, score):
         """
@@ -64,22 +233,35 @@ class SortedSet(object):
             raise TypeError("Slicing not supported")
         return self._members[member]
 
+    def __getstate__(self):
+        # pickled as its pairs, as the links between nodes would be followed
+        # as deep as the list is long
+        return list(self._scores)
+
+    def __setstate__(self, pairs):
+        self.__init__()
+        for score, member in pairs:
+            self.insert(member, score)
+
     def __iter__(self):
-        return self._scores.__iter__()
+        return iter(self._scores)
 
     def __reversed__(self):
-        return self._scores.__reversed__()
+        return reversed(self._scores)
 
     def insert(self, member, score):
         """
         Identical to __setitem__, but returns whether a member was
         inserted (True) or updated (False)
         """
-        found = self.remove(member)
-        index = bisect_left(self._scores, (score, member))
-        self._scores.insert(index, (score, member))
+        old = self._members.get(member)
+        if old is not None:
+            if old == score:
+                return False
+            self._scores.remove((old, member))
+        self._scores.insert((score, member))
         self._members[member] = score
-        return not found
+        return old is None
 
     def remove(self, member):
         """
@@ -87,12 +269,22 @@ class SortedSet(object):
         """
         if member not in self:
             return False
-        score = self._members[member]
-        score_index = bisect_left(self._scores, (score, member))
-        del self._scores[score_index]
-        del self._members[member]
+        score = self._members.pop(member)
+        self._scores.remove((score, member))
         return True
 
+    def members(self):
+        """
+        Return a list of the members, in no particular order.
+        """
+        return self._members.keys()
+
+    def iteritems(self):
+        """
+        Iterate over (member, score) pairs, in no particular order.
+        """
+        return self._members.iteritems()
+
     def score(self, member):
         """
         Identical to __getitem__, but returns None instead of raising
@@ -107,40 +299,53 @@ class SortedSet(object):
         score = self._members.get(member)
         if score is None:
             return None
-        return bisect_left(self._scores, (score, member))
+        return self._scores.rank((score, member))
 
     def range(self, start, end, desc=False):
         """
-        Return (score, member) pairs between min and max ranks.
+        Return (score, member) pairs between min and max ranks, which
+        count from the end when negative, as in Redis. Only the pairs
+        in range are visited.
         """
-        if not self:
+        length = len(self)
+        if start < 0:
+            start = max(start + length, 0)
+        if end < 0:
+            end += length
+        end = min(end, length - 1)
+        if start > end:
             return []
-
         if desc:
-            return reversed(self._scores[len(self) - end - 1:len(self) - start])
+            x = self._scores.node(length - 1 - start)
         else:
-            return self._scores[start:end + 1]
+            x = self._scores.node(start)
+        result = []
+        for i in xrange(end - start + 1):
+            result.append(x.key)
+            x = x.prev if desc else x.next[0]
+        return result
+
+    def scorerank(self, score, right=False):
+        """
+        Return the number of members with a lower score (or, with `right`,
+        a lower or equal one) - the rank at which a score range starts or
+        ends.
+        """
+        return self._scores.bisect(score, right)[0]
 
     def scorerange(self, start, end):
         """
         Return (score, member) pairs between min and max scores.
         """
-        if not self:
-            return []
-
-        left = bisect_left(self._scores, (start,))
-        right = bisect_right(self._scores, (end,))
-
-        # end is inclusive
-        while right < len(self) and self._scores[right][0] == end:
-            right += 1
-
-        return self._scores[left:right]
+        result = []
+        x = self._scores.bisect(start)[1]
+        while x is not None and x.key[0] <= end:
+            result.append(x.key)
+            x = x.next[0]
+        return result
 
     def min_score(self):
-        return self._scores[0][0]
+        return self._scores.head.next[0].key[0]
 
     def max_score(self):
-        return self._scores[-1][0]
-
-
+        return self._scores.tail.key[0]
@@ -0,0 +1,30 @@
+# vim :set ts=4 sw=4 sts=4 et :
+"""
+In-process server fixture shared by the tests that call command handlers
+directly instead of going through a socket.
+
+A test module imports `setup`, `teardown` and `call` from here so nose runs
+them as its module fixtures, and reaches the server and its client as
+`local.server` and `local.c`.
+"""
+
+import sys, shutil, tempfile
+
+sys.path.append('..')
+
+from miniredis.server import RedisServer, RedisConnection
+
+path = server = c = None
+
+def setup():
+    global path, server, c
+    path = tempfile.mkdtemp()
+    server = RedisServer(port=6420, db_path=path)
+    c = RedisConnection(None)
+    server.select(c, 0)
+
+def teardown():
+    shutil.rmtree(path)
+
+def call(*args):
+    return server.call(c, list(args))
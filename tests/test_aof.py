@@ -0,0 +1,89 @@
+# vim :set ts=4 sw=4 sts=4 et :
+import os, sys, signal, time, shutil, tempfile
+from nose.tools import ok_, eq_, istest
+
+sys.path.append('..')
+
+import miniredis.server
+from miniredis.client import RedisClient
+
+pid = None
+path = None
+
+def launch():
+    global pid
+    pid = miniredis.server.fork(port=6410, db_path=path, appendonly=True)
+    time.sleep(1)
+    return RedisClient(port=6410)
+
+def kill():
+    os.kill(pid, signal.SIGKILL)
+    os.waitpid(pid, 0)
+
+def setup_module(module):
+    global path
+    path = tempfile.mkdtemp()
+
+def teardown_module(module):
+    shutil.rmtree(path)
+
+
+def test_replay():
+    r = launch()
+    eq_(r.config('get', 'appendonly'), ['appendonly', 'yes'])
+    eq_(r.config('set', 'appendfsync', 'always'), 'OK')
+    eq_(r.set('test:key', 'value'), 'OK')
+    eq_(r.incr('test:counter'), 1)
+    eq_(r.incr('test:counter'), 2)
+    eq_(r.rpush('test:list', 'a', 'b'), 2)
+    eq_(r.select(1), 'OK')
+    eq_(r.setex('test:volatile', 100, 'value'), 1)
+    kill()
+    r = launch()
+    eq_(r.get('test:key'), 'value')
+    eq_(r.get('test:counter'), '2')
+    eq_(r.lrange('test:list', 0, -1), ['a', 'b'])
+    eq_(r.select(1), 'OK')
+    ok_(0 < r.ttl('test:volatile') <= 100)
+    kill()
+
+def test_rewrite():
+    r = launch()
+    for i in range(10):
+        r.set('test:key', str(i))
+    eq_(r.bgrewriteaof(), 'Background append only file rewriting started')
+    time.sleep(0.5)
+    eq_(r.set('test:after', 'value'), 'OK')
+    kill()
+    r = launch()
+    eq_(r.get('test:key'), '9')
+    eq_(r.get('test:after'), 'value')
+    kill()
+
+def test_truncated():
+    with open(os.path.join(path, 'appendonly.aof'), 'ab') as f:
+        f.write('*3\r\n$3\r\nSET\r\n$4\r\ntest')
+    r = launch()
+    eq_(r.get('test:after'), 'value')
+    kill()
+
+def test_enable_at_runtime():
+    pid = miniredis.server.fork(port=6411, db_path=path)
+    time.sleep(1)
+    r = RedisClient(port=6411)
+    eq_(r.flushall(), 'OK')
+    eq_(r.set('test:k1', '1'), 'OK')
+    eq_(r.config('set', 'appendonly', 'yes'), 'OK')
+    eq_(r.set('test:k2', '2'), 'OK')
+    eq_(r.config('set', 'appendonly', 'no'), 'OK')
+    eq_(r.set('test:k3', '3'), 'OK')
+    # the stale log is rewritten, not replayed
+    eq_(r.config('set', 'appendonly', 'yes'), 'OK')
+    eq_(r.mget('test:k1', 'test:k2', 'test:k3'), ['1', '2', '3'])
+    eq_(r.set('test:k4', '4'), 'OK')
+    time.sleep(0.5)
+    os.kill(pid, signal.SIGKILL)
+    os.waitpid(pid, 0)
+    r = launch()
+    eq_(r.mget('test:k1', 'test:k2', 'test:k3', 'test:k4'), ['1', '2', '3', '4'])
+    kill()
@@ -0,0 +1,118 @@
+# vim :set ts=4 sw=4 sts=4 et :
+import os, sys, signal, socket, time
+from nose.tools import ok_, eq_, istest
+
+sys.path.append('..')
+
+import miniredis.server
+from miniredis.client import RedisClient
+from miniredis.cluster import ShardRouter, key_shard
+from miniredis.server import RedisConnection
+from miniredis.poller import Poller
+from miniredis.protocol import NIL, encode_request
+
+pid = None
+r = None
+
+def setup_module(module):
+    global pid, r
+    pid = miniredis.server.fork(workers=2, port=6400, db_path=None)
+    print("Launched sharded server with pid %d." % pid)
+    time.sleep(1)
+    r = RedisClient(port=6400)
+
+def teardown_module(module):
+    global pid
+    os.kill(pid, signal.SIGTERM)
+    os.waitpid(pid, 0)
+    print("Stopped server.")
+
+
+def test_key_shard():
+    eq_(key_shard('{user1}:name', 4), key_shard('user1', 4))
+
+def test_routing():
+    keys = ['test:key%d' % i for i in range(20)]
+    for k in keys:
+        eq_(r.set(k, k), 'OK')
+    for k in keys:
+        eq_(r.get(k), k)
+    eq_(r.mget(*(keys + ['test:nothere'])), keys + [None])
+    eq_(r.mset(*[x for k in keys for x in (k, k + ':v')]), 'OK')
+    eq_(r.mget(*keys), [k + ':v' for k in keys])
+    eq_(sorted(r.keys('test:*')), sorted(keys))
+    eq_(r.delete(*keys), 20)
+    eq_(r.keys('test:*'), [])
+
+def test_select():
+    eq_(r.select(1), 'OK')
+    eq_(r.set('test:key', 'one'), 'OK')
+    eq_(r.select(0), 'OK')
+    eq_(r.get('test:key'), None)
+    eq_(r.select(1), 'OK')
+    eq_(r.get('test:key'), 'one')
+    eq_(r.flushdb(), 'OK')
+    eq_(r.select(0), 'OK')
+
+def test_randomkey():
+    eq_(r.select(2), 'OK')
+    eq_(r.randomkey(), None)
+    eq_(r.set('test:key', 'one'), 'OK')
+    eq_(r.randomkey(), 'test:key')
+    eq_(r.flushdb(), 'OK')
+    eq_(r.select(0), 'OK')
+
+def test_crossslot():
+    # with two shards, test:a lives on the first and test:d on the second
+    eq_(r.set('test:a', 'x'), 'OK')
+    try:
+        r.rename('test:a', 'test:d')
+        ok_(False)
+    except Exception, e:
+        ok_(str(e).startswith('CROSSSLOT'))
+    eq_(r.get('test:a'), 'x')
+    eq_(r.set('{test}:a', 'x'), 'OK')
+    eq_(r.rename('{test}:a', '{test}:b'), 'OK')
+
+def test_slow_shard():
+    # a shard that never answers, next to a real one
+    stalled = socket.socket()
+    stalled.bind(('127.0.0.1', 0))
+    stalled.listen(1)
+    shard = miniredis.server.fork(port=6409, db_path=None)
+    try:
+        router = ShardRouter([stalled.getsockname(), ('127.0.0.1', 6409)], port=6408)
+        router.poller = Poller()
+        router.listener = socket.socket()
+        router.load()
+        peer = stalled.accept()[0]
+        slow, fast = RedisConnection(None), RedisConnection(None)
+        for client, key in ((slow, 'test:a'), (fast, 'test:d')):
+            router.select(client, 0)
+            client.parser.feed(encode_request(['GET', key]))
+            router.process(client)
+        for i in xrange(10):
+            router.process_events(0.05)
+        eq_(''.join(fast.pieces), NIL)
+        eq_(slow.pieces, [])
+        # requests waiting on a shard that goes away are failed
+        peer.close()
+        router.process_events(0.5)
+        ok_(''.join(slow.pieces).startswith('-ERR shard'))
+    finally:
+        os.kill(shard, signal.SIGKILL)
+        os.waitpid(shard, 0)
+        stalled.close()
+
+def test_scan():
+    keys = ['test:scan%d' % i for i in range(30)]
+    for k in keys:
+        r.set(k, k)
+    seen, cursor = [], '0'
+    while True:
+        cursor, found = r.scan(cursor, 'MATCH', 'test:scan*', 'COUNT', '7')
+        seen.extend(found)
+        if cursor == '0':
+            break
+    eq_(sorted(seen), sorted(keys))
+    r.delete(*keys)
@@ -0,0 +1,43 @@
+# vim :set ts=4 sw=4 sts=4 et :
+import sys, time
+from nose.tools import ok_, eq_
+
+sys.path.append('..')
+
+import local
+from local import setup, teardown, call
+from miniredis.protocol import EMPTY_SCALAR
+
+
+def due(key):
+    """Make a key due without letting the active expire cycle reap it"""
+    local.server.timeouts[(local.c.db, key)] = time.time() - 1
+
+
+def test_setnx():
+    call('SET', 'k', 'old')
+    due('k')
+    eq_(call('SETNX', 'k', 'new'), 1)
+    eq_(call('GET', 'k'), 'new')
+    eq_(call('TTL', 'k'), -1)
+    call('DEL', 'k')
+
+def test_type():
+    call('RPUSH', 'l', 'a')
+    due('l')
+    eq_(call('TYPE', 'l').message, 'none')
+    ok_('l' not in local.c.table)
+
+def test_dump():
+    call('SET', 'k', 'v')
+    due('k')
+    eq_(call('DUMP', 'k'), EMPTY_SCALAR)
+
+def test_keys():
+    call('SET', 'a:1', 'x')
+    call('SET', 'a:2', 'x')
+    due('a:2')
+    eq_(call('KEYS', 'a:*'), ['a:1'])
+    eq_(call('KEYS', 'a:2'), [])
+    ok_('a:2' not in local.c.table)
+    call('DEL', 'a:1')
@@ -0,0 +1,42 @@
+# vim :set ts=4 sw=4 sts=4 et :
+import sys
+from nose.tools import ok_, eq_
+
+sys.path.append('..')
+
+import local
+from local import setup, teardown, call
+from miniredis.protocol import RedisError
+
+
+def test_hmset():
+    eq_(call('HMSET', 'h', 'a', '1', 'b', '2'), True)
+    eq_(call('HMSET', 'h', 'b', '3', 'c', '4'), True)
+    eq_(call('HMGET', 'h', 'a', 'b', 'c', 'd'), ['1', '3', '4', None])
+    eq_(call('HMGET', 'nothere', 'a'), [None])
+    ok_(isinstance(call('HMSET', 'h', 'a', '1', 'b'), RedisError))
+    call('SET', 's', 'x')
+    ok_(isinstance(call('HMSET', 's', 'a', '1'), RedisError))
+    call('DEL', 'h', 's')
+
+def test_fields():
+    eq_(call('HSET', 'h', 'a', '1'), 1)
+    eq_(call('HSET', 'h', 'a', '2'), 0)
+    eq_(call('HGET', 'h', 'a'), '2')
+    eq_(call('HGET', 'h', 'x'), None)
+    eq_(call('HEXISTS', 'h', 'a'), 1)
+    eq_(call('HEXISTS', 'nothere', 'a'), 0)
+    eq_(call('HINCRBY', 'h', 'n', '5'), 5)
+    eq_(call('HINCRBY', 'h', 'n', '-7'), -2)
+    ok_(isinstance(call('HINCRBY', 'h', 'a', 'x'), RedisError))
+    call('HSET', 'h', 's', 'text')
+    ok_(isinstance(call('HINCRBY', 'h', 's', '1'), RedisError))
+    eq_(call('HLEN', 'h'), 3)
+    eq_(sorted(call('HKEYS', 'h')), ['a', 'n', 's'])
+    eq_(sorted(call('HVALS', 'h')), ['-2', '2', 'text'])
+    eq_(call('HDEL', 'h', 'a', 'x'), 1)
+    eq_(call('HDEL', 'h', 'n', 's'), 2)
+    ok_('h' not in local.c.table)
+    call('SET', 's', 'x')
+    ok_(isinstance(call('HGET', 's', 'a'), RedisError))
+    call('DEL', 's')
@@ -0,0 +1,196 @@
+# vim :set ts=4 sw=4 sts=4 et :
+import os, sys, time, shutil, tempfile, cPickle
+from nose.tools import ok_, eq_, raises, with_setup
+
+sys.path.append('..')
+
+from miniredis.haystack import Haystack, FILE_HEADER
+
+path = None
+
+def setup():
+    global path
+    path = tempfile.mkdtemp()
+
+def teardown():
+    shutil.rmtree(path)
+
+def clean():
+    for name in os.listdir(path):
+        os.unlink(os.path.join(path, name))
+
+
+@with_setup(clean)
+def test_read_after_write():
+    h = Haystack(path)
+    for i in xrange(100):
+        h['k%d' % i] = 'x' * i
+        # every read sees the appends made before it
+        eq_(h['k%d' % i], 'x' * i)
+    h.update([('a', {'b': 1}), ('k5', [1, 2])])
+    eq_(h['a'], {'b': 1})
+    eq_(h['k5'], [1, 2])
+    eq_(len(h), 101)
+    eq_(sorted(h.iteritems())[:2], [('a', {'b': 1}), ('k0', '')])
+
+
+@with_setup(clean)
+def test_reopen():
+    h = Haystack(path)
+    h['a'] = 1
+    h['a'] = 2
+    h['b'] = 3
+    del h['b']
+    h.commit()
+    h = Haystack(path)
+    eq_(h.keys(), ['a'])
+    eq_(h['a'], 2)
+
+
+@with_setup(clean)
+def test_compact():
+    h = Haystack(path)
+    for i in xrange(10):
+        h['a'] = 'x' * 100
+    view = h.view('a')
+    h.compact(background=False)
+    eq_(os.path.getsize(h.cache), FILE_HEADER.size + h._footprint('a', 100 + 7))
+    eq_(h['a'], 'x' * 100)
+    # views into the old file stay valid
+    eq_(len(str(view)), len(h.view('a')))
+
+
+@with_setup(clean)
+def test_compact_catch_up():
+    h = Haystack(path)
+    h.update([('a', 1), ('b', 2), ('c', 3)])
+    # what compact() does before handing over to a background thread
+    h._remap()
+    h.compacting = set()
+    snapshot, source = h._index.copy(), h.map
+    h['a'] = 4
+    del h['b']
+    h['d'] = 5
+    h._compact(snapshot, source)
+    eq_(h.compacting, None)
+    eq_(h.garbage, 0)
+    eq_(sorted(h.iteritems()), [('a', 4), ('c', 3), ('d', 5)])
+    eq_(sorted(Haystack(path).iteritems()), [('a', 4), ('c', 3), ('d', 5)])
+
+
+@with_setup(clean)
+def test_compact_failure():
+    h = Haystack(path)
+    h.update([('a', 1), ('b', 2)])
+    h._remap()
+    h.compacting = set()
+    # a source that can't be read fails the copy half-way
+    h._compact(h._index.copy(), None)
+    eq_(h.compacting, None)
+    ok_(not os.path.exists(h.temp))
+    eq_(sorted(h.iteritems()), [('a', 1), ('b', 2)])
+    ok_(h.compact(background=False))
+    eq_(sorted(Haystack(path).iteritems()), [('a', 1), ('b', 2)])
+
+@with_setup(clean)
+def test_garbage_ratio():
+    h = Haystack(path)
+    h.compactmin = 0
+    h['a'] = 'x' * 1000
+    h.commit()
+    ok_(h.compacting is None)
+    h['a'] = 'x' * 1000
+    h['a'] = 'y' * 1000
+    eq_(h.garbage, 2 * h._footprint('a', len(h.view('a'))))
+    h.commit()
+    # the background compaction can't finish before the lock is released
+    for i in xrange(100):
+        if h.garbage == 0:
+            break
+        time.sleep(0.01)
+    eq_(os.path.getsize(h.cache), FILE_HEADER.size + h._footprint('a', len(h.view('a'))))
+    eq_(h['a'], 'y' * 1000)
+
+
+@with_setup(clean)
+def test_recover():
+    h = Haystack(path)
+    h.update([('a', 1), ('b', 2)])
+    h.commit()
+    ok_(not os.path.exists(h.index))
+    # the records are replayed from the data file alone
+    h = Haystack(path)
+    eq_(sorted(h.iteritems()), [('a', 1), ('b', 2)])
+    for i in xrange(2000):
+        h['k%d' % i] = i
+    h.commit()
+    ok_(os.path.exists(h.index))
+    eq_(h.records, 0)
+    h['c'] = 3
+    del h['k0']
+    h.commit()
+    h = Haystack(path)
+    eq_(h['c'], 3)
+    ok_('k0' not in h)
+    eq_(len(h), 2002)
+
+
+@with_setup(clean)
+def test_torn_write():
+    h = Haystack(path)
+    h['a'] = 1
+    h['b'] = 'x' * 100
+    h.commit()
+    size = os.path.getsize(h.cache)
+    with open(h.cache, 'r+b') as f:
+        f.truncate(size - 10)
+    h = Haystack(path)
+    eq_(h.keys(), ['a'])
+    eq_(os.path.getsize(h.cache), FILE_HEADER.size + h._footprint('a', len(h.view('a'))))
+    h['b'] = 2
+    h.commit()
+    eq_(sorted(Haystack(path).iteritems()), [('a', 1), ('b', 2)])
+
+
+@with_setup(clean)
+def test_stale_checkpoint():
+    h = Haystack(path)
+    for i in xrange(2000):
+        h['k%d' % i] = i
+    h.commit()
+    checkpoint = open(h.index, 'rb').read()
+    for i in xrange(1000):
+        del h['k%d' % i]
+    h.compact(background=False)
+    # as if the checkpoint that follows a compaction had been lost
+    open(h.index, 'wb').write(checkpoint)
+    h = Haystack(path)
+    eq_(len(h), 1000)
+    eq_(h['k1999'], 1999)
+
+
+@with_setup(clean)
+def test_old_format():
+    # no file or record headers, and a pickled index
+    data = cPickle.dumps({'b': 1}, 2)
+    with open(os.path.join(path, 'haystack.bin'), 'wb') as f:
+        f.write(data)
+    with open(os.path.join(path, 'haystack.idx'), 'wb') as f:
+        f.write(cPickle.dumps({'a': [0, len(data), 0]}))
+    h = Haystack(path)
+    eq_(h['a'], {'b': 1})
+    h['c'] = 2
+    h.commit()
+    h._checkpoint()
+    h['d'] = 3
+    h.commit()
+    h = Haystack(path)
+    eq_(sorted(h.iteritems()), [('a', {'b': 1}), ('c', 2), ('d', 3)])
+    h.compact(background=False)
+    eq_(sorted(Haystack(path).iteritems()), [('a', {'b': 1}), ('c', 2), ('d', 3)])
+
+
+@raises(KeyError)
+@with_setup(clean)
+def test_missing():
+    Haystack(path)['nothere']
@@ -73,3 +73,66 @@ def test_keys():
     eq_(r.set('test:key','value'), 'OK')
     eq_(r.keys('*:key'), ['test:key'])
 
+def test_pexpire():
+    eq_(r.set('test:volatile','value'), 'OK')
+    eq_(r.pexpire('test:volatile', 100), 1)
+    ok_(0 < r.pttl('test:volatile') <= 100)
+    time.sleep(0.3)
+    eq_(r.exists('test:volatile'), 0)
+    eq_(r.pttl('test:volatile'), -2)
+
+def test_persist():
+    eq_(r.set('test:volatile','value'), 'OK')
+    eq_(r.expire('test:volatile', 10), 1)
+    eq_(r.persist('test:volatile'), 1)
+    eq_(r.persist('test:volatile'), 0)
+    eq_(r.ttl('test:volatile'), -1)
+    eq_(r.delete('test:volatile'), 1)
+
+def test_rename():
+    eq_(r.set('test:old','value'), 'OK')
+    eq_(r.expire('test:old', 10), 1)
+    eq_(r.rename('test:old', 'test:new'), 'OK')
+    eq_(r.ttl('test:old'), -2)
+    ok_(0 < r.ttl('test:new') <= 10)
+    eq_(r.get('test:new'), 'value')
+    eq_(r.delete('test:new'), 1)
+    # renaming a key onto itself keeps its TTL
+    eq_(r.set('test:self', 'value'), 'OK')
+    eq_(r.expire('test:self', 10), 1)
+    eq_(r.rename('test:self', 'test:self'), 'OK')
+    ok_(0 < r.ttl('test:self') <= 10)
+    eq_(r.delete('test:self'), 1)
+    try:
+        r.renamenx('test:nosuch', 'test:new')
+        ok_(False)
+    except Exception, e:
+        ok_('no such key' in str(e))
+    eq_(r.exists('test:new'), False)
+
+
+def test_randomkey():
+    eq_(r.select(3), 'OK')
+    eq_(r.randomkey(), None)
+    eq_(r.set('test:key', 'value'), 'OK')
+    eq_(r.randomkey(), 'test:key')
+    eq_(r.delete('test:key'), 1)
+    eq_(r.select(0), 'OK')
+
+def test_errors():
+    try:
+        r.nosuchcommand()
+        ok_(False)
+    except Exception, e:
+        eq_(str(e), "ERR unknown command 'nosuchcommand'")
+    try:
+        r.get('a', 'b')
+        ok_(False)
+    except Exception, e:
+        eq_(str(e), "ERR wrong number of arguments for 'get' command")
+    # the connection survives
+    eq_(r.ping(), 'PONG')
+
+def test_command():
+    eq_(r.command('info', 'get')[0][:2], ['get', 2])
+    eq_(r.command('getkeys', 'del', 'a', 'b'), ['a', 'b'])
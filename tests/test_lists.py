@@ -0,0 +1,107 @@
+# vim :set ts=4 sw=4 sts=4 et :
+import os, sys, signal, time
+from nose.tools import ok_, eq_, istest
+
+sys.path.append('..')
+
+import miniredis.server
+from miniredis.client import RedisClient
+
+pid = None
+r = None
+
+def setup_module(module):
+    global pid, r
+    pid = miniredis.server.fork()
+    print("Launched server with pid %d." % pid)
+    time.sleep(1)
+    r = RedisClient()
+
+def teardown_module(module):
+    global pid
+    os.kill(pid, signal.SIGKILL)
+    print("Killed server.")
+
+
+def send(client, *args):
+    """Send a command without waiting for its reply"""
+    client.sock.send('*%d\r\n' % len(args) + ''.join('$%d\r\n%s\r\n' % (len(a), a) for a in args))
+
+
+def test_push():
+    r.delete('test:list')
+    eq_(r.rpush('test:list', 'b', 'c'), 2)
+    eq_(r.lpush('test:list', 'a', 'z'), 4)
+    eq_(r.lrange('test:list', '0', '-1'), ['z', 'a', 'b', 'c'])
+
+def test_pop():
+    r.delete('test:list')
+    r.rpush('test:list', 'a', 'b')
+    eq_(r.lpop('test:list'), 'a')
+    eq_(r.rpop('test:list'), 'b')
+    # emptied lists go away
+    eq_(r.exists('test:list'), 0)
+    eq_(r.type('test:list'), 'none')
+
+def test_rpoplpush():
+    r.delete('test:src', 'test:dst')
+    r.rpush('test:src', 'a')
+    r.rpush('test:src', 'b')
+    eq_(r.rpoplpush('test:src', 'test:dst'), 'b')
+    eq_(r.lrange('test:dst', '0', '-1'), ['b'])
+    eq_(r.rpoplpush('test:nothere', 'test:dst'), None)
+    eq_(r.rpoplpush('test:src', 'test:dst'), 'a')
+    eq_(r.exists('test:src'), 0)
+
+def test_blpop():
+    r.delete('test:list', 'test:other')
+    r.rpush('test:other', 'x')
+    eq_(r.blpop('test:list', 'test:other', '1'), ['test:other', 'x'])
+    first, second = RedisClient(), RedisClient()
+    send(first, 'BLPOP', 'test:list', '0')
+    time.sleep(0.1)
+    send(second, 'BRPOP', 'test:other', 'test:list', '0')
+    time.sleep(0.1)
+    ok_('blocked_clients:2' in r.info('clients'))
+    r.rpush('test:list', 'one')
+    eq_(first.parse_response(), ['test:list', 'one'])
+    r.rpush('test:list', 'two')
+    eq_(second.parse_response(), ['test:list', 'two'])
+    eq_(r.exists('test:list'), 0)
+    # commands sent while blocked run once the client is served
+    send(first, 'BLPOP', 'test:list', '0')
+    send(first, 'PING')
+    time.sleep(0.1)
+    r.lpush('test:list', 'three')
+    eq_(first.parse_response(), ['test:list', 'three'])
+    eq_(first.parse_response(), 'PONG')
+
+def test_timeout():
+    start = time.time()
+    ok_(not r.blpop('test:nothere', '0.2'))
+    ok_(0.2 <= time.time() - start < 0.5)
+    eq_(r.brpoplpush('test:nothere', 'test:dst', '0.1'), None)
+    try:
+        r.blpop('test:nothere', '-1')
+        ok_(False)
+    except Exception, e:
+        ok_('negative' in str(e))
+    try:
+        r.brpop('test:nothere')
+        ok_(False)
+    except Exception, e:
+        ok_('wrong number of arguments' in str(e))
+
+def test_brpoplpush():
+    r.delete('test:src', 'test:dst')
+    waiter, chained = RedisClient(), RedisClient()
+    send(waiter, 'BRPOPLPUSH', 'test:src', 'test:dst', '0')
+    send(chained, 'BLPOP', 'test:dst', '0')
+    time.sleep(0.1)
+    r.lpush('test:src', 'job')
+    eq_(waiter.parse_response(), 'job')
+    # the element moved to test:dst is handed on in turn
+    eq_(chained.parse_response(), ['test:dst', 'job'])
+    eq_(r.exists('test:src'), 0)
+    eq_(r.exists('test:dst'), 0)
+    ok_('blocked_clients:0' in r.info('clients'))
@@ -0,0 +1,80 @@
+# vim :set ts=4 sw=4 sts=4 et :
+import sys, cPickle
+from collections import deque
+from nose.tools import ok_, eq_, raises
+
+sys.path.append('..')
+
+import local
+from local import setup, teardown, call
+from miniredis.packed import PackedList, PackedHash
+from miniredis.protocol import encode
+
+
+def test_list():
+    items = PackedList(['b'])
+    items.append('c')
+    items.appendleft('a')
+    items.extend(['d', 'e'])
+    items.extendleft(['y', 'z'])
+    eq_(list(items), ['z', 'y', 'a', 'b', 'c', 'd', 'e'])
+    eq_(items.popleft(), 'z')
+    eq_(items.pop(), 'e')
+    eq_(len(items), 5)
+    eq_(list(cPickle.loads(cPickle.dumps(items, 2))), list(items))
+
+@raises(IndexError)
+def test_empty_list():
+    PackedList().pop()
+
+def test_hash():
+    fields = PackedHash([('a', '1'), ('b', '2')])
+    eq_(fields.update([('b', '3'), ('c', '4'), ('c', '5')]), 1)
+    eq_(dict(fields.iteritems()), {'a': '1', 'b': '3', 'c': '5'})
+    eq_(fields['a'], '1')
+    eq_(fields.get('x'), None)
+    ok_('c' in fields)
+    # values are not fields
+    ok_('1' not in fields)
+    eq_(fields.pop('a'), '1')
+    eq_(fields.pop('a', None), None)
+    eq_(len(fields), 2)
+    chunks = []
+    encode(chunks.append, fields.flat())
+    eq_(''.join(chunks), '*4\r\n$1\r\nb\r\n$1\r\n3\r\n$1\r\nc\r\n$1\r\n5\r\n')
+
+def test_conversion():
+    call('CONFIG', 'SET', 'hash-max-ziplist-entries', '3')
+    call('CONFIG', 'SET', 'list-max-ziplist-entries', '3')
+    call('HMSET', 'h', 'a', '1', 'b', '2')
+    call('RPUSH', 'l', 'a', 'b', 'c')
+    ok_(isinstance(local.c.table['h'], PackedHash))
+    ok_(isinstance(local.c.table['l'], PackedList))
+    call('HSET', 'h', 'c', '3')
+    call('HSET', 'h', 'd', '4')
+    call('LPUSH', 'l', 'z')
+    ok_(isinstance(local.c.table['h'], dict))
+    ok_(isinstance(local.c.table['l'], deque))
+    eq_(call('HMGET', 'h', 'a', 'd'), ['1', '4'])
+    eq_(call('LRANGE', 'l', '0', '-1'), ['z', 'a', 'b', 'c'])
+    call('CONFIG', 'SET', 'hash-max-ziplist-entries', '128')
+    call('CONFIG', 'SET', 'list-max-ziplist-entries', '128')
+    # and so do long values
+    call('HSET', 'h2', 'a', 'x' * 65)
+    call('RPUSH', 'l2', 'x' * 65)
+    ok_(isinstance(local.c.table['h2'], dict))
+    ok_(isinstance(local.c.table['l2'], deque))
+    call('DEL', 'h', 'l', 'h2', 'l2')
+
+def test_restore():
+    call('HSET', 'h', 'a', '1')
+    call('RPUSH', 'l', 'a')
+    call('HSET', 'big', 'a', 'x' * 100)
+    eq_(call('SAVE'), True)
+    local.server.tables.clear()
+    table = local.server.load_table(0)
+    ok_(isinstance(table['h'], PackedHash))
+    ok_(isinstance(table['l'], PackedList))
+    ok_(isinstance(table['big'], dict))
+    eq_(dict(table['h'].iteritems()), {'a': '1'})
+    call('DEL', 'h', 'l', 'big')
@@ -0,0 +1,75 @@
+# vim :set ts=4 sw=4 sts=4 et :
+import sys
+from nose.tools import ok_, eq_
+
+sys.path.append('..')
+
+from miniredis.pattern import match, matcher, literal_prefix, Table, CACHE_SIZE, _cache
+
+
+def test_match():
+    for pattern, name, expected in [
+        ('*', '', True),
+        ('h?llo', 'hello', True),
+        ('h?llo', 'hllo', False),
+        ('h*llo', 'heeeello', True),
+        ('h[ae]llo', 'hallo', True),
+        ('h[ae]llo', 'hillo', False),
+        ('h[^e]llo', 'hallo', True),
+        ('h[^e]llo', 'hello', False),
+        ('h[a-b]llo', 'hbllo', True),
+        ('h[b-a]llo', 'hbllo', True),
+        ('h[a-b]llo', 'hcllo', False),
+        ('h\\*llo', 'h*llo', True),
+        ('h\\*llo', 'hello', False),
+        ('h[\\]]llo', 'h]llo', True),
+        ('[]', '', False),
+        ('a[]b', 'ab', False),
+        ('a[^]b', 'axb', True),
+        ('a[bc', 'ab', True),
+        ('a\\', 'a\\', True),
+        ('a.b', 'axb', False),
+        ('a+', 'aa', False),
+        ('*\n', 'x\n', True),
+        ('line*', 'line\nbreak', True),
+        ('exact', 'exact', True),
+        ('exact', 'exactly', False),
+    ]:
+        eq_(match(pattern, name), expected, '%r %r' % (pattern, name))
+
+
+def test_prefix():
+    eq_(literal_prefix('session:*'), ('session:', False))
+    eq_(literal_prefix('a\\*b'), ('a*b', True))
+    eq_(literal_prefix('[ab]*'), ('', False))
+
+
+def test_cache():
+    for i in xrange(CACHE_SIZE + 10):
+        matcher('key%d*' % i)
+    eq_(len(_cache), CACHE_SIZE)
+    ok_('key0*' not in _cache)
+    ok_(matcher('key20*') is matcher('key20*'))
+
+
+def test_index():
+    table = Table(('key%d' % i, i) for i in xrange(100))
+    table['other'] = 1
+    table.set_index(True)
+    eq_(sorted(table.matching('key1?')), ['key%d' % i for i in xrange(10, 20)])
+    del table['key10']
+    table.pop('key11')
+    table['key1x'] = 2
+    table.setdefault('key1y', 3)
+    table.update({'key1z': 4})
+    eq_(list(table.index), sorted(table))
+    eq_(table.matching('key1?'), ['key%d' % i for i in xrange(12, 20)] + ['key1x', 'key1y', 'key1z'])
+    eq_(table.matching('other'), ['other'])
+    table['a*b'] = 5
+    eq_(table.matching(r'a\*b'), ['a*b'])
+    eq_(table.matching(r'a\*c'), [])
+    eq_(sorted(table.matching('*r')), ['other'])
+    table.clear()
+    eq_(table.matching('key*'), [])
+    table['key'] = 1
+    eq_(table.matching('k*'), ['key'])
@@ -0,0 +1,84 @@
+# vim :set ts=4 sw=4 sts=4 et :
+import sys
+from nose.tools import ok_, eq_, raises
+
+sys.path.append('..')
+
+from miniredis.protocol import RequestParser, ReplyParser, ProtocolError, RedisError, \
+    RedisMessage, EMPTY_SCALAR, EMPTY_LIST, BIG_BULK, encode
+
+
+def test_multibulk():
+    p = RequestParser()
+    p.feed('*3\r\n$3\r\nSET\r\n$3\r\nkey\r\n$5\r\nvalue\r\n')
+    eq_(p.get(), ['SET', 'key', 'value'])
+    eq_(p.get(), None)
+    eq_(len(p.buf), 0)
+
+def test_pipeline():
+    p = RequestParser()
+    p.feed(''.join('*2\r\n$3\r\nGET\r\n$2\r\nk%d\r\n' % i for i in range(10)))
+    eq_([args[1] for args in p], ['k%d' % i for i in range(10)])
+
+def test_partial():
+    p = RequestParser()
+    request = '*3\r\n$3\r\nSET\r\n$3\r\nkey\r\n$10\r\nvalue\r\nabc\r\n'
+    for c in request[:-1]:
+        p.feed(c)
+        eq_(p.get(), None)
+    p.feed(request[-1])
+    eq_(p.get(), ['SET', 'key', 'value\r\nabc'])
+
+def test_inline():
+    p = RequestParser()
+    p.feed('PING\r\n\r\nset  key value\n')
+    eq_(p.get(), ['PING'])
+    eq_(p.get(), ['set', 'key', 'value'])
+    eq_(p.get(), None)
+
+def test_empty_multibulk():
+    p = RequestParser()
+    p.feed('*0\r\n*1\r\n$4\r\nPING\r\n')
+    eq_(p.get(), ['PING'])
+
+@raises(ProtocolError)
+def test_bad_length():
+    p = RequestParser()
+    p.feed('*1\r\n$x\r\n')
+    p.get()
+
+@raises(ProtocolError)
+def test_bad_prefix():
+    p = RequestParser()
+    p.feed('*1\r\n:4\r\nPING\r\n')
+    p.get()
+
+def test_encode():
+    out = []
+    encode(out.append, ['a', 1, None, ['b']])
+    eq_(''.join(out), '*4\r\n$1\r\na\r\n:1\r\n$-1\r\n*1\r\n$1\r\nb\r\n')
+    out = []
+    for reply in (True, False, 0, -1, EMPTY_SCALAR, EMPTY_LIST, RedisError('oops')):
+        encode(out.append, reply)
+    eq_(''.join(out), '+OK\r\n:0\r\n:-1\r\n$-1\r\n*-1\r\n-ERR oops\r\n')
+
+def test_encode_big():
+    value = 'x' * BIG_BULK
+    out = []
+    encode(out.append, value)
+    eq_(len(out), 3)
+    ok_(out[1] is value)
+
+def test_replies():
+    p = ReplyParser()
+    data = '+OK\r\n:5\r\n$-1\r\n*2\r\n$1\r\na\r\n*2\r\n:1\r\n$4\r\nb\r\nc\r\n*0\r\n*-1\r\n-WRONGTYPE bad\r\n+QUEUED\r\n'
+    # a byte at a time, so every reply arrives in pieces
+    replies = []
+    for c in data:
+        p.feed(c)
+        replies.extend(p.replies())
+    eq_(replies[:6], [True, 5, None, ['a', [1, 'b\r\nc']], [], EMPTY_LIST])
+    eq_((replies[6].prefix, replies[6].message), ('WRONGTYPE', 'bad'))
+    ok_(isinstance(replies[7], RedisMessage))
+    eq_(len(replies), 8)
+    eq_(len(p.buf), 0)
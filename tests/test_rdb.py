@@ -0,0 +1,64 @@
+# vim :set ts=4 sw=4 sts=4 et :
+import sys, cPickle
+from collections import deque
+from nose.tools import ok_, eq_, raises
+
+sys.path.append('..')
+
+from miniredis.rdb import dumps, loads, load, DecodeError
+from miniredis.sset import SortedSet
+from miniredis.intset import IntSet
+
+
+def roundtrip(value, deadline=None):
+    data = dumps((value, deadline))
+    eq_(loads(data), (value, deadline))
+    return data
+
+def test_strings():
+    for s in ('', 'a', 'x' * 100, 'x' * 20000, '\x00\xff', '12', '-1', '65536', '01', '-0', '1e3', ' 1'):
+        value, deadline = loads(roundtrip(s))
+        ok_(isinstance(value, str))
+    # canonical numbers take their binary form
+    eq_(len(dumps(('100', None))), 3)
+    eq_(len(dumps(('100000', None))), 6)
+
+def test_integers():
+    for n in (0, -1, 127, 128, 2 ** 31, -2 ** 63, 2 ** 80):
+        value, deadline = loads(roundtrip(n))
+        ok_(isinstance(value, (int, long)))
+
+def test_collections():
+    roundtrip(deque(['a', '1', 'x' * 300]))
+    roundtrip(set(['a', 'b', '3']))
+    roundtrip({'field': 'value', '1': '2'})
+    roundtrip({})
+    value, deadline = loads(dumps((IntSet(['3', '-70000', '12']), None)))
+    ok_(isinstance(value, IntSet))
+    eq_(list(value), ['-70000', '3', '12'])
+    zset = SortedSet()
+    zset.insert('a', 1.5)
+    zset.insert('b', -3)
+    value, deadline = loads(dumps((zset, 1400000000.123)))
+    eq_(list(value), [(-3, 'b'), (1.5, 'a')])
+    eq_(deadline, 1400000000.123)
+
+def test_deadline():
+    eq_(loads(dumps(('value', 1400000000.5)))[1], 1400000000.5)
+
+def test_stream():
+    data = dumps((deque(['a']), None)) + dumps(('b', 5.0))
+    value, deadline, end = load(buffer(data))
+    eq_(value, deque(['a']))
+    eq_(load(buffer(data), end), ('b', 5.0, len(data)))
+
+def test_pickle():
+    eq_(loads(cPickle.dumps(({'a': 1}, None), 2)), ({'a': 1}, None))
+
+@raises(DecodeError)
+def test_truncated():
+    loads(dumps((deque(['abc']), None))[:-1])
+
+@raises(TypeError)
+def test_unsupported():
+    dumps((1.5, None))
@@ -0,0 +1,96 @@
+# vim :set ts=4 sw=4 sts=4 et :
+import sys
+from nose.tools import ok_, eq_
+
+sys.path.append('..')
+
+import local
+from local import setup, teardown, call
+import miniredis.server
+from miniredis.protocol import RedisError
+
+
+def scan_all(*args, **kwargs):
+    """Run an iteration to the end, changing the keyspace along the way"""
+    change = kwargs.get('change')
+    cursor, seen, steps = '0', [], 0
+    while True:
+        command = list(args)
+        command.insert(1 if args[0] == 'SCAN' else 2, cursor)
+        cursor, found = call(*command)
+        seen.extend(found)
+        steps += 1
+        if change:
+            change(steps)
+        if cursor == '0':
+            return seen, steps
+
+
+def test_scan():
+    call('FLUSHDB')
+    for i in xrange(100):
+        call('SET', 'key%d' % i, 'x')
+    call('RPUSH', 'list', 'x')
+    def change(step):
+        # keys added and removed while iterating, growing the table
+        call('DEL', 'key%d' % step)
+        for i in xrange(50):
+            call('SET', 'new%d:%d' % (step, i), 'x')
+    seen, steps = scan_all('SCAN', 'COUNT', '10', change=change)
+    eq_(steps, 11)
+    eq_(len(seen), len(set(seen)))
+    ok_(set('key%d' % i for i in xrange(11, 100)) <= set(seen))
+    ok_(not [k for k in seen if k.startswith('new')])
+    seen, steps = scan_all('SCAN', 'MATCH', 'key1?', 'COUNT', '1000')
+    eq_((sorted(seen), steps), (['key%d' % i for i in xrange(12, 20)], 1))
+    eq_(scan_all('SCAN', 'TYPE', 'list')[0], ['list'])
+    ok_(isinstance(call('SCAN', '12345'), RedisError))
+    ok_(isinstance(call('SCAN', '0', 'COUNT'), RedisError))
+
+
+def test_collections():
+    call('FLUSHDB')
+    call('ZADD', 'z', *[x for i in xrange(50) for x in (str(i), 'm%d' % i)])
+    for i in xrange(50):
+        call('HSET', 'h', 'f%d' % i, 'v%d' % i)
+    local.c.table['s'] = set('m%d' % i for i in xrange(50))
+    seen = scan_all('ZSCAN', 'z', 'COUNT', '7')[0]
+    eq_(sorted(zip(seen[::2], seen[1::2])), sorted(('m%d' % i, str(i)) for i in xrange(50)))
+    seen = scan_all('HSCAN', 'h', 'MATCH', 'f1*')[0]
+    eq_(sorted(zip(seen[::2], seen[1::2])), sorted(('f%s' % i, 'v%s' % i) for i in ['1'] + range(10, 20)))
+    eq_(sorted(scan_all('SSCAN', 's')[0]), sorted(local.c.table['s']))
+    eq_(call('SSCAN', 'nothere', '0'), ['0', []])
+    # a cursor only works for the collection it was handed out for
+    cursor = call('ZSCAN', 'z', '0')[0]
+    ok_(isinstance(call('HSCAN', 'h', cursor), RedisError))
+    ok_(call('ZSCAN', 'z', cursor)[1])
+
+
+def test_eviction():
+    call('FLUSHDB')
+    for i in xrange(20):
+        call('SET', 'key%d' % i, 'x')
+    limit = miniredis.server.SCAN_MAX_ELEMENTS
+    # forget the iterations other tests left open, and make room for three
+    local.server.scans.clear()
+    local.server.scan_elements = 0
+    miniredis.server.SCAN_MAX_ELEMENTS = 60
+    try:
+        cursors = [call('SCAN', '0', 'COUNT', '5')[0] for i in xrange(3)]
+        # no room left, and no iteration idle long enough to be dropped
+        eq_(call('SCAN', '0', 'COUNT', '5').prefix, 'BUSY')
+        eq_(local.server.scan_elements, 60)
+        steps = [call('SCAN', cursor, 'COUNT', '5') for cursor in cursors]
+        eq_([len(keys) for cursor, keys in steps], [5, 5, 5])
+        # the least recently used iteration goes once it has been left idle
+        scan_id, (target, elements, used) = next(local.server.scans.iteritems())
+        local.server.scans[scan_id] = (target, elements, used - miniredis.server.SCAN_IDLE_TIMEOUT)
+        ok_(call('SCAN', '0', 'COUNT', '5')[1])
+        ok_(isinstance(call('SCAN', cursors[0]), RedisError))
+        # a finished iteration gives its room back
+        cursor = steps[1][0]
+        while cursor != '0':
+            cursor = call('SCAN', cursor, 'COUNT', '5')[0]
+        eq_(local.server.scan_elements, 40)
+    finally:
+        miniredis.server.SCAN_MAX_ELEMENTS = limit
@@ -0,0 +1,112 @@
+# vim :set ts=4 sw=4 sts=4 et :
+import os, sys, signal, time
+from nose.tools import ok_, eq_, istest
+
+sys.path.append('..')
+
+import miniredis.server
+from miniredis.client import RedisClient
+from miniredis.protocol import encode_request
+
+pid = None
+r = None
+
+def setup_module(module):
+    global pid, r
+    pid = miniredis.server.fork()
+    print("Launched server with pid %d." % pid)
+    time.sleep(1)
+    r = RedisClient()
+
+def teardown_module(module):
+    global pid
+    os.kill(pid, signal.SIGKILL)
+    print("Killed server.")
+
+
+def test_config():
+    eq_(r.config('get', 'hz'), ['hz', '10'])
+    eq_(r.config('set', 'trace-sample-rate', '0.5'), 'OK')
+    eq_(r.config('get', 'trace*'), ['trace-sample-rate', '0.5'])
+    eq_(r.config('set', 'trace-sample-rate', '0'), 'OK')
+    for name, value in (('hz', '0'), ('hz', '501'), ('trace-sample-rate', '2'), ('save', '1 x')):
+        try:
+            r.config('set', name, value)
+            ok_(False)
+        except Exception, e:
+            ok_('Invalid argument' in str(e))
+    eq_(r.config('get', 'hz'), ['hz', '10'])
+    eq_(r.config('get', 'save'), ['save', '3600 1 300 100 60 10000'])
+
+def test_partial_request():
+    eq_(r.set('test:key', 'value'), 'OK')
+    slow = RedisClient()
+    request = encode_request(['GET', 'test:key'])
+    slow.sock.send(request[:-5])
+    time.sleep(0.1)
+    # other clients are served while the request is incomplete
+    eq_(r.ping(), 'PONG')
+    slow.sock.send(request[-5:])
+    eq_(slow.parse_response(), 'value')
+    eq_(r.delete('test:key'), 1)
+
+def test_large_reply():
+    value = 'x' * (32 << 20)
+    eq_(r.set('test:big', value), 'OK')
+    reader = RedisClient()
+    reader.sock.send(encode_request(['GET', 'test:big']))
+    time.sleep(0.2)
+    # the reply outgrows the socket buffers, and waits for them to drain
+    # without holding up other clients
+    eq_(r.ping(), 'PONG')
+    ok_(reader.parse_response() == value)
+    eq_(reader.ping(), 'PONG')
+    eq_(r.delete('test:big'), 1)
+
+def test_pipeline():
+    r.delete('test:counter')
+    p = RedisClient()
+    p.sock.send(''.join([encode_request(['INCR', 'test:counter'])] * 100) +
+                encode_request(['GET', 'test:counter']))
+    eq_([p.parse_response() for i in range(100)], range(1, 101))
+    eq_(p.parse_response(), '100')
+    eq_(r.delete('test:counter'), 1)
+
+def test_info():
+    info = r.info()
+    ok_('# Stats' in info)
+    ok_('total_commands_processed:' in info)
+
+def test_monitor():
+    m = RedisClient()
+    eq_(m.monitor(), 'OK')
+    eq_(r.set('test:key', 'value'), 'OK')
+    line = m.parse_response()
+    ok_(line.endswith('"set" "test:key" "value"'))
+
+def test_pubsub():
+    s = RedisClient()
+    p = RedisClient()
+    eq_(s.subscribe('test:a', 'test:b'), ['subscribe', 'test:a', 1])
+    eq_(s.parse_response(), ['subscribe', 'test:b', 2])
+    eq_(p.psubscribe('test:[ab]*'), ['psubscribe', 'test:[ab]*', 1])
+    try:
+        s.get('test:key')
+        ok_(False)
+    except Exception, e:
+        ok_("only (P)SUBSCRIBE" in str(e))
+    eq_(s.ping(), ['pong', ''])
+    eq_(r.pubsub('numsub', 'test:a', 'test:c'), ['test:a', 1, 'test:c', 0])
+    eq_(r.pubsub('numpat'), 1)
+    eq_(r.publish('test:a', 'hello'), 2)
+    eq_(s.parse_response(), ['message', 'test:a', 'hello'])
+    eq_(p.parse_response(), ['pmessage', 'test:[ab]*', 'test:a', 'hello'])
+    eq_(r.publish('test:c', 'nobody'), 0)
+    eq_(s.unsubscribe('test:a'), ['unsubscribe', 'test:a', 1])
+    eq_(r.publish('test:b', 'x' * 100000), 2)
+    eq_(s.parse_response(), ['message', 'test:b', 'x' * 100000])
+    eq_(p.parse_response(), ['pmessage', 'test:[ab]*', 'test:b', 'x' * 100000])
+    eq_(s.unsubscribe(), ['unsubscribe', 'test:b', 0])
+    eq_(s.get('test:nothere'), None)
+    eq_(p.punsubscribe(), ['punsubscribe', 'test:[ab]*', 0])
+    eq_(r.pubsub('numpat'), 0)
@@ -0,0 +1,103 @@
+# vim :set ts=4 sw=4 sts=4 et :
+import sys
+from nose.tools import ok_, eq_
+
+sys.path.append('..')
+
+import local
+from local import setup, teardown, call
+from miniredis.intset import IntSet
+from miniredis.protocol import RedisError
+
+
+def test_sadd():
+    eq_(call('SADD', 's', 'a', 'b', 'a'), 2)
+    eq_(call('SADD', 's', 'b', 'c'), 1)
+    eq_(call('TYPE', 's').message, 'set')
+    eq_(local.c.table['s'], set(['a', 'b', 'c']))
+    call('SET', 'str', 'x')
+    ok_(isinstance(call('SADD', 'str', 'a'), RedisError))
+    call('DEL', 's', 'str')
+
+def test_members():
+    call('SADD', 's', 'a', 'b', 'c')
+    eq_(call('SCARD', 's'), 3)
+    eq_(call('SCARD', 'nothere'), 0)
+    eq_(call('SISMEMBER', 's', 'a'), 1)
+    eq_(call('SISMEMBER', 's', 'x'), 0)
+    eq_(sorted(call('SMEMBERS', 's')), ['a', 'b', 'c'])
+    eq_(call('SMEMBERS', 'nothere'), [])
+    eq_(call('SREM', 's', 'a', 'x'), 1)
+    eq_(call('SMOVE', 's', 't', 'b'), 1)
+    eq_(call('SMOVE', 's', 't', 'b'), 0)
+    eq_(call('SMEMBERS', 't'), ['b'])
+    eq_(call('SREM', 's', 'c'), 1)
+    # emptied sets go away
+    ok_('s' not in local.c.table)
+    call('DEL', 't')
+
+def test_operations():
+    call('SADD', 'a', '1', '2', '3', 'x')
+    call('SADD', 'b', '2', '3', '4')
+    call('SADD', 'c', '3', 'x', 'y')
+    eq_(sorted(call('SINTER', 'a', 'b', 'c')), ['3'])
+    eq_(call('SINTER', 'a', 'nothere'), [])
+    eq_(sorted(call('SUNION', 'a', 'b', 'nothere')), ['1', '2', '3', '4', 'x'])
+    eq_(sorted(call('SDIFF', 'a', 'b', 'c')), ['1'])
+    eq_(call('SDIFF', 'nothere', 'a'), [])
+    eq_(call('SINTERSTORE', 'd', 'a', 'b'), 2)
+    eq_(local.c.table['d'].__class__, IntSet)
+    eq_(call('SUNIONSTORE', 'd', 'b', 'c'), 5)
+    eq_(sorted(call('SMEMBERS', 'd')), ['2', '3', '4', 'x', 'y'])
+    eq_(call('SDIFFSTORE', 'd', 'a', 'a'), 0)
+    ok_('d' not in local.c.table)
+    call('SET', 'str', 'x')
+    ok_(isinstance(call('SINTER', 'a', 'str'), RedisError))
+    ok_(isinstance(call('SUNIONSTORE', 'd', 'a', 'str'), RedisError))
+    call('DEL', 'a', 'b', 'c', 'str')
+
+def test_random():
+    call('SADD', 's', *map(str, range(10)))
+    eq_(call('SRANDMEMBER', 's') in local.c.table['s'], True)
+    eq_(len(set(call('SRANDMEMBER', 's', '5'))), 5)
+    eq_(len(call('SRANDMEMBER', 's', '20')), 10)
+    eq_(len(call('SRANDMEMBER', 's', '-20')), 20)
+    eq_(call('SRANDMEMBER', 'nothere', '3'), [])
+    popped = call('SPOP', 's', '3') + [call('SPOP', 's')]
+    eq_(len(set(popped)), 4)
+    eq_(call('SCARD', 's'), 6)
+    eq_(local.server.propagated(local.c, 'spop', ['SPOP', 's', '3'], popped[:3]), [['SREM', 's'] + popped[:3]])
+    eq_(local.server.propagated(local.c, 'spop', ['SPOP', 'nothere'], None), [])
+    ok_(isinstance(call('SPOP', 's', '-1'), RedisError))
+    call('DEL', 's')
+
+def test_intset():
+    call('SADD', 's', '1', '-5', '70000')
+    value = local.c.table['s']
+    ok_(isinstance(value, IntSet))
+    eq_(list(value), ['-5', '1', '70000'])
+    # only integers written the canonical way fit
+    ok_('01' not in value)
+    call('SADD', 's', '01')
+    ok_(isinstance(local.c.table['s'], set))
+    eq_(sorted(call('SMEMBERS', 's')), ['-5', '01', '1', '70000'])
+    call('DEL', 's')
+    eq_(call('CONFIG', 'SET', 'set-max-intset-entries', '4'), True)
+    call('SADD', 's', '1', '2', '3', '4', '4')
+    ok_(isinstance(local.c.table['s'], IntSet))
+    call('SADD', 's', '5')
+    ok_(isinstance(local.c.table['s'], set))
+    eq_(call('SCARD', 's'), 5)
+    call('CONFIG', 'SET', 'set-max-intset-entries', '512')
+    call('DEL', 's')
+
+def test_intset_widths():
+    value = IntSet()
+    for n in (3, -2, 40000, 2 ** 40, -2 ** 63):
+        ok_(value.add(str(n)))
+    ok_(not value.add('3'))
+    eq_(list(value), map(str, sorted((3, -2, 40000, 2 ** 40, -2 ** 63))))
+    ok_(str(2 ** 40) in value)
+    ok_(value.discard('-2'))
+    ok_(not value.discard('-2'))
+    eq_(len(value), 4)
@@ -0,0 +1,52 @@
+# vim :set ts=4 sw=4 sts=4 et :
+import sys
+from nose.tools import ok_, eq_
+
+sys.path.append('..')
+
+import local
+from local import setup, teardown, call
+from miniredis.shared import SharedValues
+from miniredis.protocol import RedisError
+
+
+def fresh(s):
+    """A string equal to s, but not the same object, as if read from a socket"""
+    return ''.join(list(s))
+
+
+def test_pool():
+    shared = SharedValues(0, 9999, 8)
+    eq_(shared.saved(), (0, 0))
+    a, b = shared.integer(int('5000')), shared.integer(int('5000'))
+    ok_(a is b)
+    eq_(shared.integer(20000), 20000)
+    x, y = shared.string(fresh('true')), shared.string(fresh('true'))
+    ok_(x is y)
+    long_value = fresh('x' * 9)
+    ok_(shared.string(long_value) is long_value)
+    eq_(shared.saved(), (sys.getsizeof(a) + sys.getsizeof(x), 2))
+    del a, b, x, y
+    eq_(shared.saved(), (0, 0))
+    shared.prune()
+    eq_(shared.strings, {})
+
+def test_writes():
+    for i in range(3):
+        call('SET', 'k%d' % i, fresh('true'))
+        call('HSET', 'h%d' % i, fresh('field'), fresh('1'))
+        call('INCRBY', 'n%d' % i, '5000')
+    ok_(local.c.table['k0'] is local.c.table['k2'])
+    ok_(local.c.table['n0'] is local.c.table['n2'])
+    eq_(call('GET', 'n0'), '5000')
+    info = dict(line.split(':', 1) for line in call('INFO', 'memory').splitlines()[1:] if line)
+    ok_(int(info['shared_memory_saved']) > 0)
+    eq_(call('CONFIG', 'SET', 'shared-integers-max', '10'), True)
+    eq_(len(local.server.shared.integers), 11)
+    call('CONFIG', 'SET', 'shared-integers-max', '9999')
+    # the pool is built eagerly, so its bounds are capped
+    for name, value in (('shared-integers-max', '1000000000'), ('shared-integers-min', '-1000000000'),
+                        ('shared-value-max-length', '1000000'), ('set-max-intset-entries', '-1')):
+        ok_(isinstance(call('CONFIG', 'SET', name, value), RedisError))
+    eq_(len(local.server.shared.integers), 10000)
+    call('DEL', 'k0', 'k1', 'k2', 'h0', 'h1', 'h2', 'n0', 'n1', 'n2')
@@ -0,0 +1,156 @@
+# vim :set ts=4 sw=4 sts=4 et :
+import os, sys, time, shutil, tempfile
+from nose.tools import ok_, eq_
+
+sys.path.append('..')
+
+from miniredis.server import RedisServer, RedisConnection
+from miniredis.haystack import Haystack
+from miniredis.protocol import EMPTY_SCALAR, RedisError
+
+path = None
+
+def setup():
+    global path
+    path = tempfile.mkdtemp()
+
+def teardown():
+    shutil.rmtree(path)
+
+def open_server():
+    server = RedisServer(port=6420, db_path=path)
+    client = RedisConnection(None)
+    server.select(client, 0)
+    return server, client
+
+
+def test_incremental():
+    server, c = open_server()
+    server.call(c, ['SET', 'a', '1'])
+    server.call(c, ['SET', 'b', '2'])
+    server.call(c, ['EXPIRE', 'b', '100'])
+    server.call(c, ['SELECT', '1'])
+    server.call(c, ['RPUSH', 'list', 'x'])
+    eq_(server.dirty, set([(0, 'a'), (0, 'b'), (1, 'list')]))
+    server.save()
+    eq_(server.dirty, set())
+    eq_(sorted(server.meta.keys()), ['0 a', '0 b', '1 list'])
+    size = os.path.getsize(server.meta.cache)
+    server.call(c, ['SELECT', '0'])
+    server.call(c, ['DEL', 'a'])
+    server.call(c, ['SET', 'b', '3'])
+    server.save()
+    eq_(sorted(server.meta.keys()), ['0 b', '1 list'])
+    # only the changed key was written again, along with a tombstone
+    meta = server.meta
+    eq_(os.path.getsize(meta.cache), size + meta._footprint('0 b', meta.stats('0 b')[1]) + meta._footprint('0 a', 0))
+
+    server, c = open_server()
+    eq_(server.call(c, ['GET', 'a']), EMPTY_SCALAR)
+    eq_(server.call(c, ['GET', 'b']), '3')
+    eq_(server.call(c, ['TTL', 'b']), -1)
+    server.call(c, ['SELECT', '1'])
+    eq_(server.call(c, ['LRANGE', 'list', '0', '-1']), ['x'])
+    server.call(c, ['FLUSHALL'])
+    server.save()
+    eq_(server.meta.keys(), [])
+
+
+def test_legacy():
+    meta = Haystack(path, 'redisdb')
+    meta[0] = {'a': '1', 'b': '2'}
+    meta[2] = {'c': '3'}
+    meta['timeouts'] = {(0, 'b'): time.time() + 100}
+    meta.commit()
+    server, c = open_server()
+    eq_(server.call(c, ['GET', 'a']), '1')
+    ok_(0 < server.call(c, ['TTL', 'b']) <= 100)
+    server.save()
+    eq_(sorted(server.meta.keys()), ['0 a', '0 b', '2 c'])
+    server, c = open_server()
+    ok_(0 < server.call(c, ['TTL', 'b']) <= 100)
+    server.call(c, ['SELECT', '2'])
+    eq_(server.call(c, ['GET', 'c']), '3')
+    server.call(c, ['FLUSHALL'])
+    server.save()
+
+
+def wait_bgsave(server):
+    for i in xrange(100):
+        server.check_children()
+        if not server.bgsave_pid:
+            return
+        time.sleep(0.05)
+
+def test_bgsave():
+    server, c = open_server()
+    server.call(c, ['SET', 'a', '1'])
+    server.call(c, ['SETEX', 'b', '100', '2'])
+    eq_(server.changes, 2)
+    ok_(server.call(c, ['BGSAVE']).message.startswith('Background saving'))
+    ok_(server.bgsave_pid)
+    eq_(server.call(c, ['BGSAVE']).message, 'Background save already in progress')
+    ok_(isinstance(server.call(c, ['SAVE']), RedisError))
+    # written while the child runs, so left for the next save
+    server.call(c, ['SET', 'c', '3'])
+    wait_bgsave(server)
+    eq_(server.last_bgsave_status, 'ok')
+    eq_(server.changes, 1)
+    eq_(server.dirty, set([(0, 'c')]))
+    eq_(sorted(server.meta.keys()), ['0 a', '0 b'])
+    ok_('rdb_bgsave_in_progress:0' in server.info('persistence'))
+    server.save()
+    server, c = open_server()
+    eq_(server.call(c, ['GET', 'c']), '3')
+    ok_(0 < server.call(c, ['TTL', 'b']) <= 100)
+    server.call(c, ['FLUSHALL'])
+    server.save()
+
+def test_save_points():
+    server, c = open_server()
+    eq_(server.call(c, ['CONFIG', 'SET', 'save', '1 2']), True)
+    eq_(server.save_points, [(1, 2)])
+    ok_(isinstance(server.call(c, ['CONFIG', 'SET', 'save', '1']), RedisError))
+    server.lastsave -= 2
+    server.call(c, ['SET', 'a', '1'])
+    server.check_save_points(time.time())
+    eq_(server.bgsave_pid, None)
+    server.call(c, ['SET', 'b', '1'])
+    server.check_save_points(time.time())
+    ok_(server.bgsave_pid)
+    wait_bgsave(server)
+    eq_(server.changes, 0)
+    eq_(sorted(server.meta.keys()), ['0 a', '0 b'])
+    server.call(c, ['FLUSHALL'])
+    server.save()
+
+def test_load():
+    server, c = open_server()
+    for db in xrange(3):
+        server.call(c, ['SELECT', str(db)])
+        for i in xrange(2000):
+            server.call(c, ['SET', 'k%d' % i, str(db)])
+        server.call(c, ['SETEX', 'volatile', '100', 'v'])
+    server.timeouts[(2, 'volatile')] = time.time() - 1
+    server.save()
+    for workers in (0, 3):
+        server = RedisServer(port=6420, db_path=path, load_workers=workers)
+        seen = []
+        server.loading_events = lambda: seen.append(server.info('persistence'))
+        server.load()
+        eq_(sorted(server.tables), [0, 1, 2])
+        eq_(server.tables[1]['k5'], '1')
+        eq_(server.last_load_keys, 6002)
+        ok_(server.timeouts.get((0, 'volatile')))
+        ok_('volatile' not in server.tables[2])
+        eq_(server.dirty, set([(2, 'volatile')]))
+        ok_(seen and 'loading:1' in seen[0])
+        ok_('loading:0' in server.info('persistence'))
+    c = RedisConnection(None)
+    server.select(c, 0)
+    server.loading = True
+    eq_(server.call(c, ['GET', 'k1']).prefix, 'LOADING')
+    ok_(server.call(c, ['INFO']).startswith('# Server'))
+    server.loading = False
+    server.call(c, ['FLUSHALL'])
+    server.save()
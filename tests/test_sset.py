@@ -0,0 +1,61 @@
+# vim :set ts=4 sw=4 sts=4 et :
+import sys, random, cPickle
+from nose.tools import ok_, eq_
+
+sys.path.append('..')
+
+from miniredis.sset import SortedSet
+
+
+def test_basic():
+    zset = SortedSet()
+    ok_(zset.insert('b', 2))
+    ok_(zset.insert('a', 1))
+    ok_(not zset.insert('b', 3))
+    eq_(list(zset), [(1, 'a'), (3, 'b')])
+    eq_(list(reversed(zset)), [(3, 'b'), (1, 'a')])
+    eq_(zset.rank('b'), 1)
+    eq_(zset.rank('c'), None)
+    eq_((zset.min_score(), zset.max_score()), (1, 3))
+    ok_(zset.remove('a'))
+    ok_(not zset.remove('a'))
+    eq_(zset.range(0, -1), [(3, 'b')])
+    zset.clear()
+    eq_(zset.range(0, -1), [])
+    eq_(zset.scorerange(0, 10), [])
+
+
+def test_against_list():
+    random.seed(1)
+    zset, members = SortedSet(), {}
+    for i in xrange(3000):
+        member = 'm%d' % random.randrange(500)
+        if random.random() < 0.3:
+            zset.remove(member)
+            members.pop(member, None)
+        else:
+            score = random.randrange(100)
+            zset.insert(member, score)
+            members[member] = score
+    expected = sorted((score, member) for member, score in members.iteritems())
+    eq_(list(zset), expected)
+    eq_(list(reversed(zset)), expected[::-1])
+    for rank, (score, member) in enumerate(expected):
+        eq_(zset.rank(member), rank)
+    for start, end in ((0, -1), (5, 10), (-10, -1), (-1000, 3), (7, 1000), (10, 5)):
+        n = len(expected)
+        s = max(start + n, 0) if start < 0 else start
+        e = end + n if end < 0 else end
+        eq_(zset.range(start, end), expected[s:e + 1])
+        eq_(zset.range(start, end, desc=True), expected[::-1][s:e + 1])
+    for low, high in ((10, 20), (-5, 0), (99, 200), (50, 40)):
+        eq_(zset.scorerange(low, high), [p for p in expected if low <= p[0] <= high])
+
+
+def test_pickle():
+    zset = SortedSet()
+    for i in xrange(5000):
+        zset.insert('m%d' % i, i % 7)
+    copy = cPickle.loads(cPickle.dumps(zset, 2))
+    eq_(list(copy), list(zset))
+    eq_(copy.rank('m10'), zset.rank('m10'))
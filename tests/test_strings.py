@@ -28,3 +28,46 @@ def test_append():
     eq_(r.set('test:key', 'value'),'OK')
     eq_(r.append('test:key', 'value'),10)
     eq_(r.get('test:key'),'valuevalue')
+
+def test_mset():
+    eq_(r.mset('test:a', '1', 'test:b', '2'), 'OK')
+    eq_(r.mget('test:a', 'test:b', 'test:nothere'), ['1', '2', None])
+    eq_(r.msetnx('test:b', '3', 'test:c', '3'), 0)
+    eq_(r.get('test:c'), None)
+    eq_(r.msetnx('test:c', '3', 'test:d', '4'), 1)
+    eq_(r.mget('test:c', 'test:d'), ['3', '4'])
+    r.rpush('test:list', 'x')
+    eq_(r.mget('test:list', 'test:a'), [None, '1'])
+    try:
+        r.mset('test:a', '1', 'test:b')
+        ok_(False)
+    except Exception, e:
+        ok_('wrong number of arguments' in str(e))
+
+def test_getset():
+    eq_(r.set('test:key', 'old'), 'OK')
+    eq_(r.pexpire('test:key', 50), 1)
+    time.sleep(0.1)
+    eq_(r.getset('test:key', 'new'), None)
+    eq_(r.ttl('test:key'), -1)
+    # a wrong-type GETSET leaves the expiry alone
+    r.rpush('test:getset', 'x')
+    eq_(r.expire('test:getset', 100), 1)
+    try:
+        r.getset('test:getset', 'new')
+        ok_(False)
+    except Exception, e:
+        ok_('wrong kind of value' in str(e))
+    eq_(r.ttl('test:getset'), 100)
+    # only strings can be read or swapped out
+    r.hset('test:hash', 'a', '1')
+    r.sadd('test:set', '1')
+    for key in ['test:hash', 'test:set']:
+        for command in [lambda: r.get(key), lambda: r.getset(key, 'new')]:
+            try:
+                command()
+                ok_(False)
+            except Exception, e:
+                ok_('wrong kind of value' in str(e))
+    eq_(r.type('test:hash'), 'hash')
+    eq_(r.delete('test:hash', 'test:set'), 2)
@@ -0,0 +1,67 @@
+# vim :set ts=4 sw=4 sts=4 et :
+import sys
+from nose.tools import ok_, eq_
+
+sys.path.append('..')
+
+import local
+from local import setup, teardown, call
+from miniredis.protocol import EMPTY_SCALAR, RedisError
+
+
+def test_zadd():
+    call('DEL', 'z')
+    eq_(call('ZADD', 'z', '1', 'a', '2', 'b'), 2)
+    eq_(call('TYPE', 'z').message, 'zset')
+    eq_(call('ZADD', 'z', 'NX', '5', 'a', '3', 'c'), 1)
+    eq_(call('ZADD', 'z', 'XX', 'CH', '5', 'a', '4', 'd'), 1)
+    eq_(call('ZADD', 'z', 'GT', 'CH', '1', 'a', '6', 'b'), 1)
+    eq_(call('ZADD', 'z', 'LT', '7', 'b'), 0)
+    eq_(call('ZRANGE', 'z', '0', '-1', 'WITHSCORES'), ['c', '3', 'a', '5', 'b', '6'])
+    eq_(call('ZADD', 'z', 'INCR', '1.5', 'c'), '4.5')
+    eq_(call('ZADD', 'z', 'NX', 'INCR', '1', 'c'), EMPTY_SCALAR)
+    eq_(call('ZINCRBY', 'z', '-inf', 'c'), '-inf')
+    eq_(call('ZSCORE', 'z', 'c'), '-inf')
+    ok_(isinstance(call('ZADD', 'z', 'NX', 'XX', '1', 'a'), RedisError))
+    ok_(isinstance(call('ZADD', 'z', '1', 'a', '2'), RedisError))
+    ok_(isinstance(call('ZADD', 'z', 'nan', 'a'), RedisError))
+    eq_(call('ZADD', 'missing', 'XX', '1', 'a'), 0)
+    eq_(call('EXISTS', 'missing'), False)
+    call('SET', 'string', 'x')
+    eq_(call('ZADD', 'string', '1', 'a').message, 'Operation against a key holding the wrong kind of value')
+
+
+def test_ranges():
+    call('DEL', 'z')
+    call('ZADD', 'z', *[x for i in xrange(10) for x in (str(i), 'm%d' % i)])
+    eq_(call('ZCARD', 'z'), 10)
+    eq_(call('ZRANK', 'z', 'm3'), 3)
+    eq_(call('ZREVRANK', 'z', 'm3'), 6)
+    eq_(call('ZRANK', 'z', 'nothere'), EMPTY_SCALAR)
+    eq_(call('ZRANGE', 'z', '-2', '100'), ['m8', 'm9'])
+    eq_(call('ZREVRANGE', 'z', '0', '1', 'WITHSCORES'), ['m9', '9', 'm8', '8'])
+    eq_(call('ZRANGEBYSCORE', 'z', '(2', '5'), ['m3', 'm4', 'm5'])
+    eq_(call('ZRANGEBYSCORE', 'z', '-inf', '+inf', 'LIMIT', '2', '3'), ['m2', 'm3', 'm4'])
+    eq_(call('ZREVRANGEBYSCORE', 'z', '5', '(2', 'LIMIT', '1', '-1'), ['m4', 'm3'])
+    eq_(call('ZRANGEBYSCORE', 'z', '5', '2'), [])
+    eq_(call('ZCOUNT', 'z', '(2', '(5'), 2)
+    eq_(call('ZREMRANGEBYSCORE', 'z', '8', 'inf'), 2)
+    eq_(call('ZREMRANGEBYRANK', 'z', '0', '1'), 2)
+    eq_(call('ZREM', 'z', 'm2', 'm3', 'nothere'), 2)
+    eq_(call('ZRANGE', 'z', '0', '-1'), ['m4', 'm5', 'm6', 'm7'])
+    eq_(call('ZREMRANGEBYRANK', 'z', '0', '-1'), 4)
+    eq_(call('EXISTS', 'z'), False)
+
+
+def test_store():
+    call('DEL', 'a', 'b', 's', 'out')
+    call('ZADD', 'a', '1', 'x', '2', 'y')
+    call('ZADD', 'b', '10', 'y', '20', 'z')
+    local.c.table['s'] = set(['y'])
+    eq_(call('ZUNIONSTORE', 'out', '2', 'a', 'b', 'WEIGHTS', '2', '1'), 3)
+    eq_(call('ZRANGE', 'out', '0', '-1', 'WITHSCORES'), ['x', '2', 'y', '14', 'z', '20'])
+    eq_(call('ZINTERSTORE', 'out', '3', 'a', 'b', 's', 'AGGREGATE', 'MAX'), 1)
+    eq_(call('ZRANGE', 'out', '0', '-1', 'WITHSCORES'), ['y', '10'])
+    eq_(call('ZINTERSTORE', 'out', '2', 'a', 'nothere'), 0)
+    eq_(call('EXISTS', 'out'), False)
+    eq_(local.server.commands['zunionstore'].keys(['ZUNIONSTORE', 'out', '2', 'a', 'b', 'WEIGHTS', '1', '2']), ['out', 'a', 'b'])